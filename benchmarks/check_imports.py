@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+
+"""
+Import-time regression check of the covseq entry point.
+
+Each case is imported in a fresh interpreter: the covseq CLI alone (what "covseq --help" or a worker waiting for its
+first job pays for), then the module of each covseq command. For each case, the best import time over --repeat runs is
+reported along with the heavy third-party modules loaded. The check fails when a case loads a heavy module it isn't
+allowed to (the CLI none of them, each command only what it computes with), or is slower than --max_time.
+
+Example: python benchmarks/check_imports.py --max_time 1.0
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+
+HEAVY_MODULES = ['numpy', 'pandas', 'Bio', 'vcf', 'pysam', 'pyarrow', 'scipy', 'matplotlib']
+# Heavy modules each case may load, the CLI itself none of them (recent pandas import pyarrow when it is installed)
+ALLOWED_MODULES = {
+    'cli': [],
+    'nanopore_metrics': ['numpy', 'pandas', 'pyarrow'],
+    'check_variants': ['numpy'],
+    'ivar_variants_to_vcf': [],
+    'variant_db': ['numpy']
+    }
+IMPORT_CODE = """
+import sys, json, time
+start = time.perf_counter()
+from covseq import cli
+if %(command)r != 'cli':
+    cli.load_tool(%(command)r)
+elapsed = time.perf_counter() - start
+print(json.dumps({'time': elapsed, 'modules': sorted(set(name.split('.')[0] for name in sys.modules) & set(%(heavy)r))}))
+"""
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Checks the import time and the heavy modules loaded by the covseq CLI and each of its commands."
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-r',
+                        '--repeat',
+                        help="Number of fresh interpreters each case is imported in, the best time being kept (Default: 3).",
+                        type=int,
+                        default=3)
+
+    parser.add_argument('-m',
+                        '--max_time',
+                        help="Maximum import time of the CLI alone, in seconds (Default: no limit).",
+                        type=float,
+                        required=False)
+
+    return parser.parse_args()
+
+def import_case(command, repeat):
+    """
+    Returns the best import time of a case and the heavy modules it loaded
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [REPO_DIR, os.environ.get('PYTHONPATH')])))
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", IMPORT_CODE % {'command': command, 'heavy': HEAVY_MODULES}],
+                                stdout=subprocess.PIPE, universal_newlines=True, env=env, check=True).stdout
+        result = json.loads(output.splitlines()[-1])
+        times.append(result['time'])
+    return min(times), result['modules']
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    failures = []
+    sys.stdout.write("case\timport_time\theavy_modules\n")
+    for case, allowed in ALLOWED_MODULES.items():
+        import_time, modules = import_case(case, args.repeat)
+        sys.stdout.write("%s\t%.4f\t%s\n" % (case, import_time, ",".join(modules) or "-"))
+        unexpected = [module for module in modules if module not in allowed]
+        if unexpected:
+            failures.append("%s imports %s" % (case, ", ".join(unexpected)))
+        if case == 'cli' and args.max_time is not None and import_time > args.max_time:
+            failures.append("cli takes %.4fs to import, over %.4fs" % (import_time, args.max_time))
+    for failure in failures:
+        sys.stderr.write("ERROR: %s\n" % failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
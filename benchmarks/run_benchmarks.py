@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+"""
+Benchmarks check_variants(), ivar_variants_to_vcf() and the nanopore metrics main() on synthetic runs.
+
+Each tool is run on a synthetic run (see synthetic_data.py) along three scaling axes: variants per sample, samples per
+run and coverage depth, the other two axes staying at their base value. For each case, the wall time of --repeat runs
+is recorded, then one more run under tracemalloc gives the peak memory allocated.
+Results are written as JSON along with the commit they were measured on, and can be compared with a previous result
+file with --compare.
+
+Example: python benchmarks/run_benchmarks.py -o bench_$(git rev-parse --short HEAD).json --compare bench_baseline.json
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import statistics
+import subprocess
+import tracemalloc
+
+import synthetic_data
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir)
+sys.path.insert(0, os.path.join(REPO_DIR, "illumina_metrics"))
+sys.path.insert(0, os.path.join(REPO_DIR, "nanopore_metrics"))
+
+BENCHMARKS = ['check_variants', 'ivar_variants_to_vcf', 'nanopore_metrics']
+BASE = {'variants': 100, 'samples': 4, 'depth': 1000}
+AXES = {
+    'variants': [10, 100, 1000, 2000],
+    'samples': [1, 4, 16, 64],
+    'depth': [100, 1000, 10000]
+    }
+QUICK_AXES = {
+    'variants': [10, 100, 1000],
+    'samples': [1, 4],
+    'depth': [100, 1000]
+    }
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Benchmarks the variant check, iVar conversion and nanopore metrics tools on synthetic runs."
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-o',
+                        '--output',
+                        help="JSON results file (Default: stdout).",
+                        required=False)
+
+    parser.add_argument('-b',
+                        '--benchmarks',
+                        help="Benchmarks to run (Default: all).",
+                        nargs='+',
+                        choices=BENCHMARKS,
+                        default=BENCHMARKS)
+
+    parser.add_argument('-r',
+                        '--repeat',
+                        help="Number of timed runs per case (Default: 3).",
+                        type=int,
+                        default=3)
+
+    parser.add_argument('-q',
+                        '--quick',
+                        help="Smaller scaling axes, for a quick check.",
+                        action='store_true')
+
+    parser.add_argument('-s',
+                        '--seed',
+                        help="Seed of the synthetic data (Default: 0).",
+                        type=int,
+                        default=0)
+
+    parser.add_argument('-d',
+                        '--data_dir',
+                        help="Directory where the synthetic runs are generated and kept (Default: a temporary directory removed at the end).",
+                        required=False)
+
+    parser.add_argument('-c',
+                        '--compare',
+                        help="Previous JSON results file to compare the results with.",
+                        required=False)
+
+    return parser.parse_args()
+
+def git_commit():
+    """
+    Returns the commit the benchmarks are run on, None outside of a git checkout
+    """
+    try:
+        return subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "HEAD"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                              universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_check_variants(reference_file, samples, output_dir):
+    import check_variant_in_fa
+    for files in samples:
+        check_variant_in_fa.check_variants(files['vcf'], files['consensus'], reference_file, 6)
+
+def run_ivar_variants_to_vcf(reference_file, samples, output_dir):
+    import ivar_variants_to_vcf
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for files in samples:
+            ivar_variants_to_vcf.ivar_variants_to_vcf(files['ivar_tsv'], os.path.join(output_dir, files['sample'] + ".vcf"))
+
+def run_nanopore_metrics(reference_file, samples, output_dir):
+    import covid_collect_nanopore_metrics
+    argv = sys.argv
+    try:
+        # The nanopore script reads its arguments from sys.argv
+        for files in samples:
+            sys.argv = ["covid_collect_nanopore_metrics.py", "-s", files['sample'], "-c", files['consensus'], "-fqs", files['fq_stats'],
+                        "-pk", files['pickle'], "-o", os.path.join(output_dir, files['sample'] + ".metrics.csv")]
+            covid_collect_nanopore_metrics.main()
+    finally:
+        sys.argv = argv
+
+RUNNERS = {
+    'check_variants': run_check_variants,
+    'ivar_variants_to_vcf': run_ivar_variants_to_vcf,
+    'nanopore_metrics': run_nanopore_metrics
+    }
+
+def benchmark_case(runner, reference_file, samples, output_dir, repeat):
+    """
+    Returns the wall times of repeat runs and the peak memory allocated during one more run
+    """
+    # Untimed run, so imports and file system caches don't weigh on the first timing
+    runner(reference_file, samples, output_dir)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        runner(reference_file, samples, output_dir)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        runner(reference_file, samples, output_dir)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return times, peak
+
+def cases(axes):
+    """
+    Yields the parameters of each case, one axis varying at a time around the base values
+    """
+    seen = []
+    for axis, values in sorted(axes.items()):
+        for value in values:
+            params = dict(BASE, **{axis: value})
+            if params not in seen:
+                seen.append(params)
+                yield axis, params
+
+def run_benchmarks(benchmarks, axes, repeat, seed, data_dir):
+    """
+    Returns the result of each benchmark and case
+    """
+    results = []
+    for axis, params in cases(axes):
+        run_dir = os.path.join(data_dir, "v%(variants)i_n%(samples)i_d%(depth)i" % params)
+        reference_file, samples = synthetic_data.generate_run(run_dir, params['samples'], params['variants'], params['depth'], seed)
+        output_dir = os.path.join(run_dir, "output")
+        os.makedirs(output_dir, exist_ok=True)
+        for benchmark in benchmarks:
+            times, peak = benchmark_case(RUNNERS[benchmark], reference_file, samples, output_dir, repeat)
+            result = {
+                'benchmark': benchmark,
+                'axis': axis,
+                'params': params,
+                'times': times,
+                'min': min(times),
+                'median': statistics.median(times),
+                'per_sample': statistics.median(times) / params['samples'],
+                'peak_memory': peak
+                }
+            results.append(result)
+            sys.stderr.write("%-22s variants=%-5i samples=%-3i depth=%-6i median %.4fs  peak %.1f MiB\n" % (
+                benchmark, params['variants'], params['samples'], params['depth'], result['median'], peak / 2.0 ** 20))
+    return results
+
+def case_key(result):
+    return (result['benchmark'], result['params']['variants'], result['params']['samples'], result['params']['depth'])
+
+def compare_results(previous, current):
+    """
+    Returns the lines comparing the median time and peak memory of the cases found in both result sets
+    """
+    previous_results = dict((case_key(result), result) for result in previous['results'])
+    lines = ["benchmark\tvariants\tsamples\tdepth\tmedian_before\tmedian_after\ttime_ratio\tpeak_before\tpeak_after\tmemory_ratio"]
+    for result in current['results']:
+        before = previous_results.get(case_key(result))
+        if before is None:
+            continue
+        lines.append("%s\t%i\t%i\t%i\t%.4f\t%.4f\t%.2f\t%i\t%i\t%.2f" % (
+            case_key(result) + (before['median'], result['median'], result['median'] / before['median'] if before['median'] else float('nan'),
+                                before['peak_memory'], result['peak_memory'], result['peak_memory'] / float(before['peak_memory']) if before['peak_memory'] else float('nan'))))
+    return lines
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="covseq_bench_")
+    try:
+        results = run_benchmarks(args.benchmarks, QUICK_AXES if args.quick else AXES, args.repeat, args.seed, data_dir)
+    finally:
+        if not args.data_dir:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    output = {
+        'commit': git_commit(),
+        'date': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'seed': args.seed,
+        'results': results
+        }
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(output, outfile, indent=1)
+    else:
+        json.dump(output, sys.stdout, indent=1)
+        sys.stdout.write("\n")
+
+    if args.compare:
+        with open(args.compare, 'r') as infile:
+            sys.stderr.write("\n".join(compare_results(json.load(infile), output)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
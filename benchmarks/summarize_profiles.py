@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Summarizes the --profile records of the metrics scripts across a run.
+
+The JSON lines appended by check_variant_in_fa.py, ivar_variants_to_vcf.py and covid_collect_nanopore_metrics.py with
+--profile (see common/stage_profiler.py) are read, each record of a single sample and each sample of a batch record
+counting as one sample. Two tables are written:
+ - stages       = per tool and stage: number of samples, percentiles of the wall time, median CPU time and the median
+                  and maximum peak memory
+ - slowest      = the samples with the longest total wall time over their stages, along with their slowest stage
+
+Example: python benchmarks/summarize_profiles.py run_profile.jsonl --tool nanopore_metrics --top 20
+"""
+
+import sys
+import json
+import argparse
+
+DEFAULT_PERCENTILES = [50, 90, 95, 99]
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Summarizes the --profile records of the metrics scripts across a run."
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('profiles',
+                        help="JSON lines profile files.",
+                        nargs='+')
+
+    parser.add_argument('-t',
+                        '--tool',
+                        help="Only summarize the records of these tools (Default: all).",
+                        nargs='+',
+                        required=False)
+
+    parser.add_argument('-p',
+                        '--percentiles',
+                        help="Percentiles of the wall time reported for each stage (Default: 50 90 95 99).",
+                        nargs='+',
+                        type=float,
+                        default=DEFAULT_PERCENTILES)
+
+    parser.add_argument('-n',
+                        '--top',
+                        help="Number of slowest samples reported (Default: 10).",
+                        type=int,
+                        default=10)
+
+    parser.add_argument('-o',
+                        '--output',
+                        help="Summary file (Default: stdout).",
+                        type=argparse.FileType('w'),
+                        default='-')
+
+    return parser.parse_args()
+
+def read_records(profile_files):
+    """
+    Yields the records of the profile files, truncated lines of an interrupted run being skipped with a warning
+    """
+    for profile_file in profile_files:
+        with open(profile_file, 'r') as infile:
+            for number, line in enumerate(infile, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    sys.stderr.write("WARNING: invalid profile record skipped at %s line %i\n" % (profile_file, number))
+
+def sample_profiles(records, tools=None):
+    """
+    Returns the (tool, sample, stages) of each sample, the samples of batch records being listed one by one
+    The stages of a batch record that are not per sample (listing inputs, writing the combined output...) are left out
+    """
+    profiles = []
+    for record in records:
+        if tools and record.get('tool') not in tools:
+            continue
+        if isinstance(record.get('samples'), list):
+            profiles.extend((record['tool'], entry['sample'], entry['stages']) for entry in record['samples'])
+        else:
+            profiles.append((record.get('tool'), record.get('sample'), record.get('stages', [])))
+    return profiles
+
+def percentile(values, percent):
+    """
+    Returns the percentile of a list of values, interpolated between the closest ranks as numpy.percentile does
+    """
+    values = sorted(values)
+    rank = (len(values) - 1) * percent / 100.0
+    lower = int(rank)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (rank - lower)
+
+def stage_table(profiles, percentiles):
+    """
+    Returns the lines of the per tool and stage summary, stages being listed in the order they run
+    """
+    stages = {}
+    for tool, _, sample_stages in profiles:
+        for stage in sample_stages:
+            stages.setdefault((tool, stage['stage']), []).append(stage)
+    lines = ["\t".join(["tool", "stage", "samples"] + ["wall.p%g" % percent for percent in percentiles] +
+                       ["wall.max", "wall.total", "cpu.p50", "peak_memory.p50", "peak_memory.max"])]
+    for (tool, name), entries in stages.items():
+        walls = [entry['wall'] for entry in entries]
+        peaks = [entry['peak_memory'] for entry in entries]
+        lines.append("\t".join([str(tool), name, str(len(entries))] + ["%.4f" % percentile(walls, percent) for percent in percentiles] +
+                               ["%.4f" % max(walls), "%.4f" % sum(walls), "%.4f" % percentile([entry['cpu'] for entry in entries], 50),
+                                "%i" % percentile(peaks, 50), "%i" % max(peaks)]))
+    return lines
+
+def slowest_table(profiles, top):
+    """
+    Returns the lines of the top slowest samples by total stage wall time
+    """
+    totals = []
+    for tool, sample, sample_stages in profiles:
+        if not sample_stages:
+            continue
+        slowest = max(sample_stages, key=lambda stage: stage['wall'])
+        totals.append((sum(stage['wall'] for stage in sample_stages), tool, sample, slowest,
+                       max(stage['peak_memory'] for stage in sample_stages)))
+    totals.sort(key=lambda total: total[0], reverse=True)
+    lines = ["tool\tsample\twall\tslowest_stage\tslowest_stage.wall\tpeak_memory"]
+    for wall, tool, sample, slowest, peak in totals[:top]:
+        lines.append("%s\t%s\t%.4f\t%s\t%.4f\t%i" % (tool, sample, wall, slowest['stage'], slowest['wall'], peak))
+    return lines
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    profiles = sample_profiles(read_records(args.profiles), args.tool)
+    if not profiles:
+        sys.stderr.write("WARNING: no profile record found\n")
+    args.output.write("# Stages\n")
+    args.output.write("\n".join(stage_table(profiles, args.percentiles)) + "\n")
+    args.output.write("\n# Slowest samples\n")
+    args.output.write("\n".join(slowest_table(profiles, args.top)) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+
+"""
+Deterministic synthetic SARS-CoV-2 data used by the benchmarks.
+
+For a given seed, generates a 29,903 bp MN908947.3-like reference and, for each sample of a run, a consensus carrying
+SNPs, insertions, deletions and N-runs along with the matching iVar variants tsv and vcf, an ARTIC-style coverage
+pickle and a fastq.stats file. SNPs under 0.75 frequency are reported but left out of the consensus, as iVar does.
+A manifest.tsv listing the nanopore inputs of each sample and an ARTIC-style primer.bed of the amplicon tiling are
+written in the run directory.
+"""
+
+import os
+import math
+import random
+import pickle
+import argparse
+
+GENOME_SIZE = 29903
+CHR_NAME = "MN908947.3"
+GC_CONTENT = 0.38
+AMPLICON_SIZE = 400
+PRIMER_SIZE = 25
+CONSENSUS_MIN_FREQ = 0.75
+
+IVAR_HEADER = "REGION\tPOS\tREF\tALT\tREF_DP\tREF_RV\tREF_QUAL\tALT_DP\tALT_RV\tALT_QUAL\tALT_FREQ\tTOTAL_DP\tPVAL\tPASS\tGFF_FEATURE\tREF_CODON\tREF_AA\tALT_CODON\tALT_AA"
+VCF_HEADER = ('##fileformat=VCFv4.2\n'
+              '##source=iVar\n'
+              '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n'
+              '##FILTER=<ID=PASS,Description="Result of p-value <= 0.05">\n'
+              '##FILTER=<ID=FAIL,Description="Result of p-value > 0.05">\n'
+              '##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n'
+              '##FORMAT=<ID=ref_DP,Number=1,Type=Integer,Description="Depth of reference base">\n'
+              '##FORMAT=<ID=ref_RV,Number=1,Type=Integer,Description="Depth of reference base on reverse reads">\n'
+              '##FORMAT=<ID=ref_QUAL,Number=1,Type=Integer,Description="Mean quality of reference base">\n'
+              '##FORMAT=<ID=alt_DP,Number=1,Type=Integer,Description="Depth of alternate base">\n'
+              '##FORMAT=<ID=alt_RV,Number=1,Type=Integer,Description="Deapth of alternate base on reverse reads">\n'
+              '##FORMAT=<ID=alt_QUAL,Number=1,Type=String,Description="Mean quality of alternate base">\n'
+              '##FORMAT=<ID=alt_FREQ,Number=1,Type=String,Description="Frequency of alternate base">\n'
+              '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t{sample}\n')
+VCF_FORMAT = 'GT:ref_DP:ref_RV:ref_QUAL:alt_DP:alt_RV:alt_QUAL:alt_FREQ'
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Generates a deterministic synthetic SARS-CoV-2 run."
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-o',
+                        '--output_dir',
+                        help="Run directory.",
+                        required=True)
+
+    parser.add_argument('-n',
+                        '--samples',
+                        help="Number of samples (Default: 4).",
+                        type=int,
+                        default=4)
+
+    parser.add_argument('-v',
+                        '--variants',
+                        help="Number of variants per sample (Default: 100).",
+                        type=int,
+                        default=100)
+
+    parser.add_argument('-d',
+                        '--depth',
+                        help="Mean coverage depth (Default: 1000).",
+                        type=int,
+                        default=1000)
+
+    parser.add_argument('-s',
+                        '--seed',
+                        help="Random seed (Default: 0).",
+                        type=int,
+                        default=0)
+
+    return parser.parse_args()
+
+def reference_sequence(seed=0):
+    """
+    Returns a random MN908947.3-like reference sequence of GENOME_SIZE bases
+    """
+    rng = random.Random(seed)
+    at = (1 - GC_CONTENT) / 2
+    gc = GC_CONTENT / 2
+    return "".join(rng.choices("ACGT", weights=[at, gc, gc, at], k=GENOME_SIZE))
+
+def write_fasta(path, name, sequence, width=60):
+    with open(path, 'w') as outfile:
+        outfile.write(">%s\n" % name)
+        outfile.writelines(sequence[start:start + width] + "\n" for start in range(0, len(sequence), width))
+
+def masked_regions(rng, n_runs, max_length=300):
+    """
+    Returns the 0-based (start, end) of the N-runs of a consensus, away from the genome ends
+    """
+    regions = []
+    for _ in range(n_runs):
+        length = rng.randint(20, max_length)
+        start = rng.randint(100, GENOME_SIZE - length - 100)
+        regions.append((start, start + length))
+    return sorted(regions)
+
+def simulate_variants(reference, n_variants, depth, rng, masked):
+    """
+    Returns the variants of a sample as dicts with the 1-based iVar position, REF, iVar ALT (+ins / -del) and depths
+    Variants are at least 12 bp apart and outside of the N-runs
+    """
+    blocked = bytearray(GENOME_SIZE)
+    for start, end in masked:
+        blocked[max(0, start - 12):end + 12] = b"\1" * (min(GENOME_SIZE, end + 12) - max(0, start - 12))
+    candidates = [position for position in range(50, GENOME_SIZE - 50, 12) if not blocked[position]]
+    positions = sorted(rng.sample(candidates, min(n_variants, len(candidates))))
+    variants = []
+    for position in positions:
+        ref = reference[position]
+        kind = rng.random()
+        if kind < 0.7:
+            alt = rng.choice([base for base in "ACGT" if base != ref])
+        elif kind < 0.85:
+            alt = "+" + "".join(rng.choice("ACGT") for _ in range(rng.randint(1, 6)))
+        else:
+            alt = "-" + reference[position + 1:position + 1 + rng.randint(1, 9)]
+        total_dp = max(10, int(rng.gauss(depth, depth / 5.0)))
+        # Low frequency variants are SNPs only, the indels of the vcf being expected in the consensus by check_variant_in_fa
+        if len(alt) == 1:
+            freq = rng.choice([rng.uniform(0.05, 0.5), rng.uniform(0.75, 1.0), rng.uniform(0.9, 1.0)])
+        else:
+            freq = rng.uniform(0.75, 1.0)
+        alt_dp = max(1, int(total_dp * freq))
+        variants.append({
+            'pos': position + 1, 'ref': ref, 'alt': alt, 'freq': round(freq, 4), 'alt_dp': alt_dp, 'ref_dp': total_dp - alt_dp,
+            'total_dp': total_dp, 'pass': "TRUE" if rng.random() < 0.9 else "FALSE"
+            })
+    return variants
+
+def consensus_sequence(reference, variants, masked):
+    """
+    Returns the consensus carrying the variants above CONSENSUS_MIN_FREQ, the N-runs being masked
+    """
+    sequence = list(reference)
+    for start, end in masked:
+        sequence[start:end] = ["N"] * (end - start)
+    for variant in reversed(variants):
+        if variant['freq'] < CONSENSUS_MIN_FREQ:
+            continue
+        index = variant['pos'] - 1
+        if variant['alt'].startswith("+"):
+            sequence[index + 1:index + 1] = list(variant['alt'][1:])
+        elif variant['alt'].startswith("-"):
+            del sequence[index + 1:index + len(variant['alt'])]
+        else:
+            sequence[index] = variant['alt']
+    return "".join(sequence)
+
+def write_ivar_tsv(path, variants):
+    with open(path, 'w') as outfile:
+        outfile.write(IVAR_HEADER + "\n")
+        for variant in variants:
+            outfile.write("%s\t%i\t%s\t%s\t%i\t%i\t35\t%i\t%i\t37\t%s\t%i\t0\t%s\tNA\tNA\tNA\tNA\tNA\n" % (
+                CHR_NAME, variant['pos'], variant['ref'], variant['alt'], variant['ref_dp'], variant['ref_dp'] // 2,
+                variant['alt_dp'], variant['alt_dp'] // 2, variant['freq'], variant['total_dp'], variant['pass']))
+
+def write_vcf(path, sample, variants):
+    """
+    Writes the vcf ivar_variants_to_vcf.py gives for the variants
+    """
+    with open(path, 'w') as outfile:
+        outfile.write(VCF_HEADER.format(sample=sample))
+        for variant in variants:
+            ref, alt = variant['ref'], variant['alt']
+            if alt.startswith("+"):
+                alt = ref + alt[1:]
+            elif alt.startswith("-"):
+                ref, alt = ref + alt[1:], ref
+            sample_values = ":".join(str(value) for value in (1, variant['ref_dp'], variant['ref_dp'] // 2, 35, variant['alt_dp'], variant['alt_dp'] // 2, 37, variant['freq']))
+            outfile.write("\t".join((CHR_NAME, str(variant['pos']), ".", ref, alt, ".", "PASS" if variant['pass'] == "TRUE" else "FAIL",
+                                     "DP=%i" % variant['total_dp'], VCF_FORMAT, sample_values)) + "\n")
+
+def coverage_depths(depth, rng, masked):
+    """
+    Returns the per-position depth of a tiled amplicon run: each amplicon gets a log-normal share of the mean depth,
+    amplicons overlapping an N-run drop out
+    """
+    depths = []
+    for start in range(0, GENOME_SIZE, AMPLICON_SIZE):
+        amplicon_depth = int(depth * math.exp(rng.gauss(0, 0.6)))
+        if any(start < end and masked_start < start + AMPLICON_SIZE for masked_start, end in masked):
+            amplicon_depth = rng.randint(0, 9)
+        depths.extend(max(0, amplicon_depth + rng.randint(-5, 5)) for _ in range(min(AMPLICON_SIZE, GENOME_SIZE - start)))
+    return depths
+
+def write_coverage_pickle(path, depths, mapped):
+    """
+    Writes an ARTIC-style bam stats pickle, the positions at zero depth being left out of the pileup
+    """
+    coverage = dict((position, depth) for position, depth in enumerate(depths) if depth > 0)
+    with open(path, 'wb') as outfile:
+        pickle.dump({'read_stats': {'mapped': mapped}, 'pileup_stats': {'coverage': {CHR_NAME: coverage}}}, outfile)
+
+def write_fastq_stats(path, raw_reads, pass_reads):
+    with open(path, 'w') as outfile:
+        outfile.write("raw_reads %i\npass_reads %i\n" % (raw_reads, pass_reads))
+
+def write_primer_bed(path):
+    """
+    Writes the ARTIC-style primer scheme of the amplicon tiling, the primers being at both ends of each amplicon
+    """
+    with open(path, 'w') as outfile:
+        for index, start in enumerate(range(0, GENOME_SIZE, AMPLICON_SIZE), 1):
+            end = min(start + AMPLICON_SIZE, GENOME_SIZE)
+            pool = "nCoV-2019_%i" % (2 - index % 2)
+            outfile.write("%s\t%i\t%i\tSYN_%i_LEFT\t%s\t+\n" % (CHR_NAME, start, start + PRIMER_SIZE, index, pool))
+            outfile.write("%s\t%i\t%i\tSYN_%i_RIGHT\t%s\t-\n" % (CHR_NAME, end - PRIMER_SIZE, end, index, pool))
+
+def generate_run(output_dir, n_samples=4, n_variants=100, depth=1000, seed=0):
+    """
+    Writes a synthetic run in output_dir and returns the reference path and a dict of the files of each sample
+    """
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    reference = reference_sequence(seed)
+    reference_file = os.path.join(output_dir, "reference.fasta")
+    write_fasta(reference_file, CHR_NAME, reference)
+    write_primer_bed(os.path.join(output_dir, "primer.bed"))
+
+    samples = []
+    for index in range(n_samples):
+        rng = random.Random("%i-%i" % (seed, index))
+        sample = "SYN%04i" % index
+        prefix = os.path.join(output_dir, sample)
+        masked = masked_regions(rng, rng.randint(0, 3))
+        variants = simulate_variants(reference, n_variants, depth, rng, masked)
+        files = {
+            'sample': sample,
+            'consensus': prefix + ".consensus.fasta",
+            'ivar_tsv': prefix + ".variants.tsv",
+            'vcf': prefix + ".variants.vcf",
+            'pickle': prefix + ".bam.pickle",
+            'fq_stats': prefix + ".fastq.stats"
+            }
+        write_fasta(files['consensus'], sample, consensus_sequence(reference, variants, masked))
+        write_ivar_tsv(files['ivar_tsv'], variants)
+        write_vcf(files['vcf'], sample, variants)
+        depths = coverage_depths(depth, rng, masked)
+        # ~300 bp reads, 90% passing size selection and 95% of those mapping
+        raw_reads = max(1, sum(depths) // 300 * 100 // 90 * 100 // 95)
+        pass_reads = raw_reads * 90 // 100
+        write_coverage_pickle(files['pickle'], depths, pass_reads * 95 // 100)
+        write_fastq_stats(files['fq_stats'], raw_reads, pass_reads)
+        samples.append(files)
+
+    with open(os.path.join(output_dir, "manifest.tsv"), 'w') as manifest:
+        manifest.write("sample\tconsensus\tfq_stats\tpickle\n")
+        manifest.writelines("%s\t%s\t%s\t%s\n" % (files['sample'], files['consensus'], files['fq_stats'], files['pickle']) for files in samples)
+    return reference_file, samples
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    generate_run(args.output_dir, args.samples, args.variants, args.depth, args.seed)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""
+Amplicon-level coverage and dropout metrics shared by the illumina and nanopore metrics collectors.
+
+The amplicons are read from a primer scheme BED, either an ARTIC primer BED (<SCHEME>_<N>_LEFT/RIGHT primers, with
+optional _alt or, as in ARTIC V4.1+ and primalscheme, _<n> primer suffixes) where the amplicon is the insert between the
+innermost LEFT and RIGHT primer ends, or a BED of the amplicon regions themselves (one named line per amplicon, as the
+ncov-tools amplicon_bed). A BED mixing primer and region names is rejected.
+From the per-position depth of a sample, the mean depth of every amplicon is taken from one prefix sum of the depths and
+the median from one padded matrix of the amplicon depths. An amplicon is a dropout when its mean depth is under the
+dropout depth. The matrices of a run (one row per sample, one column per amplicon) are written as tsv:
+ - amplicon_mean_depth.tsv      = mean depth of each amplicon
+ - amplicon_median_depth.tsv    = median depth of each amplicon
+ - amplicon_dropouts.tsv        = number of dropouts of the sample followed by a 0/1 dropout flag for each amplicon
+"""
+
+import os
+import re
+import sys
+
+import numpy as np
+
+DEFAULT_DROPOUT_DEPTH = 20
+PRIMER_NAME = re.compile(r"^(.+)_(LEFT|RIGHT)(_alt\d*|_\d+)?$")
+MATRIX_FILES = {
+    'mean': "amplicon_mean_depth.tsv",
+    'median': "amplicon_median_depth.tsv",
+    'dropouts': "amplicon_dropouts.tsv"
+    }
+
+def read_amplicons(bed_file):
+    """
+    Returns the (name, start, end) of the amplicons of a primer scheme or amplicon regions BED, 0-based end excluded, sorted by start
+    Raises ValueError when only some of the names are primer names
+    """
+    regions = []
+    with open(bed_file, 'r') as infile:
+        for line in infile:
+            fields = line.rstrip("\r\n").split("\t")
+            if len(fields) < 4 or line.startswith(("#", "track", "browser")):
+                continue
+            regions.append((fields[3], int(fields[1]), int(fields[2])))
+
+    primers = [(PRIMER_NAME.match(name), start, end) for name, start, end in regions]
+    if not any(match for match, _, _ in primers):
+        return sorted(regions, key=lambda region: (region[1], region[2]))
+    others = [name for (match, _, _), (name, _, _) in zip(primers, regions) if not match]
+    if others:
+        raise ValueError("%s mixes primer names (<SCHEME>_<N>_LEFT/RIGHT) and amplicon region names (%s)" % (bed_file, ", ".join(others[:5])))
+    lefts = {}
+    rights = {}
+    for match, start, end in primers:
+        if match.group(2) == 'LEFT':
+            lefts[match.group(1)] = max(lefts.get(match.group(1), end), end)
+        else:
+            rights[match.group(1)] = min(rights.get(match.group(1), start), start)
+    unpaired = sorted(set(lefts) ^ set(rights))
+    if unpaired:
+        sys.stderr.write("WARNING: amplicons without both a LEFT and a RIGHT primer left out of %s: %s\n" % (bed_file, ", ".join(unpaired)))
+    amplicons = [(name, lefts[name], rights[name]) for name in lefts if name in rights]
+    return sorted(amplicons, key=lambda amplicon: (amplicon[1], amplicon[2]))
+
+def bedgraph_depth(bedgraph_file, genome_size):
+    """
+    Returns the per-position depth of a BedGraph as a NumPy array of genome_size positions, uncovered positions being at 0
+    """
+    starts, ends, depths = [], [], []
+    with open(bedgraph_file, 'r') as infile:
+        for line in infile:
+            fields = line.split()
+            if len(fields) >= 4 and not line.startswith(("track", "browser", "#")):
+                starts.append(int(float(fields[1])))
+                ends.append(int(float(fields[2])))
+                depths.append(float(fields[3]))
+    depth_diff = np.zeros(genome_size + 1, dtype=np.float64)
+    np.add.at(depth_diff, np.clip(starts, 0, genome_size), depths)
+    np.subtract.at(depth_diff, np.clip(ends, 0, genome_size), depths)
+    return np.cumsum(depth_diff[:genome_size])
+
+def amplicon_depths(genome_depth, amplicons):
+    """
+    Returns the mean and median depth of each amplicon as two NumPy arrays, amplicons past the end of genome_depth being clipped
+    """
+    genome_depth = np.asarray(genome_depth, dtype=np.float64)
+    starts = np.clip(np.array([start for _, start, _ in amplicons], dtype=np.int64), 0, len(genome_depth))
+    ends = np.clip(np.array([end for _, _, end in amplicons], dtype=np.int64), 0, len(genome_depth))
+    lengths = np.maximum(ends - starts, 0)
+    prefix = np.concatenate(([0.0], np.cumsum(genome_depth)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = (prefix[ends] - prefix[np.minimum(starts, ends)]) / lengths
+    # Amplicons are padded with NaN to the longest one, so all the medians are taken at once
+    offsets = np.arange(int(lengths.max()) if len(lengths) else 0)
+    padded = genome_depth[np.minimum(starts[:, None] + offsets, max(len(genome_depth) - 1, 0))] if len(genome_depth) else np.zeros((len(amplicons), 0))
+    padded = np.where(offsets < lengths[:, None], padded, np.nan)
+    medians = np.full(len(amplicons), np.nan)
+    covered = lengths > 0
+    if covered.any():
+        medians[covered] = np.nanmedian(padded[covered], axis=1)
+    return means, medians
+
+def dropouts(means, dropout_depth=DEFAULT_DROPOUT_DEPTH):
+    """
+    Returns the dropout flag of each amplicon, an amplicon without any position in the genome being a dropout
+    """
+    return ~(np.nan_to_num(means, nan=0.0) >= dropout_depth)
+
+def format_depth(value):
+    return "NA" if np.isnan(value) else "%.2f" % value
+
+def write_amplicon_matrices(output_dir, amplicons, samples, dropout_depth=DEFAULT_DROPOUT_DEPTH):
+    """
+    Writes the mean depth, median depth and dropout samples x amplicons matrices of a run in output_dir
+    samples is a list of (sample, means, medians), the means and medians being in the order of amplicons
+    """
+    if output_dir and not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+    names = [name for name, _, _ in amplicons]
+    with open(os.path.join(output_dir, MATRIX_FILES['mean']), 'w') as mean_file, \
+         open(os.path.join(output_dir, MATRIX_FILES['median']), 'w') as median_file, \
+         open(os.path.join(output_dir, MATRIX_FILES['dropouts']), 'w') as dropout_file:
+        mean_file.write("\t".join(["sample"] + names) + "\n")
+        median_file.write("\t".join(["sample"] + names) + "\n")
+        dropout_file.write("\t".join(["sample", "dropouts"] + names) + "\n")
+        for sample, means, medians in samples:
+            means = np.asarray(means, dtype=np.float64)
+            flags = dropouts(means, dropout_depth)
+            mean_file.write("\t".join([sample] + [format_depth(value) for value in means]) + "\n")
+            median_file.write("\t".join([sample] + [format_depth(value) for value in np.asarray(medians, dtype=np.float64)]) + "\n")
+            dropout_file.write("\t".join([sample, str(int(flags.sum()))] + [str(int(flag)) for flag in flags]) + "\n")
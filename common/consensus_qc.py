@@ -0,0 +1,122 @@
+"""
+Consensus FASTA QC shared by the illumina and nanopore metrics collectors, in place of QUAST and Biopython.
+
+Each consensus file is memory-mapped and its records are located from the '>' at the start of a line, the bases of all
+the records being counted at once with one byte histogram (NumPy bincount) per record. From the histograms are derived:
+ - length               = total length of the records
+ - acgt                 = A, C, G and T bases, any case
+ - n_count              = N bases, any case
+ - ambiguous            = IUPAC ambiguity codes other than N (R, Y, S, W, K, M, B, D, H, V), any case
+ - quast_n              = bases other than A, C, G and T, QUAST replacing them all with N
+ - gc_percent           = percent of G and C among the A, C, G and T bases, as QUAST "GC (%)"
+ - n_per_100kbp         = quast_n per 100 kbp, as QUAST "# N's per 100 kbp"
+ - genome_fraction      = percent of the reference length covered by bases other than N, approximating the QUAST "Genome
+                          fraction (%)" without aligning the consensus to the reference
+ - n_runs, longest_n_run = number and longest of the runs of consecutive N bases, runs not spanning records
+As with QUAST, the records shorter than min_contig are only counted in the length and the raw byte histogram.
+"""
+
+import os
+import mmap
+
+import numpy as np
+
+QUAST_MIN_CONTIG = 500
+WHITESPACE = b" \t\r\n\x0b\x0c"
+IUPAC_AMBIGUOUS = b"RYSWKMBDHV"
+
+# Bytes kept in the sequences, whitespace being dropped
+_KEEP = np.ones(256, dtype=bool)
+_KEEP[list(WHITESPACE)] = False
+
+def _case_insensitive(bases):
+    return sorted(set(bases.upper() + bases.lower()))
+
+def parse_records(data):
+    """
+    Returns the (name, sequence) records of the bytes of a fasta file as a uint8 NumPy array, sequences being copies without whitespace
+    """
+    newlines = np.flatnonzero(data == ord("\n"))
+    headers = np.flatnonzero(data == ord(">"))
+    headers = headers[(headers == 0) | (data[np.maximum(headers - 1, 0)] == ord("\n"))]
+    header_ends = np.append(newlines, len(data))[np.searchsorted(newlines, headers)]
+    records = []
+    for header, header_end, next_header in zip(headers, header_ends, np.append(headers[1:], len(data))):
+        name = data[header + 1:header_end].tobytes().decode().strip()
+        sequence = data[min(header_end + 1, next_header):next_header]
+        records.append((name, sequence[_KEEP[sequence]]))
+    return records
+
+def read_records(fasta_file):
+    """
+    Returns the (name, sequence) records of a fasta file, each sequence being a uint8 NumPy array without whitespace
+    The file is memory-mapped, lines before the first header are ignored
+    """
+    with open(fasta_file, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            # The records are copies, so no view on the mapping outlives parse_records() and the mapping can be closed
+            return parse_records(np.frombuffer(mapped, dtype=np.uint8))
+
+def n_runs(sequence):
+    """
+    Returns the lengths of the runs of consecutive N (or n) bases of a sequence
+    """
+    mask = (sequence == ord("N")) | (sequence == ord("n"))
+    if not mask.any():
+        return np.zeros(0, dtype=np.int64)
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    return np.flatnonzero(edges == -1) - np.flatnonzero(edges == 1)
+
+def count_bases(counts, bases):
+    """
+    Returns the number of bytes of a histogram that are any of the given bases, any case
+    """
+    return int(counts[_case_insensitive(bases)].sum())
+
+def consensus_qc(fasta_file, reference_length=None, min_contig=QUAST_MIN_CONTIG):
+    """
+    Returns the QC statistics of a single- or multi-record consensus fasta as a dict, undefined values being None
+    The 'counts' entry is the byte histogram of all the records, for statistics defined differently by the callers
+    """
+    records = read_records(fasta_file)
+    counts = np.zeros(256, dtype=np.int64)
+    kept = np.zeros(256, dtype=np.int64)
+    runs = []
+    for _, sequence in records:
+        histogram = np.bincount(sequence, minlength=256)
+        counts += histogram
+        if len(sequence) >= min_contig:
+            kept += histogram
+        runs.append(n_runs(sequence))
+    runs = np.concatenate(runs) if runs else np.zeros(0, dtype=np.int64)
+
+    length = int(counts.sum())
+    kept_length = int(kept.sum())
+    kept_acgt = count_bases(kept, b"ACGT")
+    kept_quast_n = kept_length - kept_acgt
+    stats = {
+        'file': fasta_file,
+        'records': len(records),
+        'length': length,
+        'acgt': count_bases(counts, b"ACGT"),
+        'n_count': count_bases(counts, b"N"),
+        'ambiguous': count_bases(counts, IUPAC_AMBIGUOUS),
+        'quast_n': length - count_bases(counts, b"ACGT"),
+        'gc_percent': 100.0 * count_bases(kept, b"GC") / kept_acgt if kept_acgt else None,
+        'n_per_100kbp': kept_quast_n * 100000.0 / kept_length if kept_length else None,
+        'genome_fraction': None,
+        'n_runs': len(runs),
+        'longest_n_run': int(runs.max()) if len(runs) else 0,
+        'counts': counts
+        }
+    if reference_length:
+        stats['genome_fraction'] = 100.0 * min(kept_length - count_bases(kept, b"N"), reference_length) / reference_length
+    return stats
+
+def run_consensus_qc(fasta_files, reference_length=None, min_contig=QUAST_MIN_CONTIG):
+    """
+    Returns the QC statistics of every consensus of a run, None for the files that don't exist
+    """
+    return [consensus_qc(fasta_file, reference_length, min_contig) if fasta_file and os.path.isfile(fasta_file) else None for fasta_file in fasta_files]
@@ -0,0 +1,119 @@
+"""
+Persistent per-sample metrics cache shared by the illumina and nanopore metrics collectors.
+
+Each entry holds the metrics computed for one sample along with the fingerprint of the input artifacts they were
+computed from (path, size and mtime of each file, optionally its content hash, plus the collector parameters).
+On re-collection, a sample is only recomputed when its fingerprint changed, the other rows are served from the cache.
+The cache is a single SQLite file, only accessed from the main process.
+"""
+
+import os
+import json
+import time
+import hashlib
+import sqlite3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    namespace TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    metrics TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (namespace, sample)
+)
+"""
+
+def file_digest(path, block_size=1 << 20):
+    """
+    Returns the sha1 of the content of a file
+    """
+    digest = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def fingerprint(paths, params=None, content_hash=False):
+    """
+    Returns the fingerprint of a set of input files and collector parameters
+    Missing files are part of the fingerprint, so a file appearing later invalidates the entry
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode())
+    for path in sorted(set(os.path.abspath(path) for path in paths if path)):
+        try:
+            stat = os.stat(path)
+            digest.update(("%s\t%i\t%i\n" % (path, stat.st_size, stat.st_mtime_ns)).encode())
+            if content_hash:
+                digest.update(file_digest(path).encode())
+        except OSError:
+            digest.update(("%s\tmissing\n" % path).encode())
+    return digest.hexdigest()
+
+class MetricsCache(object):
+    """
+    SQLite backed cache of per-sample metrics, entries of each collector being kept in their own namespace
+    With force, every lookup misses so all the samples are recomputed and their entries refreshed
+    """
+    def __init__(self, db_path, namespace, content_hash=False, force=False):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.execute(SCHEMA)
+        self.namespace = namespace
+        self.content_hash = content_hash
+        self.force = force
+        self.hits = 0
+        self.misses = 0
+
+    def fingerprint(self, paths, params=None):
+        """
+        Returns the fingerprint of the inputs of a sample, hashing their content if the cache was opened with content_hash
+        """
+        return fingerprint(paths, params, self.content_hash)
+
+    def get(self, sample, sample_fingerprint):
+        """
+        Returns the cached metrics of a sample if they were computed from the same inputs, None otherwise
+        """
+        if self.force:
+            self.misses += 1
+            return None
+        row = self.connection.execute("SELECT fingerprint, metrics FROM metrics WHERE namespace = ? AND sample = ?", (self.namespace, sample)).fetchone()
+        if row is not None and row[0] == sample_fingerprint:
+            self.hits += 1
+            return json.loads(row[1])
+        self.misses += 1
+        return None
+
+    def put(self, sample, sample_fingerprint, metrics):
+        """
+        Stores the metrics of a sample, NumPy scalars being stored as their Python value
+        Each entry is committed as it is stored, so a killed collection keeps the samples it already computed
+        """
+        with self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO metrics VALUES (?, ?, ?, ?, ?)",
+                                    (self.namespace, sample, sample_fingerprint, json.dumps(metrics, default=lambda value: value.item()), time.time()))
+
+    def invalidate(self, samples=None):
+        """
+        Drops the cached metrics of the given samples, or of all the samples of the namespace, returns the number of entries dropped
+        """
+        if samples is None:
+            cursor = self.connection.execute("DELETE FROM metrics WHERE namespace = ?", (self.namespace,))
+        else:
+            cursor = self.connection.executemany("DELETE FROM metrics WHERE namespace = ? AND sample = ?", [(self.namespace, sample) for sample in samples])
+        self.connection.commit()
+        return cursor.rowcount
+
+    def stats(self):
+        """
+        Returns the hit/miss summary line of the cache
+        """
+        total = self.hits + self.misses
+        return "Metrics cache: %i hits, %i misses (%.1f%% hit rate)" % (self.hits, self.misses, 100.0 * self.hits / total if total else 0.0)
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
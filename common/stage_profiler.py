@@ -0,0 +1,102 @@
+"""
+Opt-in stage timing of the metrics scripts (--profile).
+
+A script run is split in named stages ("load consensus", "read VCF", "write output", ...). For each stage, the wall
+time, the CPU time of the process and the peak memory allocated while it ran (traced with tracemalloc, so NumPy arrays
+are included) are recorded. At the end of the run, one JSON line is appended to the profile file, so all the runs of a
+pipeline can share one file, see benchmarks/summarize_profiles.py to summarize it.
+A profiler created without a profile file does nothing, so the scripts can always go through their stages.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import resource
+import contextlib
+import tracemalloc
+
+# Stages being recorded in this process, outermost first
+_OPEN_STAGES = []
+
+def _update_open_stages(peak):
+    for stage in _OPEN_STAGES:
+        stage['peak_memory'] = max(stage['peak_memory'], peak)
+
+class StageProfiler(object):
+    """
+    Records the wall time, CPU time and peak traced memory of the named stages of a script run
+    """
+    def __init__(self, profile_file=None, tool=None, sample=None, enabled=None):
+        self.profile_file = profile_file
+        self.tool = tool
+        self.sample = sample
+        self.enabled = profile_file is not None if enabled is None else enabled
+        self.stages = []
+        self.extra = {}
+        self.start_time = time.time()
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        # Memory allocated before tracing started is not seen, so tracing starts as early as possible
+        if self.enabled and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Context manager recording one stage, stages with the same name are recorded separately
+        Stages can be nested, the peak memory of an inner stage counting in the peak of the stages around it
+        """
+        if not self.enabled:
+            yield
+            return
+        # tracemalloc has a single peak, the peak reached so far is handed over to the enclosing stages before resetting it
+        _update_open_stages(tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        current = {'stage': name, 'wall': 0.0, 'cpu': 0.0, 'peak_memory': 0, 'start_memory': tracemalloc.get_traced_memory()[0]}
+        _OPEN_STAGES.append(current)
+        start_wall = time.perf_counter()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            current['wall'] = time.perf_counter() - start_wall
+            current['cpu'] = time.process_time() - start_cpu
+            _OPEN_STAGES.remove(current)
+            current['peak_memory'] = max(current['peak_memory'], tracemalloc.get_traced_memory()[1])
+            _update_open_stages(current['peak_memory'])
+            self.stages.append(current)
+
+    def record(self):
+        """
+        Returns the profile record of the run so far
+        """
+        record = {
+            'tool': self.tool,
+            'sample': self.sample,
+            'time': time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time)),
+            'host': socket.gethostname(),
+            'pid': os.getpid(),
+            'argv': sys.argv,
+            'wall': time.perf_counter() - self.start_wall,
+            'cpu': time.process_time() - self.start_cpu,
+            # ru_maxrss is in KiB on Linux
+            'max_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            'stages': self.stages
+            }
+        record.update(self.extra)
+        return record
+
+    def write(self):
+        """
+        Appends the record of the run to the profile file as one JSON line
+        """
+        if not self.enabled or self.profile_file is None:
+            return
+        directory = os.path.dirname(self.profile_file)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        # One write of one line, so runs appending to the same file concurrently don't interleave their records
+        with open(self.profile_file, 'a') as outfile:
+            outfile.write(json.dumps(self.record(), default=str) + "\n")
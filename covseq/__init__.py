@@ -0,0 +1,3 @@
+"""
+Single covseq entry point for the CoVSeQ tools, see covseq/cli.py.
+"""
@@ -0,0 +1,3 @@
+from covseq.cli import main
+
+main()
@@ -0,0 +1,217 @@
+"""
+Single covseq entry point running the metrics and variant tools as subcommands.
+
+    covseq <COMMAND> [ARGS...]      runs one tool, ARGS being the arguments of its script (covseq <COMMAND> --help)
+    covseq worker [--jobs FILE]     runs a stream of jobs in this process, one per line of stdin (or FILE)
+
+Only the standard library is imported until a tool is run, the module of a tool (and the numpy/pandas it needs) being
+imported on its first run, so "covseq --help" or a worker waiting for its first job start fast. In worker mode, the
+tools stay imported from one job to the next, so a workflow step can push hundreds of samples through one process
+instead of paying for the interpreter startup and the imports of every sample.
+
+A job line is either the arguments of one covseq command, shell quoted:
+    nanopore_metrics -s S1 -c S1.consensus.fasta -fqs S1.fastq.stats -pk S1.pickle -o S1.metrics.csv
+or a JSON object with the command, its arguments and optionally the directory it runs from:
+    {"command": "check_variants", "args": ["-c", "S1.fa", "-v", "S1.vcf", "-r", "ref.fa"], "cwd": "run/S1"}
+Empty lines and lines starting with '#' are skipped. The tools write their outputs as they do as scripts, the status
+of each job is written on stderr (and in --status) and a failed job doesn't stop the worker unless --stop_on_error.
+Jobs can't read stdin, which holds the job stream (ivar_variants_to_vcf streaming mode).
+"""
+
+import os
+import sys
+import json
+import time
+import shlex
+import argparse
+import importlib
+import traceback
+import tracemalloc
+
+# Command: (directory of the tool, module of the tool, description)
+COMMANDS = {
+    'nanopore_metrics': ("nanopore_metrics", "covid_collect_nanopore_metrics", "Collects the metrics of nanopore samples."),
+    'check_variants': ("illumina_metrics", "check_variant_in_fa", "Checks that the variants of samples are found in their consensus."),
+    'ivar_variants_to_vcf': ("illumina_metrics", "ivar_variants_to_vcf", "Converts iVar variants tsv files to vcf."),
+    'variant_db': ("illumina_metrics", "variant_db", "Loads and queries the cross-run variant database.")
+    }
+TOOL_DIRS = ["common", "illumina_metrics", "nanopore_metrics"]
+
+def tools_root():
+    """
+    Returns the directory holding the tool directories, the covseq package when installed and the repository in a checkout
+    """
+    package_dir = os.path.dirname(os.path.realpath(__file__))
+    if os.path.isdir(os.path.join(package_dir, "common")):
+        return package_dir
+    return os.path.join(package_dir, os.pardir)
+
+def add_tool_paths():
+    """
+    Makes the tool modules importable, as they import each other as top-level modules
+    """
+    root = tools_root()
+    for directory in TOOL_DIRS:
+        path = os.path.join(root, directory)
+        if path not in sys.path:
+            sys.path.insert(0, path)
+
+def load_tool(command):
+    """
+    Returns the module of the tool of a command, imported on first use
+    """
+    add_tool_paths()
+    return importlib.import_module(COMMANDS[command][1])
+
+def exit_status(code):
+    """
+    Returns the process exit status of a SystemExit code, as the interpreter would
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    sys.stderr.write("%s\n" % code)
+    return 1
+
+def run_tool(command, args):
+    """
+    Runs the main() of a tool with the given arguments and returns its exit status
+    sys.argv is set for the run, so usage messages and --profile records show the covseq command line
+    """
+    module = load_tool(command)
+    argv = sys.argv
+    was_tracing = tracemalloc.is_tracing()
+    sys.argv = ["covseq " + command] + list(args)
+    try:
+        return exit_status(module.main())
+    except SystemExit as exit:
+        return exit_status(exit.code)
+    finally:
+        sys.argv = argv
+        # A --profile run starts tracemalloc, which would slow down the next jobs of a worker
+        if not was_tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        sys.stdout.flush()
+
+def parse_job(line):
+    """
+    Returns the (command, args, cwd) of a job line, a shell quoted command line or a JSON object
+    """
+    if line.startswith("{"):
+        job = json.loads(line)
+        return job['command'], [str(arg) for arg in job.get('args', [])], job.get('cwd')
+    fields = shlex.split(line)
+    return fields[0], fields[1:], None
+
+def read_jobs(infile):
+    """
+    Yields the (line number, line) of the jobs of a job stream, as they come
+    """
+    for number, line in enumerate(infile, 1):
+        line = line.strip()
+        if line and not line.startswith("#"):
+            yield number, line
+
+def run_job(line):
+    """
+    Runs one job line and returns its command and exit status, errors of the job being written on stderr
+    """
+    command = None
+    cwd = os.getcwd()
+    try:
+        command, args, job_cwd = parse_job(line)
+        if command not in COMMANDS:
+            sys.stderr.write("ERROR: unknown command %s, expected one of %s\n" % (command, ", ".join(COMMANDS)))
+            return command, 2
+        if job_cwd:
+            os.chdir(job_cwd)
+        return command, run_tool(command, args)
+    except Exception:
+        traceback.print_exc()
+        return command, 1
+    finally:
+        os.chdir(cwd)
+
+def run_worker(infile, status_file=None, stop_on_error=False):
+    """
+    Runs the jobs of a job stream one after the other, returns the number of failed jobs
+    """
+    failed = 0
+    if status_file:
+        status_file.write("job\tline\tcommand\tstatus\twall\n")
+    for job, (number, line) in enumerate(read_jobs(infile), 1):
+        start = time.perf_counter()
+        command, status = run_job(line)
+        wall = time.perf_counter() - start
+        sys.stderr.write("covseq worker: job %i (line %i, %s) exited with status %i in %.3fs\n" % (job, number, command, status, wall))
+        if status_file:
+            status_file.write("%i\t%i\t%s\t%i\t%.4f\n" % (job, number, command, status, wall))
+            status_file.flush()
+        if status:
+            failed += 1
+            if stop_on_error:
+                break
+    return failed
+
+def parse_worker_args(args):
+    """
+    Worker mode argument parser
+    """
+    parser = argparse.ArgumentParser(prog="covseq worker", description="Runs a stream of covseq jobs, one per line, in this process.")
+
+    parser.add_argument('-j',
+                        '--jobs',
+                        help="Job file (Default: stdin).",
+                        type=argparse.FileType('r'),
+                        default='-')
+
+    parser.add_argument('-s',
+                        '--status',
+                        help="tsv file where the exit status and wall time of each job are written as they end.",
+                        type=argparse.FileType('w'),
+                        required=False)
+
+    parser.add_argument('--stop_on_error',
+                        help="Stop at the first failed job instead of running the next ones.",
+                        action='store_true')
+
+    return parser.parse_args(args)
+
+def parse_args(args=None):
+    """
+    Argument parser
+    """
+    epilog = "Commands:\n" + "\n".join("  %-22s %s" % (command, description) for command, (_, _, description) in COMMANDS.items())
+    epilog += "\n  %-22s %s" % ("worker", "Runs a stream of jobs read on stdin in one process.")
+
+    parser = argparse.ArgumentParser(prog="covseq", description="CoVSeQ metrics and variant tools.", epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+
+    parser.add_argument('command',
+                        help="Tool to run, see the commands below.",
+                        choices=list(COMMANDS) + ['worker'],
+                        metavar='COMMAND')
+
+    parser.add_argument('args',
+                        help="Arguments of the command (covseq COMMAND --help).",
+                        nargs=argparse.REMAINDER)
+
+    return parser.parse_args(args)
+
+def main(args=None):
+    """
+    main
+    """
+    args = parse_args(args)
+    if args.command == 'worker':
+        worker_args = parse_worker_args(args.args)
+        failed = run_worker(worker_args.jobs, worker_args.status, worker_args.stop_on_error)
+        if failed:
+            sys.stderr.write("WARNING: %i covseq jobs failed\n" % failed)
+        sys.exit(1 if failed else 0)
+    sys.exit(run_tool(args.command, args.args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+
+"""
+Catalog of the runs, samples and report artifacts of COVID_full_processing, replacing the find crawls of prepare_LSPQReport.sh.
+
+The processing tree (<ROOT>/{illumina,mgi,nanopore}/<RUN>/...) is walked once with os.scandir and every file of interest
+(alignment bams, nanopore commands, report_metrics.csv, nanopore metrics and ncov_tools reports) is stored in a SQLite
+catalog. The catalog keeps the mtime of each directory along with its subdirectories, so a refresh only lists the
+directories whose mtime changed, the unchanged ones costing a single stat.
+
+From the catalog, the *_samples.csv lists, the internal_metrics and ncov_tools link sets and full_nanopore_report.csv are
+written in <REPORT_PATH>/{illumina,mgi,nanopore}_reports as prepare_LSPQReport.sh did with find.
+"""
+
+import os
+import sys
+import glob
+import fnmatch
+import sqlite3
+import argparse
+
+PLATFORMS = ["illumina", "mgi", "nanopore"]
+
+# (kind, path pattern relative to the root, the '*' of the last component only matching within it as with find -name)
+ARTIFACT_PATTERNS = [
+    ('bam', "*/*/alignment*/*/*.sorted.filtered.bam"),
+    ('commands', "*/*/analysis/*/*/*_commands.txt"),
+    ('report_metrics', "*/*/**/report_metrics.csv"),
+    ('nanopore_metrics', "nanopore/*/analysis/**/*metrics.csv"),
+    ('summary_qc', "*/*/**/*_summary_qc.tsv"),
+    ('negative_control', "*/*/**/*_negative_control_report.tsv"),
+    ('ambiguous_position', "*/*/**/*_ambiguous_position_report.tsv"),
+    ('lineage', "*/*/**/*_lineage_report.csv")
+    ]
+
+NCOV_TOOLS_KINDS = ['summary_qc', 'negative_control', 'ambiguous_position', 'lineage']
+
+# Directories, relative to the root, under which the ncov_tools reports of each platform are linked
+NCOV_TOOLS_LOCATIONS = {
+    'illumina': "illumina/*/report/**",
+    'nanopore': "nanopore/*/analysis/*/ncov_tools/**"
+    }
+
+# Path components of the sample lists, as 'cut -d / -f 5,6,8' (illumina, mgi) and 'cut -d / -f 5,6,8,9' (nanopore)
+# gave on the absolute paths under /genfs/projects/COVID_full_processing
+SAMPLE_LISTS = {
+    'illumina': ('bam', [0, 1, 3]),
+    'mgi': ('bam', [0, 1, 3]),
+    'nanopore': ('commands', [0, 1, 3, 4])
+    }
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS directories_parent ON directories (parent);
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    platform TEXT NOT NULL,
+    run TEXT NOT NULL,
+    PRIMARY KEY (path, kind)
+);
+CREATE INDEX IF NOT EXISTS artifacts_directory ON artifacts (directory);
+CREATE INDEX IF NOT EXISTS artifacts_kind ON artifacts (kind, platform, run);
+CREATE VIEW IF NOT EXISTS runs AS
+    SELECT substr(path, 1, instr(path, '/') - 1) AS platform, substr(path, instr(path, '/') + 1) AS run
+    FROM directories WHERE parent IN (SELECT path FROM directories WHERE parent = '');
+CREATE VIEW IF NOT EXISTS samples AS
+    SELECT platform, run, path FROM artifacts WHERE kind IN ('bam', 'commands');
+"""
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Builds or refreshes the catalog of the COVID_full_processing runs and writes the sample lists and report links."
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-r',
+                        '--root',
+                        help="COVID_full_processing location (Default: /genfs/projects/COVID_full_processing).",
+                        default="/genfs/projects/COVID_full_processing")
+
+    parser.add_argument('-o',
+                        '--report_path',
+                        help="Report location where the sample lists and links are written (Default: <ROOT>/Report).",
+                        required=False)
+
+    parser.add_argument('-d',
+                        '--database',
+                        help="SQLite catalog (Default: <REPORT_PATH>/artifact_catalog.sqlite).",
+                        required=False)
+
+    parser.add_argument('--full',
+                        help="Re-list every directory instead of only the ones whose mtime changed.",
+                        action='store_true')
+
+    parser.add_argument('--catalog_only',
+                        help="Only refresh the catalog, don't write the sample lists and links.",
+                        action='store_true')
+
+    return parser.parse_args()
+
+def match_path(parts, pattern):
+    """
+    Returns True if the path components match the pattern components, '**' matching any number of components
+    """
+    pattern_parts = pattern.split("/")
+    if not pattern_parts:
+        return not parts
+    if pattern_parts[0] == "**":
+        rest = "/".join(pattern_parts[1:])
+        if not rest:
+            return True
+        return any(match_path(parts[index:], rest) for index in range(len(parts) + 1))
+    if not parts or not fnmatch.fnmatchcase(parts[0], pattern_parts[0]):
+        return False
+    if len(pattern_parts) == 1:
+        return len(parts) == 1
+    return match_path(parts[1:], "/".join(pattern_parts[1:]))
+
+def artifact_kinds(relative_path):
+    """
+    Returns the artifact kinds of a file path relative to the root
+    """
+    parts = relative_path.split("/")
+    return [kind for kind, pattern in ARTIFACT_PATTERNS if match_path(parts, pattern)]
+
+class ArtifactCatalog(object):
+    """
+    SQLite catalog of the artifacts found under the processing root, paths being stored relative to the root
+    """
+    def __init__(self, db_path, root):
+        self.root = os.path.abspath(root)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(SCHEMA)
+        self.listed = 0
+        self.reused = 0
+
+    def refresh(self, full=False):
+        """
+        Walks the platform directories, listing only the directories whose mtime changed since the last refresh
+        """
+        self.listed = self.reused = 0
+        self.connection.execute("INSERT OR REPLACE INTO directories VALUES ('', NULL, 0)")
+        for platform in PLATFORMS:
+            if os.path.isdir(os.path.join(self.root, platform)):
+                self.connection.execute("INSERT OR IGNORE INTO directories VALUES (?, '', -1)", (platform,))
+                self._walk(platform, full)
+            else:
+                self._forget(platform)
+        self.connection.commit()
+
+    def _walk(self, directory, full):
+        """
+        Refreshes a directory, then its subdirectories
+        """
+        try:
+            mtime_ns = os.stat(os.path.join(self.root, directory)).st_mtime_ns
+        except OSError:
+            self._forget(directory)
+            return
+        row = self.connection.execute("SELECT mtime_ns FROM directories WHERE path = ?", (directory,)).fetchone()
+        if not full and row is not None and row[0] == mtime_ns:
+            self.reused += 1
+            subdirectories = [path for path, in self.connection.execute("SELECT path FROM directories WHERE parent = ?", (directory,))]
+        else:
+            self.listed += 1
+            subdirectories = self._list(directory, mtime_ns)
+        for subdirectory in subdirectories:
+            self._walk(subdirectory, full)
+
+    def _list(self, directory, mtime_ns):
+        """
+        Lists a directory, replacing its artifacts and subdirectories in the catalog, and returns its subdirectories
+        """
+        subdirectories = []
+        artifacts = []
+        with os.scandir(os.path.join(self.root, directory)) as entries:
+            for entry in entries:
+                path = directory + "/" + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    subdirectories.append(path)
+                elif entry.is_file(follow_symlinks=False):
+                    platform, run = path.split("/")[:2] if path.count("/") > 1 else (path.split("/")[0], "")
+                    artifacts.extend((path, kind, directory, platform, run) for kind in artifact_kinds(path))
+        known = [path for path, in self.connection.execute("SELECT path FROM directories WHERE parent = ?", (directory,))]
+        for path in set(known) - set(subdirectories):
+            self._forget(path)
+        self.connection.execute("DELETE FROM artifacts WHERE directory = ?", (directory,))
+        self.connection.executemany("INSERT OR REPLACE INTO artifacts VALUES (?, ?, ?, ?, ?)", artifacts)
+        self.connection.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?)", (directory, os.path.dirname(directory), mtime_ns))
+        # New subdirectories are listed whatever their mtime
+        self.connection.executemany("INSERT OR IGNORE INTO directories VALUES (?, ?, -1)", [(path, directory) for path in subdirectories])
+        return subdirectories
+
+    def _forget(self, directory):
+        """
+        Drops a directory that disappeared, its subdirectories and their artifacts from the catalog
+        """
+        for path, in self.connection.execute("SELECT path FROM directories WHERE parent = ?", (directory,)).fetchall():
+            self._forget(path)
+        self.connection.execute("DELETE FROM artifacts WHERE directory = ?", (directory,))
+        self.connection.execute("DELETE FROM directories WHERE path = ?", (directory,))
+
+    def artifacts(self, kind, platform=None, run=None):
+        """
+        Returns the sorted paths, relative to the root, of the artifacts of a kind
+        """
+        query = "SELECT path FROM artifacts WHERE kind = ?"
+        values = [kind]
+        if platform is not None:
+            query += " AND platform = ?"
+            values.append(platform)
+        if run is not None:
+            query += " AND run = ?"
+            values.append(run)
+        return sorted(path for path, in self.connection.execute(query, values))
+
+    def sample_list(self, platform):
+        """
+        Returns the lines of the <platform>_samples.csv list
+        """
+        kind, fields = SAMPLE_LISTS[platform]
+        lines = []
+        for path in self.artifacts(kind, platform):
+            parts = path.split("/")
+            lines.append(",".join(parts[index] for index in fields))
+        return lines
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def link_artifacts(catalog, paths, link_dir, link_names=None):
+    """
+    Replaces the symlinks of a directory by relative links to the given artifacts, the last one winning as with ln -sf
+    """
+    for link in glob.glob(os.path.join(link_dir, "*")):
+        if os.path.islink(link):
+            os.remove(link)
+    for index, path in enumerate(paths):
+        link_name = link_names[index] if link_names else os.path.basename(path)
+        if os.path.lexists(os.path.join(link_dir, link_name)):
+            os.remove(os.path.join(link_dir, link_name))
+        os.symlink(os.path.relpath(os.path.join(catalog.root, path), link_dir), os.path.join(link_dir, link_name))
+
+def last_line(path):
+    """
+    Returns the last line of a file as 'echo $(tail -n 1 <file>)' prints it
+    """
+    with open(path, 'r') as infile:
+        lines = infile.read().splitlines()
+    return " ".join(lines[-1].split()) if lines else ""
+
+def write_reports(catalog, report_path):
+    """
+    Writes the sample lists, the internal_metrics and ncov_tools links and full_nanopore_report.csv
+    """
+    for platform in PLATFORMS:
+        platform_dir = os.path.join(report_path, platform + "_reports")
+        for subdirectory in ["internal_metrics", "ncov_tools"]:
+            os.makedirs(os.path.join(platform_dir, subdirectory), exist_ok=True)
+        lines = catalog.sample_list(platform)
+        with open(os.path.join(platform_dir, platform + "_samples.csv"), 'w') as outfile:
+            outfile.writelines(line + "\n" for line in lines)
+
+        if platform in ["illumina", "mgi"]:
+            paths = []
+            link_names = []
+            for run in sorted(set(line.split(",")[1] for line in lines)):
+                run_metrics = catalog.artifacts('report_metrics', platform, run)
+                if len(run_metrics) != 1:
+                    sys.stderr.write("WARNING: %i report_metrics.csv found for %s run %s, no link created\n" % (len(run_metrics), platform, run))
+                    continue
+                paths.append(run_metrics[0])
+                link_names.append(run + "_report_metrics.csv")
+            link_artifacts(catalog, paths, os.path.join(platform_dir, "internal_metrics"), link_names)
+        else:
+            internal_dir = os.path.join(platform_dir, "internal_metrics")
+            header_file = os.path.join(report_path, platform + ".metrics.header.csv")
+            with open(os.path.join(internal_dir, "full_nanopore_report.csv"), 'w') as outfile:
+                if os.path.isfile(header_file):
+                    with open(header_file, 'r') as header:
+                        outfile.write(header.read())
+                else:
+                    sys.stderr.write("WARNING: %s not found, full_nanopore_report.csv written without header\n" % header_file)
+                for path in catalog.artifacts('nanopore_metrics', platform):
+                    outfile.write("%s,%s\n" % (last_line(os.path.join(catalog.root, path)), os.path.relpath(os.path.join(catalog.root, path), internal_dir)))
+
+        # MGI ncov_tools reports are not linked yet
+        if platform in NCOV_TOOLS_LOCATIONS:
+            paths = [path for kind in NCOV_TOOLS_KINDS for path in catalog.artifacts(kind, platform) if match_path(path.split("/"), NCOV_TOOLS_LOCATIONS[platform])]
+            link_artifacts(catalog, paths, os.path.join(platform_dir, "ncov_tools"))
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    report_path = args.report_path or os.path.join(args.root, "Report")
+    catalog = ArtifactCatalog(args.database or os.path.join(report_path, "artifact_catalog.sqlite"), args.root)
+    try:
+        catalog.refresh(args.full)
+        sys.stderr.write("Artifact catalog: %i directories listed, %i unchanged\n" % (catalog.listed, catalog.reused))
+        if not args.catalog_only:
+            write_reports(catalog, report_path)
+    finally:
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main()
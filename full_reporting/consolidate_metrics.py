@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+
+"""
+Consolidates the per-run metrics read by prepare_full_report.R into a run-partitioned Parquet dataset.
+
+Three tables are kept in the store (Default: <REPORT_PATH>/metrics_store):
+ - internal_metrics     = illumina and mgi <RUN>_report_metrics.csv
+ - ncov_tools           = illumina and nanopore <RUN>_summary_qc.tsv
+ - nanopore_metrics     = rows of the nanopore full_nanopore_report.csv, split by run
+
+Each table is laid out as <table>/<platform>/<run>/part-<hash>.parquet. All the source columns are stored as text (empty
+and NA cells as null, as readr reads them) followed by the 'filename', 'platform' and 'run' columns, so the partitions
+share one schema and the types are guessed once by the reader.
+
+'append' writes the runs whose source changed since the last append and replaces their previous partition, appending
+the same sources again is a no-op. The runs of a table and platform that are no longer found in its sources (source file
+removed or renamed, rows gone from the nanopore report) are dropped from the store, so the store always holds what
+re-reading the sources would give. 'compact' merges the run partitions of each platform into a single file. The content
+hash and the file holding each run are tracked in <store>/_manifest.json.
+"""
+
+import io
+import os
+import sys
+import glob
+import json
+import hashlib
+import argparse
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+STORE_COLUMNS = ['filename', 'platform', 'run']
+MANIFEST = "_manifest.json"
+
+# (table, platform, glob pattern relative to the report path, file name suffix removed to get the run, separator)
+RUN_SOURCES = [
+    ('internal_metrics', 'illumina', "illumina_reports/internal_metrics/*report_metrics.csv", "_report_metrics.csv", ","),
+    ('internal_metrics', 'mgi', "mgi_reports/internal_metrics/*report_metrics.csv", "_report_metrics.csv", ","),
+    ('ncov_tools', 'illumina', "illumina_reports/ncov_tools/**/*_summary_qc.tsv", "_summary_qc.tsv", "\t"),
+    ('ncov_tools', 'nanopore', "nanopore_reports/ncov_tools/**/*_summary_qc.tsv", "_summary_qc.tsv", "\t")
+    ]
+NANOPORE_REPORT = "nanopore_reports/internal_metrics/full_nanopore_report.csv"
+TABLES = ['internal_metrics', 'ncov_tools', 'nanopore_metrics']
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Consolidates the per-run metrics of the full report into a run-partitioned Parquet dataset."
+
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    for command, help_text in [('append', "Append the runs whose metrics changed since the last append and drop the runs no longer in the sources."),
+                               ('compact', "Merge the run partitions of each platform into a single file.")]:
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument('-r',
+                               '--report_path',
+                               help="Report location holding the *_reports directories (Default: current directory).",
+                               default=os.getcwd())
+        subparser.add_argument('-s',
+                               '--store',
+                               help="Parquet dataset location (Default: <REPORT_PATH>/metrics_store).",
+                               required=False)
+        subparser.add_argument('-t',
+                               '--tables',
+                               help="Tables to process (Default: all).",
+                               nargs='+',
+                               choices=TABLES,
+                               default=TABLES)
+
+    return parser.parse_args()
+
+def read_text_table(path_or_buffer, sep):
+    """
+    Returns a csv/tsv as a dataframe of strings, empty and NA cells being null as with readr defaults
+    """
+    return pd.read_csv(path_or_buffer, sep=sep, dtype=str, keep_default_na=False, na_values=["", "NA"])
+
+def to_arrow(frame, filename, platform, run):
+    """
+    Returns the arrow table of a source dataframe with the filename, platform and run columns
+    """
+    frame = frame.drop(columns=[column for column in ['platform', 'run'] if column in frame.columns])
+    if 'filename' not in frame.columns:
+        frame['filename'] = filename
+    frame['platform'] = platform
+    frame['run'] = run
+    columns = [column for column in frame.columns if column not in STORE_COLUMNS] + STORE_COLUMNS
+    schema = pa.schema([(column, pa.string()) for column in columns])
+    return pa.Table.from_pandas(frame[columns], schema=schema, preserve_index=False)
+
+def align(table, columns):
+    """
+    Returns the table with the given columns in order, missing columns being null
+    """
+    arrays = [table.column(column) if column in table.column_names else pa.nulls(table.num_rows, pa.string()) for column in columns]
+    return pa.Table.from_arrays(arrays, schema=pa.schema([(column, pa.string()) for column in columns]))
+
+def concat(tables):
+    """
+    Returns the concatenation of tables with possibly different columns, on the union of their columns
+    """
+    columns = []
+    for table in tables:
+        columns.extend(column for column in table.column_names if column not in columns and column not in STORE_COLUMNS)
+    columns += STORE_COLUMNS
+    return pa.concat_tables([align(table, columns) for table in tables])
+
+class MetricsStore(object):
+    """
+    Run-partitioned Parquet dataset along with the manifest of the content hash and file of each run
+    """
+    def __init__(self, store_path):
+        self.path = store_path
+        self.manifest_file = os.path.join(store_path, MANIFEST)
+        self.manifest = {}
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, 'r') as infile:
+                self.manifest = json.load(infile)
+        self.written = 0
+        self.unchanged = 0
+        self.pruned = 0
+
+    def save(self):
+        os.makedirs(self.path, exist_ok=True)
+        with open(self.manifest_file + ".tmp", 'w') as outfile:
+            json.dump(self.manifest, outfile, indent=1, sort_keys=True)
+        os.replace(self.manifest_file + ".tmp", self.manifest_file)
+
+    def _write(self, table, relative_path):
+        """
+        Writes a parquet file atomically, the temporary file being hidden from dataset readers
+        """
+        path = os.path.join(self.path, relative_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temporary = os.path.join(os.path.dirname(path), "." + os.path.basename(path) + ".tmp")
+        pq.write_table(table, temporary)
+        os.replace(temporary, path)
+
+    def _remove(self, relative_path):
+        path = os.path.join(self.path, relative_path)
+        if os.path.isfile(path):
+            os.remove(path)
+        directory = os.path.dirname(path)
+        if os.path.isdir(directory) and not os.listdir(directory):
+            os.rmdir(directory)
+
+    def _drop_compacted_run(self, table_name, platform, run):
+        """
+        Rewrites the compacted file holding a run without its rows
+        """
+        runs = self.manifest[table_name][platform]
+        compacted = runs[run]['file']
+        kept = [other for other in runs if other != run and runs[other]['file'] == compacted]
+        if kept:
+            table = pq.read_table(os.path.join(self.path, compacted))
+            table = table.filter(pc.is_in(table.column('run'), value_set=pa.array(kept, pa.string())))
+            new_compacted = os.path.join(table_name, platform, "compacted-%s.parquet" % self._hash_runs(runs, kept))
+            self._write(table, new_compacted)
+            for other in kept:
+                runs[other]['file'] = new_compacted
+            if new_compacted == compacted:
+                return
+        self._remove(compacted)
+
+    @staticmethod
+    def _hash_runs(runs, names):
+        return hashlib.sha1(json.dumps(sorted((name, runs[name]['hash']) for name in names)).encode()).hexdigest()[:16]
+
+    def is_current(self, table_name, platform, run, content_hash):
+        """
+        Returns True if the partition of a run already holds the content with this hash
+        """
+        entry = self.manifest.get(table_name, {}).get(platform, {}).get(run)
+        return entry is not None and entry['hash'] == content_hash
+
+    def append(self, table_name, platform, run, table, content_hash):
+        """
+        Replaces the partition of a run unless it already holds the same content
+        """
+        if self.is_current(table_name, platform, run, content_hash):
+            self.unchanged += 1
+            return False
+        runs = self.manifest.setdefault(table_name, {}).setdefault(platform, {})
+        if run in runs:
+            if os.path.basename(runs[run]['file']).startswith("compacted-"):
+                self._drop_compacted_run(table_name, platform, run)
+            else:
+                self._remove(runs[run]['file'])
+        part = os.path.join(table_name, platform, run, "part-%s.parquet" % content_hash[:16])
+        self._write(table, part)
+        runs[run] = {'hash': content_hash, 'file': part}
+        self.written += 1
+        return True
+
+    def prune(self, table_name, platform, current_runs):
+        """
+        Drops the runs of a table and platform that are not in current_runs, along with their partition or their rows of a compacted file
+        """
+        runs = self.manifest.get(table_name, {}).get(platform, {})
+        for run in sorted(set(runs) - set(current_runs)):
+            if os.path.basename(runs[run]['file']).startswith("compacted-"):
+                self._drop_compacted_run(table_name, platform, run)
+            else:
+                self._remove(runs[run]['file'])
+            del runs[run]
+            self.pruned += 1
+            sys.stderr.write("Metrics store: run %s of %s %s no longer in the sources, dropped\n" % (run, platform, table_name))
+
+    def compact(self, table_name):
+        """
+        Merges the run partitions and compacted file of each platform of a table into a single compacted file
+        """
+        for platform, runs in sorted(self.manifest.get(table_name, {}).items()):
+            files = sorted(set(entry['file'] for entry in runs.values()))
+            if len(files) < 2:
+                continue
+            table = concat([pq.read_table(os.path.join(self.path, path)) for path in files])
+            compacted = os.path.join(table_name, platform, "compacted-%s.parquet" % self._hash_runs(runs, list(runs)))
+            self._write(table, compacted)
+            for entry in runs.values():
+                entry['file'] = compacted
+            for path in files:
+                if path != compacted:
+                    self._remove(path)
+            sys.stderr.write("Compacted %i files of %s %s into %s\n" % (len(files), platform, table_name, compacted))
+
+def file_hash(path):
+    with open(path, 'rb') as infile:
+        return hashlib.sha1(infile.read()).hexdigest()
+
+def append_run_sources(store, report_path, tables):
+    """
+    Appends the internal metrics and ncov_tools files, one file per run, and prunes the runs whose file is gone
+    """
+    for table_name, platform, pattern, suffix, sep in RUN_SOURCES:
+        if table_name not in tables:
+            continue
+        current_runs = []
+        for path in sorted(glob.glob(os.path.join(report_path, pattern), recursive=True)):
+            filename = os.path.relpath(path, report_path)
+            run = os.path.basename(path)[:-len(suffix)]
+            current_runs.append(run)
+            content_hash = file_hash(path)
+            # Checked before parsing, so unchanged runs are only hashed
+            if store.is_current(table_name, platform, run, content_hash):
+                store.unchanged += 1
+                continue
+            store.append(table_name, platform, run, to_arrow(read_text_table(path, sep), filename, platform, run), content_hash)
+        store.prune(table_name, platform, current_runs)
+
+def append_nanopore_report(store, report_path):
+    """
+    Appends the rows of the full nanopore report, grouped by the run found in their filename column, and prunes the runs
+    without rows in the report
+    """
+    report_file = os.path.join(report_path, NANOPORE_REPORT)
+    lines = []
+    if os.path.isfile(report_file):
+        with open(report_file, 'r') as infile:
+            lines = infile.read().splitlines()
+    else:
+        sys.stderr.write("WARNING: %s not found, no nanopore metrics consolidated\n" % report_file)
+    if not lines:
+        store.prune('nanopore_metrics', 'nanopore', [])
+        return
+    header = lines[0]
+    filename_index = header.split(",").index('filename') if 'filename' in header.split(",") else -1
+    rows_by_run = {}
+    for line in lines[1:]:
+        # The run is the 2nd component under the nanopore directory of ../../../nanopore/<RUN>/analysis/...
+        path_parts = line.split(",")[filename_index].split("/")
+        if len(path_parts) < 5:
+            sys.stderr.write("WARNING: no run found for nanopore metrics line '%s'\n" % line)
+            continue
+        rows_by_run.setdefault(path_parts[4], []).append(line)
+    for run, rows in sorted(rows_by_run.items()):
+        text = "\n".join([header] + rows) + "\n"
+        frame = read_text_table(io.StringIO(text), ",")
+        store.append('nanopore_metrics', 'nanopore', run, to_arrow(frame, NANOPORE_REPORT, 'nanopore', run), hashlib.sha1(text.encode()).hexdigest())
+    store.prune('nanopore_metrics', 'nanopore', list(rows_by_run))
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    store = MetricsStore(args.store or os.path.join(args.report_path, "metrics_store"))
+    if args.command == 'append':
+        append_run_sources(store, args.report_path, args.tables)
+        if 'nanopore_metrics' in args.tables:
+            append_nanopore_report(store, args.report_path)
+        sys.stderr.write("Metrics store: %i runs written, %i unchanged, %i dropped\n" % (store.written, store.unchanged, store.pruned))
+    else:
+        for table_name in args.tables:
+            store.compact(table_name)
+    store.save()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Per-reference mapped/unmapped read counts read directly from the BAM index, without spawning samtools idxstats.
+
+The counts come from the metadata pseudo-bin (bin 37450) that samtools writes for each reference in the .bai, and the
+count of unplaced unmapped reads stored at the end of the index. Reference names and lengths are read from the BAM header.
+Nothing is cached here: the .bai is one of the inputs keying the per-sample metrics cache (see common/metrics_cache.py),
+so the index of an unchanged sample isn't read again on re-collection.
+"""
+
+import os
+import gzip
+import struct
+import subprocess
+
+PSEUDO_BIN = 37450
+VIRAL_CONTIGS = ["MN908947.3"]
+
+def bam_references(bam_file):
+    """
+    Returns the (name, length) of the references listed in the header of a bam
+    """
+    with gzip.open(bam_file, 'rb') as bam:
+        if bam.read(4) != b"BAM\1":
+            raise ValueError("%s is not a bam file" % bam_file)
+        l_text, = struct.unpack("<i", bam.read(4))
+        bam.read(l_text)
+        n_ref, = struct.unpack("<i", bam.read(4))
+        references = []
+        for _ in range(n_ref):
+            l_name, = struct.unpack("<i", bam.read(4))
+            name = bam.read(l_name)[:-1].decode()
+            l_ref, = struct.unpack("<i", bam.read(4))
+            references.append((name, l_ref))
+    return references
+
+def find_index(bam_file):
+    """
+    Returns the path of the .bai index of a bam, None if there is none
+    """
+    for index_file in (bam_file + ".bai", os.path.splitext(bam_file)[0] + ".bai"):
+        if os.path.isfile(index_file):
+            return index_file
+    return None
+
+def read_index_counts(index_file):
+    """
+    Returns the (mapped, unmapped) count of each reference of a .bai and the count of unplaced unmapped reads
+    """
+    with open(index_file, 'rb') as index:
+        data = index.read()
+    if data[:4] != b"BAI\1":
+        raise ValueError("%s is not a bai index" % index_file)
+    n_ref, = struct.unpack_from("<i", data, 4)
+    offset = 8
+    counts = []
+    for _ in range(n_ref):
+        mapped = unmapped = 0
+        n_bin, = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, offset)
+            offset += 8
+            if bin_id == PSEUDO_BIN and n_chunk == 2:
+                mapped, unmapped = struct.unpack_from("<QQ", data, offset + 16)
+            offset += 16 * n_chunk
+        n_intv, = struct.unpack_from("<i", data, offset)
+        offset += 4 + 8 * n_intv
+        counts.append((mapped, unmapped))
+    no_coor = struct.unpack_from("<Q", data, offset)[0] if len(data) >= offset + 8 else 0
+    return counts, no_coor
+
+def samtools_idxstats(bam_file):
+    """
+    Returns the (contig, length, mapped, unmapped) of samtools idxstats, used when the bam has no .bai index
+    """
+    output = subprocess.run(["samtools", "idxstats", bam_file], stdout=subprocess.PIPE, universal_newlines=True).stdout
+    stats = []
+    for line in output.splitlines():
+        fields = line.split("\t")
+        if len(fields) >= 4:
+            stats.append((fields[0], int(fields[1]), int(fields[2]), int(fields[3])))
+    return stats
+
+def idxstats(bam_file):
+    """
+    Returns the (contig, length, mapped, unmapped) lines samtools idxstats gives for a bam, including the final '*' line
+    """
+    index_file = find_index(bam_file)
+    if index_file is None:
+        return samtools_idxstats(bam_file)
+    counts, no_coor = read_index_counts(index_file)
+    stats = [(name, length, mapped, unmapped) for (name, length), (mapped, unmapped) in zip(bam_references(bam_file), counts)]
+    stats.append(("*", 0, 0, no_coor))
+    return stats
+
+def read_contig_map(contig_map_file):
+    """
+    Returns the viral contigs of a contig map tsv with one '<contig>\t<host|viral>' line per contig
+    Contigs missing from the map are counted as host
+    """
+    viral_contigs = []
+    with open(contig_map_file, 'r') as contig_map:
+        for line in contig_map:
+            fields = line.split()
+            if len(fields) >= 2 and fields[1].lower() == "viral":
+                viral_contigs.append(fields[0])
+    return viral_contigs
+
+def host_counts(bam_files, viral_contigs=VIRAL_CONTIGS):
+    """
+    Returns the total, host only, viral only and unmapped read counts summed over the bams of a sample (one per readset)
+    """
+    total = viral = unmapped = 0
+    for bam_file in bam_files:
+        stats = idxstats(bam_file)
+        bam_unmapped = sum(contig_unmapped for _, _, _, contig_unmapped in stats)
+        total += sum(contig_mapped for _, _, contig_mapped, _ in stats) + bam_unmapped
+        viral += sum(contig_mapped for contig, _, contig_mapped, _ in stats if contig in viral_contigs)
+        unmapped += bam_unmapped
+    return total, total - viral - unmapped, viral, unmapped
@@ -5,27 +5,38 @@ import sys
 import re
 import argparse
 
-import vcf
-from Bio import SeqIO
+import numpy as np
+
+from variant_reader import VcfReader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "common"))
+from stage_profiler import StageProfiler
+
+RUN_OUTPUT_SUFFIX = ".variants_in_consensus.tsv"
+# Number of (variant, consensus, reference) checks evaluated together in run mode
+CHECK_BATCH_SIZE = 100000
 
 def parse_args():
     """
     Argument parser
     """
     description = """1. Checks if the consensus has the same length as the regference and print a warning if not.
-2. If no Warning from first step, checks if all the variants in the vcf are found in the fasta file and return the variants not found."""
+2. If no Warning from first step, checks if all the variants in the vcf are found in the fasta file and return the variants not found.
+Run mode (--manifest): checks all the samples of a run at once, writes the tsv of each sample in --output_dir and a
+concordance summary of the run (variant mismatches per sample in --output, mismatching variants shared by samples in
+--recurrent)."""
 
-    parser = argparse.ArgumentParser(description=description)
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
 
     parser.add_argument('-c',
                         '--consensus',
                         help="Consensus fasta file",
-                        required=True)
+                        required=False)
 
     parser.add_argument('-v',
                         '--vcf',
                         help="Variants vcf file",
-                        required=True)
+                        required=False)
 
     parser.add_argument('-r',
                         '--reference',
@@ -41,13 +52,61 @@ def parse_args():
 
     parser.add_argument('-o',
                         '--output',
-                        help="tsv file with variants found within vcf file (Default: stdout)",
+                        help="tsv file with variants found within vcf file, in run mode the per-sample concordance summary (Default: stdout)",
                         type=argparse.FileType('w'),
                         default='-')
 
-    return parser.parse_args()
+    parser.add_argument('-m',
+                        '--manifest',
+                        help="Run mode: tsv with a header and sample, consensus and vcf columns",
+                        required=False)
 
-def check_consensus_size(fasta_file, reference):
+    parser.add_argument('-d',
+                        '--output_dir',
+                        help="Run mode: directory where the <SAMPLE>%s tsv of each sample is written (Default: current directory)" % RUN_OUTPUT_SUFFIX,
+                        default=os.curdir)
+
+    parser.add_argument('--recurrent',
+                        help="Run mode: tsv of the variants not matching the consensus in several samples (Default: <OUTPUT_DIR>/recurrent_mismatches.tsv)",
+                        required=False)
+
+    parser.add_argument('--min_samples',
+                        help="Run mode: minimum number of samples a mismatching variant is found in to be reported as recurrent (Default: 2)",
+                        default=2,
+                        type=int)
+
+    parser.add_argument('--profile',
+                        help="Append the wall time, CPU time and peak memory of each stage of the run as a JSON line to this file.",
+                        required=False)
+
+    args = parser.parse_args()
+    if args.manifest and (args.consensus or args.vcf):
+        parser.error("--consensus and --vcf can't be used with --manifest")
+    if not args.manifest and not (args.consensus and args.vcf):
+        parser.error("--consensus and --vcf are required unless --manifest is used")
+    return args
+
+def load_fasta(fasta_file):
+    """
+    Returns the records of a fasta file as a list of (name, sequence) tuples, the sequence being kept as bytes
+    """
+    records = []
+    name = None
+    lines = []
+    with open(fasta_file, 'rb') as infile:
+        for line in infile:
+            if line.startswith(b">"):
+                if name is not None:
+                    records.append((name, b"".join(lines).replace(b" ", b"")))
+                name = line[1:].strip().decode()
+                lines = []
+            elif name is not None:
+                lines.append(line.strip())
+    if name is not None:
+        records.append((name, b"".join(lines).replace(b" ", b"")))
+    return records
+
+def check_consensus_size(fasta_file, reference, consensus_records=None):
     """
     Returns a warning if the len of the consensus != len of reference
     """
@@ -56,160 +115,349 @@ def check_consensus_size(fasta_file, reference):
     with open(reference_index, "r") as reference:
         for line in reference:
             ref_len = int(line.split("\t")[1])
-    for record in SeqIO.parse(fasta_file, "fasta"):
-        if len(record.seq) != ref_len:
+    if consensus_records is None:
+        consensus_records = load_fasta(fasta_file)
+    for _, consensus_seq in consensus_records:
+        if len(consensus_seq) != ref_len:
             sys.stderr.write("""WARNING: The length of the consensus (%i) is diferent from the length of the reference (%i).
-The variants can't be checked.\n""" % (len(record.seq), ref_len))
+The variants can't be checked.\n""" % (len(consensus_seq), ref_len))
             ret = False
     return ret
 
-def store_current_out(variant, consensus, reference, sample, window, deletion, insertion, variant_type, variant_match, context_match, out_list):
-    ref_interval = str(reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + variant.REF + "." + reference.seq[variant.POS : variant.POS + window])
-    cons_interval = str(consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] + "." + consensus.seq[variant.POS - 1 - deletion + insertion: variant.POS - deletion + insertion] + "." + consensus.seq[variant.POS - deletion + insertion : variant.POS + window - deletion + insertion])
-    if variant_type == "deletion":
-        ref_interval = str(reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + reference.seq[variant.POS - 1 : variant.POS + (len(variant.REF) - len(variant.ALT))] + "." + reference.seq[variant.POS + (len(variant.REF) - len(variant.ALT)) : variant.POS + window + (len(variant.REF) - len(variant.ALT))])
-    elif variant_type == "insertion":
-        cons_interval = str(consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] + "." + consensus.seq[variant.POS - 1 - deletion + insertion : variant.POS - deletion + insertion + (len(variant.ALT) - len(variant.REF))] + "." + consensus.seq[variant.POS - deletion + insertion + (len(variant.ALT) - len(variant.REF)) : variant.POS + window - deletion + insertion + (len(variant.ALT) - len(variant.REF))])
-    out_list.append([
-        str(variant.POS),
-        variant.REF,
-        variant.ALT,
-        str(sample['alt_FREQ']),
-        str(sample['alt_DP']),
-        ref_interval,
-        cons_interval,
-        str(variant_match),
-        str(context_match)
-        ])
-
-def check_variants(vcf_file, consensus_file, reference_file, window):
-    """
-    Returns the positions in the vcf where the fasta is different
+def read_variants(vcf_file):
     """
-    out_list = []
-    insertion = 0
+    Yields (POS, REF, ALT, ALT_FREQ, ALT_DEPTH) tuples for each sample of each record of the vcf
+    """
+    with VcfReader(vcf_file) as reader:
+        for variant in reader:
+            alt = variant.alt.replace(",", "")
+            for sample in range(len(variant.sample_columns)):
+                yield (variant.pos, variant.ref, alt, variant.get('alt_FREQ', sample), variant.get('alt_DP', sample))
+
+def indel_offsets(variants):
+    """
+    Returns the running (deletion, insertion) offsets between reference and consensus coordinates in effect at each variant
+    """
+    offsets = []
     deletion = 0
-    for variant in vcf.Reader(open(vcf_file, 'r')):
-        for sample in variant.samples:
-            # print(sample['alt_FREQ'])
-            # print(len(variant.REF), len(variant.ALT))
-            # exit()
-            variant.ALT = "".join(str(v) for v in variant.ALT)
-            for consensus in SeqIO.parse(consensus_file, "fasta"):
-                for reference in SeqIO.parse(reference_file, "fasta"):
-                    # print(len(reference.seq), len(consensus.seq))
-                    # for indice, nt_r in enumerate(reference.seq):
-                    #     if nt_r != consensus.seq[indice]:
-                    #         print(nt_r, consensus.seq[indice])
-                    # print(len(variant.REF) - len(variant.ALT))
-
-                    variant_match = True
-
-                    # deletion within variant
-                    if len(variant.REF) - len(variant.ALT) > 0:
-                        context_match = consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] == reference.seq[variant.POS - window - 1 : variant.POS - 1] and consensus.seq[variant.POS - deletion : variant.POS + window - deletion + insertion] == reference.seq[variant.POS + (len(variant.REF) - len(variant.ALT)) : variant.POS + window + (len(variant.REF) - len(variant.ALT))]
-                        variant_match = variant.ALT == consensus.seq[variant.POS - 1 - deletion + insertion : variant.POS - deletion + insertion] and consensus.seq[variant.POS - deletion : variant.POS + window - deletion + insertion] == reference.seq[variant.POS + (len(variant.REF) - len(variant.ALT)) : variant.POS + window + (len(variant.REF) - len(variant.ALT))]
-                        # if consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] == reference.seq[variant.POS - window - 1 : variant.POS - 1] and consensus.seq[variant.POS - deletion : variant.POS + window - deletion + insertion] == reference.seq[variant.POS + (len(variant.REF) - len(variant.ALT)) : variant.POS + window + (len(variant.REF) - len(variant.ALT))]:
-                        #     context_match = True
-                        # else:
-                        #     context_match = False
-                            # out_list.append([
-                            #     str(variant.POS),
-                            #     variant.REF,
-                            #     variant.ALT,
-                            #     str(sample['alt_FREQ']),
-                            #     str(sample['alt_DP']),
-                            #     str(reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + variant.REF + "." + reference.seq[variant.POS + (len(variant.REF) - len(variant.ALT)) : variant.POS + window + (len(variant.REF) - len(variant.ALT))]),
-                            #     str(consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] + "." + variant.ALT + "." + consensus.seq[variant.POS - deletion + insertion : variant.POS + window - deletion + insertion])
-                            #     ])
-                            # print(
-                            #     variant.POS,
-                            #     variant.REF,
-                            #     variant.ALT,
-                            #     sample['alt_FREQ'],
-                            #     sample['alt_DP'],
-                            #     reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + variant.REF + "." + reference.seq[variant.POS + (len(variant.REF) - len(variant.ALT)) : variant.POS + window + (len(variant.REF) - len(variant.ALT))],
-                            #     consensus.seq[variant.POS - (window + deletion - insertion) - 1 : variant.POS - 1] + "." + variant.ALT + "." + consensus.seq[variant.POS : variant.POS + window - (deletion + insertion)]
-                            #     )
-                        store_current_out(variant, consensus, reference, sample, window, deletion, insertion, "deletion", variant_match, context_match, out_list)
-                        deletion += (len(variant.REF) - len(variant.ALT))
-                            # exit()
-
-                    # insertion within variant
-                    elif len(variant.REF) - len(variant.ALT) < 0:
-                        context_match = consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] == reference.seq[variant.POS - window - 1 : variant.POS - 1] and consensus.seq[variant.POS - deletion + insertion + (len(variant.ALT) - len(variant.REF)) : variant.POS + window - deletion + insertion + (len(variant.ALT) - len(variant.REF))] == reference.seq[variant.POS : variant.POS + window]
-                        variant_match = variant.ALT == consensus.seq[variant.POS - 1 - deletion + insertion : variant.POS - deletion + insertion + (len(variant.ALT) - len(variant.REF))]
-                        # if consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] == reference.seq[variant.POS - window - 1 : variant.POS - 1] and consensus.seq[variant.POS - deletion + insertion + (len(variant.ALT) - len(variant.REF)) : variant.POS + window - deletion + insertion + (len(variant.ALT) - len(variant.REF))] == reference.seq[variant.POS : variant.POS + window]:
-                        #     context_match = True
-                        # else:
-                        #     context_match = False
-                            # out_list.append([
-                            #     str(variant.POS),
-                            #     variant.REF,
-                            #     variant.ALT,
-                            #     str(sample['alt_FREQ']),
-                            #     str(sample['alt_DP']),
-                            #     str(reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + variant.REF + "." + reference.seq[variant.POS : variant.POS + window]),
-                            #     str(consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] + "." + variant.ALT + "." + consensus.seq[variant.POS - deletion + insertion + (len(variant.ALT) - len(variant.REF)) : variant.POS + window - deletion + insertion + (len(variant.ALT) - len(variant.REF))])
-                            #     ])
-                            # print(
-                            #     variant.POS,
-                            #     variant.REF,
-                            #     variant.ALT,
-                            #     sample['alt_FREQ'],
-                            #     sample['alt_DP'],
-                            #     reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + variant.REF + "." + reference.seq[variant.POS : variant.POS + window],
-                            #     consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] + "." + variant.ALT + "." + consensus.seq[variant.POS - deletion + insertion + (len(variant.ALT) - len(variant.REF)) : variant.POS + window - deletion + insertion + (len(variant.ALT) - len(variant.REF))]
-                            #     )
-                        store_current_out(variant, consensus, reference, sample, window, deletion, insertion, "insertion", variant_match, context_match, out_list)
-                        insertion += (len(variant.ALT) - len(variant.REF))
-                        # print(variant.POS, variant.REF, variant.ALT, consensus.seq[variant.POS - (window + 1 + deletion - insertion) : variant.POS + window - (deletion + insertion) + abs(len(variant.REF) - len(variant.ALT))], reference.seq[variant.POS - (window + 1) : variant.POS + window], sample['alt_FREQ'], sample['alt_DP'])
-
-                    else:
-                        context_match = consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] == reference.seq[variant.POS - window - 1 : variant.POS - 1] and consensus.seq[variant.POS - deletion + insertion : variant.POS + window - deletion + insertion] == reference.seq[variant.POS : variant.POS + window]
-                        variant_match = variant.ALT == consensus.seq[variant.POS - 1 - deletion + insertion : variant.POS - deletion + insertion]
-                        # if consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] == reference.seq[variant.POS - window - 1 : variant.POS - 1] and consensus.seq[variant.POS - deletion + insertion : variant.POS + window - deletion + insertion] == reference.seq[variant.POS : variant.POS + window]:
-                        #     context_match = True
-                        # else:
-                        #     context_match = False
-                        store_current_out(variant, consensus, reference, sample, window, deletion, insertion, None, variant_match, context_match, out_list)
-                            # out_list.append([
-                            #     str(variant.POS),
-                            #     variant.REF,
-                            #     variant.ALT,
-                            #     str(sample['alt_FREQ']),
-                            #     str(sample['alt_DP']),
-                            #     str(reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + variant.REF + "." + reference.seq[variant.POS : variant.POS + window]),
-                            #     str(consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] + "." + variant.ALT + "." + consensus.seq[variant.POS - deletion + insertion : variant.POS + window - deletion + insertion])
-                            #     ])
-                        # print(
-                        #     variant.POS,
-                        #     variant.REF,
-                        #     variant.ALT,
-                        #     sample['alt_FREQ'],
-                        #     sample['alt_DP'],
-                        #     reference.seq[variant.POS - window - 1 : variant.POS - 1] + "." + variant.REF + "." + reference.seq[variant.POS + (len(variant.REF) - len(variant.ALT)) : variant.POS + window + (len(variant.REF) - len(variant.ALT))],
-                        #     consensus.seq[variant.POS - window - deletion + insertion - 1 : variant.POS - 1 - deletion + insertion] + "." + variant.ALT + "." + consensus.seq[variant.POS - deletion + insertion : variant.POS + window - deletion + insertion]
-                        #     )
-                        # exit()
-                        # print(variant.POS, variant.REF, variant.ALT, consensus.seq[variant.POS - (window + 1 + deletion - insertion) : variant.POS + window - (deletion - insertion)], reference.seq[variant.POS - (window + 1) : variant.POS + window], sample['alt_FREQ'], sample['alt_DP'])
-
-                    # if record.seq[variant.POS - 1] != "".join(str(v) for v in variant.ALT):
-                    #     # print(str(variant.POS), str(variant.REF), "".join(str(v) for v in variant.ALT), str(record.seq[variant.POS - 1]))
-                    #     out_list.append([str(variant.POS), str(variant.REF), str(variant.ALT), str(sample['alt_FREQ']), str(record.seq[variant.POS - 1])])
+    insertion = 0
+    for variant in variants:
+        offsets.append((deletion, insertion))
+        length_diff = len(variant[1]) - len(variant[2])
+        if length_diff > 0:
+            deletion += length_diff
+        elif length_diff < 0:
+            insertion -= length_diff
+    return offsets
+
+def compare_variant(pos, ref, alt, consensus, reference, window, deletion, insertion):
+    """
+    Compares one variant against the consensus, both sequences being bytes
+    Returns the reference and consensus intervals around the variant along with the variant and context matches
+    """
+    shift = insertion - deletion
+    ref_left = reference[pos - window - 1 : pos - 1]
+    cons_left = consensus[pos - window - 1 + shift : pos - 1 + shift]
+    length_diff = len(ref) - len(alt)
+
+    # deletion within variant
+    if length_diff > 0:
+        ref_variant = reference[pos - 1 : pos + length_diff]
+        ref_right = reference[pos + length_diff : pos + window + length_diff]
+        cons_variant = consensus[pos - 1 + shift : pos + shift]
+        cons_right = consensus[pos + shift : pos + window + shift]
+        # The right context is read from the consensus without the insertion offset
+        right_match = consensus[pos - deletion : pos + window + shift] == ref_right
+        context_match = cons_left == ref_left and right_match
+        variant_match = alt == cons_variant and right_match
+    # insertion within variant
+    elif length_diff < 0:
+        ref_variant = ref
+        ref_right = reference[pos : pos + window]
+        cons_variant = consensus[pos - 1 + shift : pos + shift - length_diff]
+        cons_right = consensus[pos + shift - length_diff : pos + window + shift - length_diff]
+        context_match = cons_left == ref_left and cons_right == ref_right
+        variant_match = alt == cons_variant
+    else:
+        ref_variant = ref
+        ref_right = reference[pos : pos + window]
+        cons_variant = consensus[pos - 1 + shift : pos + shift]
+        cons_right = consensus[pos + shift : pos + window + shift]
+        context_match = cons_left == ref_left and cons_right == ref_right
+        variant_match = alt == cons_variant
+
+    ref_interval = b".".join((ref_left, ref_variant, ref_right))
+    cons_interval = b".".join((cons_left, cons_variant, cons_right))
+    return ref_interval, cons_interval, variant_match, context_match
+
+def compare_variants(variants, consensus_records, reference_records, window):
+    """
+    Returns one output row per variant and per consensus/reference pair, sequences being loaded once beforehand
+    """
+    variants = list(variants)
+    out_list = []
+    for (pos, ref, alt, alt_freq, alt_dp), (deletion, insertion) in zip(variants, indel_offsets(variants)):
+        ref_bytes = ref.encode()
+        alt_bytes = alt.encode()
+        for _, consensus in consensus_records:
+            for _, reference in reference_records:
+                ref_interval, cons_interval, variant_match, context_match = compare_variant(pos, ref_bytes, alt_bytes, consensus, reference, window, deletion, insertion)
+                out_list.append([
+                    str(pos),
+                    ref,
+                    alt,
+                    alt_freq,
+                    alt_dp,
+                    ref_interval.decode(),
+                    cons_interval.decode(),
+                    str(variant_match),
+                    str(context_match)
+                    ])
     return out_list
 
+def check_variants(vcf_file, consensus_file, reference_file, window, consensus_records=None, reference_records=None):
+    """
+    Returns the variants of the vcf along with whether they are found in the consensus
+    """
+    if consensus_records is None:
+        consensus_records = load_fasta(consensus_file)
+    if reference_records is None:
+        reference_records = load_fasta(reference_file)
+    return compare_variants(read_variants(vcf_file), consensus_records, reference_records, window)
+
+def write_variants(variants_list, window, output):
+    """
+    Writes the variants checked against the consensus as a tsv
+    """
+    output.write("POS\tREF\tALT\tALT_FREQ\tALT_DEPTH\tREF+-{window_size}\tCONSENSUS+-{window_size}\tVARIANT_MATCH_CONSENSUS\tCONTEXT_MATCH+-{window_size}\n".format(window_size=window))
+    output.write("\n".join("\t".join(variant) for variant in variants_list) + "\n")
+
+def read_manifest(manifest_file):
+    """
+    Returns the (sample, consensus, vcf) of each sample of a run manifest
+    """
+    samples = []
+    with open(manifest_file, 'r') as infile:
+        header = infile.readline().rstrip("\r\n").split("\t")
+        for line in infile:
+            if not line.strip() or line.startswith("#"):
+                continue
+            values = dict(zip(header, line.rstrip("\r\n").split("\t")))
+            samples.append((values['sample'], values['consensus'], values['vcf']))
+    return samples
+
+def sequence_matrix(sequences):
+    """
+    Returns a list of bytes sequences as a uint8 matrix, one zero padded row per sequence, along with their lengths
+    """
+    lengths = np.array([len(sequence) for sequence in sequences], dtype=np.int64)
+    matrix = np.zeros((len(sequences), max(1, int(lengths.max()) if len(sequences) else 0)), dtype=np.uint8)
+    for row, sequence in enumerate(sequences):
+        matrix[row, :len(sequence)] = np.frombuffer(sequence, dtype=np.uint8)
+    return matrix, lengths
+
+def gather(matrix, lengths, rows, starts, ends):
+    """
+    Returns the slices sequence[start:end] of the given rows of a sequence matrix as a zero padded matrix along with their lengths
+    Bounds follow the Python slice rules, negative bounds counting from the end of the sequence and bounds past it being clipped
+    """
+    lengths = lengths[rows]
+    starts = np.where(starts < 0, np.maximum(starts + lengths, 0), np.minimum(starts, lengths))
+    ends = np.where(ends < 0, np.maximum(ends + lengths, 0), np.minimum(ends, lengths))
+    sizes = np.maximum(ends - starts, 0)
+    offsets = np.arange(int(sizes.max()) if len(sizes) else 0)
+    values = matrix[rows[:, None], np.minimum(starts[:, None] + offsets, matrix.shape[1] - 1)]
+    values[offsets >= sizes[:, None]] = 0
+    return values, sizes
+
+def segments_equal(first, second):
+    """
+    Returns for each row whether two sets of gathered slices hold the same bytes
+    """
+    (first_values, first_sizes), (second_values, second_sizes) = first, second
+    width = max(first_values.shape[1], second_values.shape[1])
+    first_values = np.pad(first_values, ((0, 0), (0, width - first_values.shape[1])))
+    second_values = np.pad(second_values, ((0, 0), (0, width - second_values.shape[1])))
+    return (first_sizes == second_sizes) & (first_values == second_values).all(axis=1)
+
+def segment_bytes(segment, row):
+    values, sizes = segment
+    return values[row, :sizes[row]].tobytes()
+
+def compare_variants_matrix(checks, consensus, reference, literals, window):
+    """
+    Vectorized compare_variant() over a batch of checks, the consensus and reference sequences being matrix rows
+    checks holds the arrays of the variant index, consensus row, reference row, position and (deletion, insertion) offsets
+    of each check, literals the (values, sizes) of the REF and ALT of each variant
+    Returns the reference and consensus intervals along with the variant and context matches of each check
+    """
+    variant_index, consensus_rows, reference_rows, pos, deletion, insertion = checks
+    ref_literals, alt_literals = literals
+    ref = (ref_literals[0][variant_index], ref_literals[1][variant_index])
+    alt = (alt_literals[0][variant_index], alt_literals[1][variant_index])
+    length_diff = ref[1] - alt[1]
+    is_deletion = length_diff > 0
+    deleted = np.maximum(length_diff, 0)
+    inserted = np.maximum(-length_diff, 0)
+    shift = insertion - deletion
+
+    ref_left = gather(reference[0], reference[1], reference_rows, pos - window - 1, pos - 1)
+    cons_left = gather(consensus[0], consensus[1], consensus_rows, pos - window - 1 + shift, pos - 1 + shift)
+    ref_variant = gather(reference[0], reference[1], reference_rows, pos - 1, pos + deleted)
+    ref_right = gather(reference[0], reference[1], reference_rows, pos + deleted, pos + window + deleted)
+    cons_variant = gather(consensus[0], consensus[1], consensus_rows, pos - 1 + shift, pos + shift + inserted)
+    cons_right = gather(consensus[0], consensus[1], consensus_rows, pos + shift + inserted, pos + window + shift + inserted)
+    # Within a deletion, the right context is read from the consensus without the insertion offset
+    deletion_right = gather(consensus[0], consensus[1], consensus_rows, np.where(is_deletion, pos - deletion, 0), np.where(is_deletion, pos + window + shift, 0))
+
+    left_match = segments_equal(cons_left, ref_left)
+    right_match = np.where(is_deletion, segments_equal(deletion_right, ref_right), segments_equal(cons_right, ref_right))
+    context_match = left_match & right_match
+    variant_match = segments_equal(alt, cons_variant) & (right_match | ~is_deletion)
+
+    intervals = []
+    for row in range(len(pos)):
+        ref_middle = segment_bytes(ref_variant, row) if is_deletion[row] else segment_bytes(ref, row)
+        intervals.append((b".".join((segment_bytes(ref_left, row), ref_middle, segment_bytes(ref_right, row))),
+                          b".".join((segment_bytes(cons_left, row), segment_bytes(cons_variant, row), segment_bytes(cons_right, row)))))
+    return intervals, variant_match, context_match
+
+def check_run(samples, reference_file, window, profiler=None, batch_size=CHECK_BATCH_SIZE):
+    """
+    Checks the variants of all the samples of a run against their consensus at once
+    The consensus records of the run are loaded in one uint8 matrix and the variants of all the samples are compared to it
+    in vectorized batches, each variant being placed in consensus coordinates with the indel offsets of its sample
+    Returns the output rows of each sample, as compare_variants() gives them, and whether its consensus has the reference length
+    """
+    profiler = profiler or StageProfiler()
+    with profiler.stage("load reference"):
+        reference_records = load_fasta(reference_file)
+        reference = sequence_matrix([sequence for _, sequence in reference_records])
+
+    consensus_sequences = []
+    size_ok = {}
+    checks = []
+    variants = []
+    sample_checks = []
+    for sample, consensus_file, vcf_file in samples:
+        with profiler.stage("load consensus"):
+            consensus_records = load_fasta(consensus_file)
+            size_ok[sample] = check_consensus_size(consensus_file, reference_file, consensus_records)
+            consensus_rows = np.arange(len(consensus_sequences), len(consensus_sequences) + len(consensus_records))
+            consensus_sequences.extend(sequence for _, sequence in consensus_records)
+        with profiler.stage("read VCF"):
+            sample_variants = list(read_variants(vcf_file))
+            offsets = np.array(indel_offsets(sample_variants), dtype=np.int64).reshape(-1, 2)
+        # One check per variant, consensus record and reference record, in the order of compare_variants()
+        n_variants, n_consensus, n_reference = len(sample_variants), len(consensus_records), len(reference_records)
+        per_variant = n_consensus * n_reference
+        variant_index = np.repeat(np.arange(len(variants), len(variants) + n_variants), per_variant)
+        checks.append((
+            variant_index,
+            np.tile(np.repeat(consensus_rows, n_reference), n_variants),
+            np.tile(np.arange(n_reference), n_variants * n_consensus),
+            np.repeat(np.array([variant[0] for variant in sample_variants], dtype=np.int64), per_variant),
+            np.repeat(offsets[:, 0], per_variant),
+            np.repeat(offsets[:, 1], per_variant)
+            ))
+        sample_checks.append((sample, len(variant_index)))
+        variants.extend(sample_variants)
+
+    with profiler.stage("load consensus"):
+        consensus = sequence_matrix(consensus_sequences)
+    checks = [np.concatenate([sample_check[column] for sample_check in checks]) if checks else np.zeros(0, dtype=np.int64) for column in range(6)]
+    literals = (sequence_matrix([variant[1].encode() for variant in variants]), sequence_matrix([variant[2].encode() for variant in variants]))
+
+    rows = []
+    with profiler.stage("check variants"):
+        for start in range(0, len(checks[0]), batch_size):
+            batch = [column[start:start + batch_size] for column in checks]
+            intervals, variant_match, context_match = compare_variants_matrix(batch, consensus, reference, literals, window)
+            for index, (ref_interval, cons_interval), variant_matched, context_matched in zip(batch[0], intervals, variant_match, context_match):
+                pos, ref, alt, alt_freq, alt_dp = variants[index]
+                rows.append([str(pos), ref, alt, alt_freq, alt_dp, ref_interval.decode(), cons_interval.decode(), str(bool(variant_matched)), str(bool(context_matched))])
+
+    results = []
+    start = 0
+    for sample, count in sample_checks:
+        results.append((sample, rows[start:start + count], size_ok[sample]))
+        start += count
+    return results
+
+def concordance_summary(results):
+    """
+    Returns the lines of the per-sample concordance summary
+    """
+    lines = ["sample\tconsensus_length_ok\tchecks\tvariant_mismatches\tcontext_mismatches\tvariant_concordance"]
+    for sample, rows, size_ok in results:
+        variant_mismatches = sum(1 for row in rows if row[7] == "False")
+        context_mismatches = sum(1 for row in rows if row[8] == "False")
+        concordance = "%.4f" % (1 - variant_mismatches / float(len(rows))) if rows else "NA"
+        lines.append("%s\t%s\t%i\t%i\t%i\t%s" % (sample, size_ok, len(rows), variant_mismatches, context_mismatches, concordance))
+    return lines
+
+def recurrent_mismatches(results, min_samples=2):
+    """
+    Returns the lines of the variants (POS, REF, ALT) not matching the consensus in at least min_samples samples
+    """
+    mismatches = {}
+    for sample, rows, _ in results:
+        for row in rows:
+            if row[7] == "False":
+                samples = mismatches.setdefault((int(row[0]), row[1], row[2]), [])
+                if sample not in samples:
+                    samples.append(sample)
+    lines = ["POS\tREF\tALT\tSAMPLES\tSAMPLE_NAMES"]
+    for (pos, ref, alt), samples in sorted(mismatches.items()):
+        if len(samples) >= min_samples:
+            lines.append("%i\t%s\t%s\t%i\t%s" % (pos, ref, alt, len(samples), ",".join(samples)))
+    return lines
+
+def run_main(args):
+    """
+    Run mode: checks all the samples of a manifest and writes their tsv and the run concordance summary
+    """
+    profiler = StageProfiler(args.profile, "check_variant_in_fa")
+    samples = read_manifest(args.manifest)
+    results = check_run(samples, args.reference, args.window, profiler)
+    with profiler.stage("write output"):
+        if not os.path.isdir(args.output_dir):
+            os.makedirs(args.output_dir)
+        for sample, rows, _ in results:
+            with open(os.path.join(args.output_dir, sample + RUN_OUTPUT_SUFFIX), 'w') as output:
+                write_variants(rows, args.window, output)
+        args.output.write("\n".join(concordance_summary(results)) + "\n")
+        args.output.flush()
+        with open(args.recurrent or os.path.join(args.output_dir, "recurrent_mismatches.tsv"), 'w') as output:
+            output.write("\n".join(recurrent_mismatches(results, args.min_samples)) + "\n")
+    profiler.extra['samples'] = len(samples)
+    profiler.write()
+
 def main():
     """
     main
     """
     args = parse_args()
+    if args.manifest:
+        run_main(args)
+        return
+    profiler = StageProfiler(args.profile, "check_variant_in_fa", os.path.basename(args.consensus).split(".")[0])
 
-    check_consensus_size(args.consensus, args.reference)
-
-    variants_list = check_variants(args.vcf, args.consensus, args.reference, args.window)
-    print("POS\tREF\tALT\tALT_FREQ\tALT_DEPTH\tREF+-{window_size}\tCONSENSUS+-{window_size}\tVARIANT_MATCH_CONSENSUS\tCONTEXT_MATCH+-{window_size}".format(window_size=args.window))
-    print("\n".join("\t".join(variant) for variant in variants_list))
+    with profiler.stage("load consensus"):
+        consensus_records = load_fasta(args.consensus)
+    with profiler.stage("check consensus size"):
+        check_consensus_size(args.consensus, args.reference, consensus_records)
+    with profiler.stage("load reference"):
+        reference_records = load_fasta(args.reference)
+    with profiler.stage("read VCF"):
+        variants = list(read_variants(args.vcf))
+    with profiler.stage("check variants"):
+        variants_list = compare_variants(variants, consensus_records, reference_records, args.window)
+    with profiler.stage("write output"):
+        write_variants(variants_list, args.window, args.output)
+        args.output.flush()
+    profiler.extra['variants'] = len(variants)
+    profiler.write()
 
     # TODO: add a flag for context match and variant match
 
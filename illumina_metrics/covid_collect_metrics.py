@@ -0,0 +1,598 @@
+#!/usr/bin/env python
+
+"""
+Gathers metrics for covseq pipeline from GenPipes, in-process replacement of the per-sample loop of covid_collect_metrics.sh.
+
+For each sample of the readset file, parses the QUAST reports of the ivar and freebayes consensus, the cutadapt logs,
+the host removal bams index (read directly from the .bai, see bam_index_stats.py), the kraken2 reports, the flagstat files, the BedGraph coverage and the Picard insert
+size metrics, then writes metrics.csv, metrics_freebayes.csv, host_contamination_metrics.tsv, host_removed_metrics.tsv
+and kraken2_metrics.tsv in <GENPIPES_OUTPUT_PATH>/metrics with the same columns and NULL conventions as the shell script.
+Samples are processed in parallel. Input paths are relative to the current directory, as in the shell script.
+Per-sample results are cached in <GENPIPES_OUTPUT_PATH>/metrics/metrics_cache.sqlite (see common/metrics_cache.py), so a
+re-run only re-parses the samples whose input files changed.
+With --consensus_metrics fasta, the consensus metrics are computed from the consensus fasta files (see
+common/consensus_qc.py) instead of being parsed from the QUAST reports, and the consensus N runs and ambiguous bases
+are written in <GENPIPES_OUTPUT_PATH>/metrics/consensus_qc.tsv.
+With --primer_bed, the mean and median depth of each amplicon are computed from the BedGraph coverage and the samples x
+amplicons depth and dropout matrices are written in <GENPIPES_OUTPUT_PATH>/metrics (see common/amplicon_coverage.py).
+"""
+
+import os
+import re
+import sys
+import glob
+import fnmatch
+import argparse
+import multiprocessing
+
+import bam_index_stats
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "common"))
+from metrics_cache import MetricsCache
+import amplicon_coverage
+import consensus_qc
+
+from decimal import Decimal, ROUND_DOWN, getcontext
+
+getcontext().prec = 60
+
+GENOME_SIZE = 29903
+COVERAGE_THRESHOLDS = [20, 50, 100, 250, 500, 1000, 2000]
+
+METRICS_HEADER = "sample,cons.per.N,cons.len,cons.perc.GC,cons.perc.genome_frac,cons.N_per_100_kbp,fq.trim.pass,bam.perc.align,bam.filter.pass,bam.primertrim.pass,bam.mean.cov,bam.med.cov,bam.max-min/mean.cov,bam.perc.20x,bam.perc.50x,bam.perc.100x,bam.perc.250x,bam.perc.500x,bam.perc.1000x,bam.perc.2000x,bam.mean.insertsize,bam.med.insertsize,bam.sd.insertsize,bam.min.insertsize,bam.max.insertsize"
+HOST_METRICS_HEADER = "Sample\tTotal_aligned\tHuman_only\tHuman_only_perc\tSARS_only\tSARS_only_perc\tUnmapped_only\tUnmapped_only_perc"
+KRAKEN_METRICS_HEADER = "Sample\tHomo_sapiens_clade\tHomo_sapiens_clade_perc"
+
+QUAST_TSV_PATTERNS = {
+    'cons_len': re.compile(r"Total length \(>= 0 bp\)\t(.*)$"),
+    'cons_GC': re.compile(r"^GC \(%\)\t(.*)$"),
+    'cons_genome_frac': re.compile(r"^Genome fraction \(%\)\t(.*)$"),
+    'cons_N_perkbp': re.compile(r"^# N's per 100 kbp\t(.*)$")
+    }
+# Consensus fasta files of each caller in consensus/<SAMPLE>, the first pattern matching being used
+CONSENSUS_PATTERNS = {
+    'ivar': ["{sample}.consensus.fasta", "{sample}.consensus.*.fasta"],
+    'freebayes': ["{sample}.freebayes_calling.consensus.fasta"]
+    }
+CONSENSUS_QC_HEADER = "sample\tcaller\tfile\trecords\tlength\tN\tambiguous\tN_runs\tlongest_N_run\tGC\tgenome_fraction\tN_per_100_kbp"
+QUAST_HTML_N_PATTERN = re.compile(r"# N's\",\"quality\":\"Less is better\",\"values\":\[(.*?)(?=])")
+CUTADAPT_PATTERN = re.compile(r"Pairs written \(passing filters\):.*\((.*?)(?=%)")
+FLAGSTAT_MAPPED_PATTERN = re.compile(r"^.*\((.*?)(?=%)")
+BC_NUMBER = re.compile(r"^-?(\d+\.?\d*|\.\d+)$")
+
+# Bumped whenever the parsing changes, so rows cached by a previous version are recomputed
+CACHE_VERSION = 1
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Gathers metrics for covseq pipeline from GenPipes."
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-r',
+                        '--readset',
+                        help="readset file used for GenPipes covseq analysis.",
+                        required=True)
+
+    parser.add_argument('-o',
+                        '--output_path',
+                        help="path of GenPipes covseq output location. (Default: current directory)",
+                        default=os.getcwd())
+
+    parser.add_argument('-t',
+                        '--threads',
+                        help="Number of samples processed in parallel (Default: 1).",
+                        default=1,
+                        type=int)
+
+    parser.add_argument('-c',
+                        '--contig_map',
+                        help="tsv classifying the hybrid reference contigs as host or viral, one '<contig> <host|viral>' line per contig (Default: MN908947.3 is viral, all other contigs are host).",
+                        required=False)
+
+    parser.add_argument('--cache',
+                        help="SQLite file caching the per-sample metrics across runs (Default: <output_path>/metrics/metrics_cache.sqlite).",
+                        required=False)
+
+    parser.add_argument('--no_cache',
+                        help="Don't use the metrics cache, all the samples are parsed.",
+                        action='store_true')
+
+    parser.add_argument('-f',
+                        '--force',
+                        help="Re-parse all the samples and refresh their cached metrics.",
+                        action='store_true')
+
+    parser.add_argument('--invalidate',
+                        help="Drop the cached metrics of the given samples, or of all the samples if none is given, before collecting.",
+                        nargs='*',
+                        metavar='SAMPLE',
+                        required=False)
+
+    parser.add_argument('--hash',
+                        help="Also key the cache on the content hash of the input files, not only their size and mtime.",
+                        action='store_true')
+
+    parser.add_argument('--consensus_metrics',
+                        help="Source of the consensus length, N, GC, genome fraction and N per 100 kbp metrics: the QUAST reports or the consensus fasta files (Default: quast).",
+                        choices=['quast', 'fasta'],
+                        default='quast')
+
+    parser.add_argument('-a',
+                        '--primer_bed',
+                        help="Primer scheme BED (ARTIC format) or amplicon regions BED, writes the amplicon depth and dropout matrices in <output_path>/metrics.",
+                        required=False)
+
+    parser.add_argument('--dropout_depth',
+                        help="Mean depth under which an amplicon is a dropout (Default: %i)." % amplicon_coverage.DEFAULT_DROPOUT_DEPTH,
+                        default=amplicon_coverage.DEFAULT_DROPOUT_DEPTH,
+                        type=float)
+
+    return parser.parse_args()
+
+##########################################################################################
+# Shell tools emulation, so the values are formatted exactly as the shell script did
+
+def bc_number(text):
+    """
+    Returns the Decimal of a bc operand or None if bc would fail to parse it
+    """
+    if text is None:
+        return None
+    if not BC_NUMBER.match(text):
+        return None
+    return Decimal(text)
+
+def bc_format(value, scale):
+    """
+    Formats a Decimal the way bc prints it at the given scale: truncated, '0' for zero and no leading 0 before the decimal point
+    """
+    value = value.quantize(Decimal(1).scaleb(-scale), rounding=ROUND_DOWN)
+    if value == 0:
+        return "0"
+    text = "{:f}".format(value)
+    if text.startswith("0."):
+        text = text[1:]
+    elif text.startswith("-0."):
+        text = "-" + text[2:]
+    return text
+
+def bc_divide(numerator, denominator, scale=2, factor=1):
+    """
+    Returns what 'echo "scale=<scale>; <factor>*<numerator>/<denominator>" | bc' prints, '' when bc would fail
+    """
+    numerator = bc_number(numerator) if isinstance(numerator, str) else numerator
+    denominator = bc_number(denominator) if isinstance(denominator, str) else denominator
+    if numerator is None or denominator is None or denominator == 0:
+        return ""
+    return bc_format(factor * numerator / denominator, scale)
+
+def bc_percent(numerator, denominator):
+    """
+    Returns the printf "%.2f" of 'echo "100*<numerator>/<denominator>" | bc -l'
+    """
+    return "%.2f" % float(Decimal(bc_divide(Decimal(numerator), Decimal(denominator), scale=20, factor=100)))
+
+def awk_number(value):
+    """
+    Formats a number the way awk prints it
+    """
+    if value == int(value):
+        return "%d" % value
+    return "%.6g" % value
+
+def to_number(text):
+    """
+    Returns the numeric value awk gives to a field
+    """
+    match = re.match(r"^\s*[-+]?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?", text)
+    return float(match.group(0)) if match else 0.0
+
+def grep_values(pattern, lines):
+    """
+    Returns the output of grep -oP on the lines as captured by a shell command substitution, the matches joined by newlines
+    """
+    return "\n".join(match.group(1) for line in lines for match in pattern.finditer(line))
+
+def read_lines(path):
+    """
+    Returns the lines of a file without line endings, None if the file doesn't exist
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r') as infile:
+        return infile.read().splitlines()
+
+def first_field(path):
+    """
+    Returns the first space separated field of the first line of a file, '' if the file doesn't exist
+    """
+    lines = read_lines(path)
+    if not lines:
+        return ""
+    return lines[0].split(" ", 1)[0] if " " in lines[0] else ""
+
+##########################################################################################
+# Metrics parsing
+
+def quast_metrics(sample, caller):
+    """
+    Returns the consensus metrics parsed from the QUAST report of a caller (ivar or freebayes)
+    """
+    quast_tsv = os.path.join("metrics", "dna", sample, "quast_metrics_" + caller, "report.tsv")
+    quast_html = os.path.join("metrics", "dna", sample, "quast_metrics_" + caller, "report.html")
+    metrics = dict.fromkeys(['cons_len', 'N_count', 'cons_perc_N', 'cons_GC', 'cons_genome_frac', 'cons_N_perkbp'], "NULL")
+    if os.path.isfile(quast_tsv) and os.path.isfile(quast_html):
+        tsv_lines = read_lines(quast_tsv)
+        for key, pattern in QUAST_TSV_PATTERNS.items():
+            metrics[key] = grep_values(pattern, tsv_lines)
+        metrics['N_count'] = grep_values(QUAST_HTML_N_PATTERN, read_lines(quast_html))
+        if metrics['cons_len'] != "0":
+            metrics['cons_perc_N'] = bc_divide(metrics['N_count'], metrics['cons_len'], factor=100)
+        else:
+            metrics['cons_perc_N'] = "NULL"
+    for key in ['cons_GC', 'cons_genome_frac', 'cons_N_perkbp']:
+        if not metrics[key]:
+            metrics[key] = "NULL"
+    return metrics
+
+def consensus_file(sample, caller):
+    """
+    Returns the consensus fasta of a caller (ivar or freebayes), None if there is none
+    """
+    for pattern in CONSENSUS_PATTERNS[caller]:
+        matches = sorted(glob.glob(os.path.join("consensus", sample, pattern.format(sample=glob.escape(sample)))))
+        if matches:
+            return matches[0]
+    return None
+
+def format_optional(value, format_string):
+    return "NULL" if value is None else format_string % value
+
+def fasta_consensus_metrics(sample, caller):
+    """
+    Returns the consensus metrics of a caller computed from its consensus fasta, formatted as quast_metrics() parses them
+    The QC line of the consensus for consensus_qc.tsv is returned under 'qc_line'
+    """
+    metrics = dict.fromkeys(['cons_len', 'N_count', 'cons_perc_N', 'cons_GC', 'cons_genome_frac', 'cons_N_perkbp'], "NULL")
+    fasta_file = consensus_file(sample, caller)
+    stats = consensus_qc.run_consensus_qc([fasta_file], GENOME_SIZE)[0]
+    if stats is None:
+        metrics['qc_line'] = "\t".join([sample, caller] + ["NULL"] * 10)
+        return metrics
+    metrics['cons_len'] = "%i" % stats['length']
+    metrics['N_count'] = "%i" % stats['quast_n']
+    if stats['length']:
+        metrics['cons_perc_N'] = bc_divide(metrics['N_count'], metrics['cons_len'], factor=100)
+    metrics['cons_GC'] = format_optional(stats['gc_percent'], "%.2f")
+    metrics['cons_genome_frac'] = format_optional(stats['genome_fraction'], "%.3f")
+    metrics['cons_N_perkbp'] = format_optional(stats['n_per_100kbp'], "%.2f")
+    metrics['qc_line'] = "\t".join([sample, caller, fasta_file] + ["%i" % stats[key] for key in ['records', 'length', 'n_count', 'ambiguous', 'n_runs', 'longest_n_run']] +
+                                    [metrics['cons_GC'], metrics['cons_genome_frac'], metrics['cons_N_perkbp']])
+    return metrics
+
+def cutadapt_log(readset_name, cutadapt_logs):
+    """
+    Returns the most recent cutadapt log of a readset, as 'ls -t ... | head -n 1' does, None if there is none
+    """
+    pattern = glob.escape("cutadapt." + readset_name) + "_*[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]T[0-9][0-9].[0-9][0-9].[0-9][0-9].o"
+    matches = [os.path.join("job_output", "cutadapt", entry) for entry in fnmatch.filter(cutadapt_logs, pattern)]
+    if not matches:
+        return None
+    return sorted(matches, key=lambda path: (-os.stat(path).st_mtime, path))[0]
+
+def trimming_metrics(readset_name, cutadapt_logs):
+    """
+    Returns the percent of pairs passing cutadapt filters for a readset, '' if it can't be found
+    """
+    log = cutadapt_log(readset_name, cutadapt_logs)
+    if log is None:
+        return ""
+    return grep_values(CUTADAPT_PATTERN, read_lines(log))
+
+def first_bam(bam_pattern):
+    """
+    Returns a list holding the first bam matching a glob pattern, as samtools idxstats only reads its first argument
+    """
+    return sorted(glob.glob(bam_pattern))[:1]
+
+def host_metrics_row(sample, counts):
+    """
+    Returns the host contamination/removal tsv line of a sample
+    """
+    total, human, sars, unmapped = counts
+    if total <= 0:
+        return "%s\t%i\t%i\tNULL\t%i\tNULL\t%i\tNULL" % (sample, total, human, sars, unmapped)
+    return "%s\t%i\t%i\t%s\t%i\t%s\t%i\t%s" % (sample, total, human, bc_percent(human, total), sars, bc_percent(sars, total), unmapped, bc_percent(unmapped, total))
+
+def kraken_metrics(sample, readset_name):
+    """
+    Returns the Homo sapiens clade read count and percentage of a readset kraken2 report, None if the report is missing or empty
+    """
+    kraken_files = glob.glob(os.path.join("metrics", "dna", sample, "kraken_metrics", glob.escape(readset_name) + "*.kraken2_report"))
+    if len(kraken_files) != 1 or os.path.getsize(kraken_files[0]) == 0:
+        return None
+    for line in read_lines(kraken_files[0]):
+        if "Homo sapiens" in line:
+            fields = line.split()
+            return int(fields[1]), Decimal(fields[0])
+    return 0, Decimal(0)
+
+def flagstat_metrics(sample):
+    """
+    Returns the alignment, filtering and primer trimming metrics from the flagstat files
+    """
+    flagstat_dir = os.path.join("metrics", "dna", sample, "flagstat")
+    raw_flagstat_file = os.path.join(flagstat_dir, sample + ".sorted.flagstat")
+    filtered_flagstat_file = os.path.join(flagstat_dir, sample + ".sorted.filtered.flagstat")
+    primertrim_flagstat_file = os.path.join(flagstat_dir, sample + ".sorted.filtered.primerTrim.flagstat")
+    alignment_metrics_file = os.path.join("alignment", sample, sample + ".sorted.filtered.all.metrics.alignment_summary_metrics")
+    total_raw = first_field(raw_flagstat_file)
+    total_filter = first_field(filtered_flagstat_file)
+    if total_raw != "0" and total_filter != "0" and os.path.isfile(alignment_metrics_file):
+        bam_surviving_filter = bc_divide(total_filter, total_raw, factor=100)
+        bam_surviving_primertrim = bc_divide(first_field(primertrim_flagstat_file), total_filter, factor=100)
+    else:
+        bam_surviving_filter = "NULL"
+        bam_surviving_primertrim = "NULL"
+    raw_lines = read_lines(raw_flagstat_file) or []
+    bam_aln = grep_values(FLAGSTAT_MAPPED_PATTERN, [line for line in raw_lines if "mapped (" in line])
+    return bam_aln, bam_surviving_filter, bam_surviving_primertrim
+
+def bedgraph_metrics(sample):
+    """
+    Returns the mean, median, max-min/mean coverage and the percent of the genome above each threshold from the BedGraph
+    """
+    intervals = []
+    for line in read_lines(os.path.join("alignment", sample, sample + ".sorted.filtered.BedGraph")) or []:
+        fields = line.split()
+        if len(fields) >= 4:
+            intervals.append((int(to_number(fields[2]) - to_number(fields[1])), to_number(fields[3]), fields[3]))
+
+    bases = sum(max(length, 0) for length, _, _ in intervals)
+    bam_meancov = bc_divide(awk_number(sum(depth * max(length, 0) for length, depth, _ in intervals)) if bases else "", str(GENOME_SIZE))
+
+    # Median of the per base depths, without expanding the intervals
+    by_depth = sorted((depth, text, length) for length, depth, text in intervals if length > 0)
+    def nth_depth(n):
+        seen = 0
+        for depth, text, length in by_depth:
+            seen += length
+            if seen >= n:
+                return depth, text
+        return 0.0, ""
+    if bases % 2:
+        bam_mediancov = nth_depth((bases + 1) // 2)[1]
+    else:
+        bam_mediancov = awk_number((nth_depth(bases // 2)[0] + nth_depth(bases // 2 + 1)[0]) / 2.0) if bases else "0"
+
+    depths = [depth for _, depth, _ in intervals]
+    bam_mincov = "%i" % min(depths) if depths else ""
+    bam_maxcov = "%i" % max(depths) if depths else ""
+    if bam_meancov == "0":
+        bam_maxmincovmean = "NULL"
+    else:
+        bam_maxmincovmean = bc_divide(bc_number(bam_maxcov) - bc_number(bam_mincov) if depths else None, bam_meancov)
+
+    covered = []
+    for threshold in COVERAGE_THRESHOLDS:
+        count = sum(length for length, depth, _ in intervals if depth > threshold)
+        covered.append(bc_divide(awk_number(count), str(GENOME_SIZE), factor=100))
+    return [bam_meancov, bam_mediancov, bam_maxmincovmean] + covered
+
+def amplicon_metrics(sample, amplicons):
+    """
+    Returns the mean and median depth lists of the amplicons from the BedGraph, NaN when the BedGraph is missing
+    """
+    bedgraph_file = os.path.join("alignment", sample, sample + ".sorted.filtered.BedGraph")
+    if not os.path.isfile(bedgraph_file):
+        return [[float('nan')] * len(amplicons)] * 2
+    means, medians = amplicon_coverage.amplicon_depths(amplicon_coverage.bedgraph_depth(bedgraph_file, GENOME_SIZE), amplicons)
+    return [means.tolist(), medians.tolist()]
+
+def insert_size_metrics(sample):
+    """
+    Returns the mean, median, sd, min and max insert size from the Picard insert size metrics
+    """
+    lines = read_lines(os.path.join("metrics", "dna", sample, "picard_metrics", sample + ".sorted.all.metrics.insert_size_metrics"))
+    if lines is None:
+        return ["NULL"] * 5
+    fields = lines[7].split() if len(lines) >= 8 else []
+    field = lambda index: fields[index - 1] if len(fields) >= index else ""
+    bam_meaninsertsize = bc_divide(field(6).replace(",", ""), "1")
+    bam_sdinsertsize = field(7)
+    if bam_sdinsertsize != "?":
+        bam_sdinsertsize = bc_divide(bam_sdinsertsize.replace(",", ""), "1")
+    else:
+        bam_sdinsertsize = "NULL"
+    return [bam_meaninsertsize, field(1), bam_sdinsertsize, field(4), field(5)]
+
+def sample_inputs(sample, readset_names, cutadapt_logs, consensus_metrics='quast'):
+    """
+    Returns the input files the metrics of a sample are parsed from, used to key the metrics cache
+    """
+    inputs = []
+    for caller in ["ivar", "freebayes"]:
+        if consensus_metrics == 'fasta':
+            inputs.append(consensus_file(sample, caller))
+            continue
+        quast_dir = os.path.join("metrics", "dna", sample, "quast_metrics_" + caller)
+        inputs.extend([os.path.join(quast_dir, "report.tsv"), os.path.join(quast_dir, "report.html")])
+    for readset_name in readset_names:
+        inputs.append(cutadapt_log(readset_name, cutadapt_logs))
+        readset_prefix = os.path.join("host_removal", sample, glob.escape(readset_name))
+        for bam_file in first_bam(readset_prefix + "*.hybrid.sorted.bam") + first_bam(readset_prefix + "*.host_removed.sorted.bam"):
+            inputs.extend([bam_file, bam_index_stats.find_index(bam_file)])
+        inputs.extend(glob.glob(os.path.join("metrics", "dna", sample, "kraken_metrics", glob.escape(readset_name) + "*.kraken2_report")))
+    flagstat_dir = os.path.join("metrics", "dna", sample, "flagstat")
+    inputs.extend(os.path.join(flagstat_dir, sample + suffix) for suffix in [".sorted.flagstat", ".sorted.filtered.flagstat", ".sorted.filtered.primerTrim.flagstat"])
+    inputs.append(os.path.join("alignment", sample, sample + ".sorted.filtered.all.metrics.alignment_summary_metrics"))
+    inputs.append(os.path.join("alignment", sample, sample + ".sorted.filtered.BedGraph"))
+    inputs.append(os.path.join("metrics", "dna", sample, "picard_metrics", sample + ".sorted.all.metrics.insert_size_metrics"))
+    return inputs
+
+def sample_metrics(task):
+    """
+    Returns the lines of the 5 metrics files for one sample
+    """
+    sample, readset_names, cutadapt_logs, viral_contigs, amplicons, consensus_metrics = task
+
+    if consensus_metrics == 'fasta':
+        ivar = fasta_consensus_metrics(sample, "ivar")
+        freebayes = fasta_consensus_metrics(sample, "freebayes")
+    else:
+        ivar = quast_metrics(sample, "ivar")
+        freebayes = quast_metrics(sample, "freebayes")
+
+    trimming = []
+    hybrid_bams = []
+    host_removed_bams = []
+    homo_sapiens_clade = 0
+    homo_sapiens_clade_perc = Decimal(0)
+    kraken_missing = False
+    for readset_name in readset_names:
+        trimming.append(trimming_metrics(readset_name, cutadapt_logs))
+        readset_prefix = os.path.join("host_removal", sample, glob.escape(readset_name))
+        hybrid_bams.extend(first_bam(readset_prefix + "*.hybrid.sorted.bam"))
+        host_removed_bams.extend(first_bam(readset_prefix + "*.host_removed.sorted.bam"))
+        kraken = kraken_metrics(sample, readset_name)
+        if kraken is None:
+            kraken_missing = True
+        else:
+            homo_sapiens_clade += kraken[0]
+            homo_sapiens_clade_perc += kraken[1]
+
+    # A single readset keeps its cutadapt value as is, several readsets are averaged
+    trimming = [value for value in trimming if value]
+    if len(trimming) == 1:
+        fq_surviving_trim = trimming[0]
+    elif trimming and all(bc_number(value) is not None for value in trimming):
+        fq_surviving_trim = bc_divide(sum(bc_number(value) for value in trimming), str(len(trimming)))
+    else:
+        fq_surviving_trim = "0"
+
+    if kraken_missing:
+        kraken_row = "%s\tNULL\tNULL" % sample
+    else:
+        kraken_row = "%s\t%i\t%s" % (sample, homo_sapiens_clade, "%.2f" % float(Decimal(bc_divide(homo_sapiens_clade_perc, Decimal(len(readset_names)), scale=20))))
+
+    bam_aln, bam_surviving_filter, bam_surviving_primertrim = flagstat_metrics(sample)
+    bam_metrics = [fq_surviving_trim, bam_aln, bam_surviving_filter, bam_surviving_primertrim] + bedgraph_metrics(sample) + insert_size_metrics(sample)
+
+    consensus_keys = ['cons_perc_N', 'cons_len', 'cons_GC', 'cons_genome_frac', 'cons_N_perkbp']
+    result = {
+        'ivar': ",".join([sample] + [ivar[key] for key in consensus_keys] + bam_metrics),
+        'freebayes': ",".join([sample] + [freebayes[key] for key in consensus_keys] + bam_metrics),
+        'host_contamination': host_metrics_row(sample, bam_index_stats.host_counts(hybrid_bams, viral_contigs)),
+        'host_removed': host_metrics_row(sample, bam_index_stats.host_counts(host_removed_bams, viral_contigs)),
+        'kraken': kraken_row
+        }
+    if amplicons:
+        result['amplicons'] = amplicon_metrics(sample, amplicons)
+    if consensus_metrics == 'fasta':
+        result['consensus_qc'] = "\n".join([ivar['qc_line'], freebayes['qc_line']])
+    return result
+
+def read_readset(readset_file):
+    """
+    Returns the samples of the readset file and, for each sample, the readsets of the lines where it appears as a word
+    """
+    with open(readset_file, 'r') as infile:
+        lines = infile.read().splitlines()
+    samples = [line.split()[0] for line in lines[1:] if line.split()]
+    readsets = {}
+    for sample in set(samples):
+        word = re.compile(r"(?<![A-Za-z0-9_])" + re.escape(sample) + r"(?![A-Za-z0-9_])")
+        readsets[sample] = [line.split()[1] for line in lines if word.search(line) and len(line.split()) > 1]
+    return samples, readsets
+
+def collect_metrics(readset_file, output_path, threads=1, viral_contigs=bam_index_stats.VIRAL_CONTIGS, cache=None, amplicons=None,
+                    dropout_depth=amplicon_coverage.DEFAULT_DROPOUT_DEPTH, consensus_metrics='quast'):
+    """
+    Collects the metrics of all the samples of the readset file and writes the metrics files in <output_path>/metrics
+    With a MetricsCache, only the samples whose inputs changed since they were cached are parsed
+    With amplicons, the amplicon depth and dropout matrices are also written
+    With consensus_metrics 'fasta', the consensus metrics are computed from the consensus fasta files and consensus_qc.tsv is written
+    """
+    samples, readsets = read_readset(readset_file)
+    cutadapt_dir = os.path.join("job_output", "cutadapt")
+    cutadapt_logs = os.listdir(cutadapt_dir) if os.path.isdir(cutadapt_dir) else []
+
+    sample_results = {}
+    fingerprints = {}
+    tasks = []
+    # The amplicons and the fasta consensus metrics only key the cache when used, so the rows cached without them stay valid
+    params = [CACHE_VERSION, viral_contigs] + ([amplicons] if amplicons else []) + ([consensus_metrics] if consensus_metrics != 'quast' else [])
+    for sample in dict.fromkeys(samples):
+        if cache is not None:
+            fingerprints[sample] = cache.fingerprint(sample_inputs(sample, readsets[sample], cutadapt_logs, consensus_metrics), params)
+            cached = cache.get(sample, fingerprints[sample])
+            if cached is not None:
+                sample_results[sample] = cached
+                continue
+        tasks.append((sample, readsets[sample], cutadapt_logs, viral_contigs, amplicons, consensus_metrics))
+
+    pool = multiprocessing.Pool(threads) if threads > 1 and len(tasks) > 1 else None
+    try:
+        # Samples are cached as they are parsed, so a killed collection doesn't parse them again
+        results = pool.imap(sample_metrics, tasks, chunksize=1) if pool else map(sample_metrics, tasks)
+        for task, result in zip(tasks, results):
+            sample_results[task[0]] = result
+            if cache is not None:
+                cache.put(task[0], fingerprints[task[0]], result)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    results = [sample_results[sample] for sample in samples]
+
+    outputs = [
+        ('metrics.csv', METRICS_HEADER, 'ivar'),
+        ('metrics_freebayes.csv', METRICS_HEADER, 'freebayes'),
+        ('host_contamination_metrics.tsv', HOST_METRICS_HEADER, 'host_contamination'),
+        ('host_removed_metrics.tsv', HOST_METRICS_HEADER, 'host_removed'),
+        ('kraken2_metrics.tsv', KRAKEN_METRICS_HEADER, 'kraken')
+        ]
+    for filename, header, key in outputs:
+        with open(os.path.join(output_path, "metrics", filename), 'w') as outfile:
+            outfile.write(header + "\n")
+            outfile.writelines(result[key] + "\n" for result in results)
+    if consensus_metrics == 'fasta':
+        with open(os.path.join(output_path, "metrics", "consensus_qc.tsv"), 'w') as outfile:
+            outfile.write(CONSENSUS_QC_HEADER + "\n")
+            outfile.writelines(sample_results[sample]['consensus_qc'] + "\n" for sample in dict.fromkeys(samples))
+    if amplicons:
+        amplicon_coverage.write_amplicon_matrices(os.path.join(output_path, "metrics"), amplicons,
+                                                  [(sample, sample_results[sample]['amplicons'][0], sample_results[sample]['amplicons'][1]) for sample in dict.fromkeys(samples)],
+                                                  dropout_depth)
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    try:
+        amplicons = amplicon_coverage.read_amplicons(args.primer_bed) if args.primer_bed else None
+    except ValueError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        sys.exit(1)
+    viral_contigs = bam_index_stats.read_contig_map(args.contig_map) if args.contig_map else bam_index_stats.VIRAL_CONTIGS
+    cache = None
+    if not args.no_cache:
+        cache = MetricsCache(args.cache or os.path.join(args.output_path, "metrics", "metrics_cache.sqlite"), "illumina", args.hash, args.force)
+        if args.invalidate is not None:
+            dropped = cache.invalidate(args.invalidate or None)
+            sys.stderr.write("Metrics cache: %i cached samples invalidated\n" % dropped)
+    try:
+        collect_metrics(args.readset, args.output_path, args.threads, viral_contigs, cache, amplicons, args.dropout_depth, args.consensus_metrics)
+    finally:
+        if cache is not None:
+            cache.close()
+    if cache is not None:
+        sys.stderr.write(cache.stats() + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,22 +6,82 @@ Convert iVar variants tsv file to vcf format. Based on nf-core-viralrecon https:
 
 import os
 import sys
-import re
 import errno
 import argparse
+import multiprocessing
+
+from variant_reader import is_ivar_tsv, read_ivar_tsv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "common"))
+from stage_profiler import StageProfiler
+
+VCF_FORMAT = 'GT:ref_DP:ref_RV:ref_QUAL:alt_DP:alt_RV:alt_QUAL:alt_FREQ'
+VARIANT_TYPES = ['DEL', 'INS', 'SNP']
 
 def parse_args(args=None):
     """
     Arguments parsing
     """
     description = "Convert iVar variants tsv file to vcf format."
-    epilog = """Example usage: python ivar_variants_to_vcf.py <FILE_IN> <FILE_OUT>"""
+    epilog = """Example usage: python ivar_variants_to_vcf.py <FILE_IN> <FILE_OUT>
+Streaming usage: cat <FILE_IN> | python ivar_variants_to_vcf.py - - > <FILE_OUT>
+Batch usage: python ivar_variants_to_vcf.py --batch <TSV_DIR_OR_MANIFEST> --output_dir <DIR> --threads 8 --bgzip --merged run.vcf.gz --counts run.variants_count.tsv"""
 
-    parser = argparse.ArgumentParser(description=description, epilog=epilog)
-    parser.add_argument('FILE_IN', help="Input tsv file.")
-    parser.add_argument('FILE_OUT', help="Full path to output vcf file")
+    parser = argparse.ArgumentParser(description=description, epilog=epilog, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('FILE_IN', nargs='?', help="Input tsv file ('-' for stdin).")
+    parser.add_argument('FILE_OUT', nargs='?', help="Full path to output vcf file ('-' for stdout, variant counts are then written to stderr)")
+    parser.add_argument('-s',
+                        '--sample',
+                        help="Sample name used in the vcf header when reading from stdin (Default: stdin)",
+                        default="stdin")
+    parser.add_argument('-b',
+                        '--batch',
+                        help="Directory searched recursively for iVar tsv files (as the GenPipes variant/<SAMPLE>/ directories) or manifest file listing one iVar tsv path per line. Converts all of them in one process pool.")
+    parser.add_argument('-d',
+                        '--output_dir',
+                        help="Batch mode: directory where the vcf files are written (Default: next to each tsv)")
+    parser.add_argument('-t',
+                        '--threads',
+                        help="Batch mode: number of worker processes (Default: 1)",
+                        default=1,
+                        type=int)
+    parser.add_argument('-z',
+                        '--bgzip',
+                        help="Batch mode: write bgzip compressed and tabix indexed vcf files (requires pysam)",
+                        action='store_true')
+    parser.add_argument('-m',
+                        '--merged',
+                        help="Batch mode: path of a merged multi-sample run vcf (bgzip compressed and indexed if the path ends with .gz)")
+    parser.add_argument('-n',
+                        '--counts',
+                        help="Batch mode: path of the consolidated SNP/INS/DEL count table (Default: stdout)")
+    parser.add_argument('-f',
+                        '--failures',
+                        help="Batch mode: tsv listing the iVar tsv files that could not be converted along with the error")
+    parser.add_argument('--profile',
+                        help="Append the wall time, CPU time and peak memory of each stage of the run as a JSON line to this file")
 
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if parsed.batch:
+        if parsed.FILE_IN or parsed.FILE_OUT:
+            parser.error("FILE_IN and FILE_OUT can't be used with --batch")
+    elif not (parsed.FILE_IN and parsed.FILE_OUT):
+        parser.error("FILE_IN and FILE_OUT are required unless --batch is used")
+    elif (parsed.FILE_IN == '-') != (parsed.FILE_OUT == '-'):
+        parser.error("streaming mode requires both FILE_IN and FILE_OUT to be '-'")
+    if (parsed.bgzip or (parsed.merged and parsed.merged.endswith(".gz"))) and not pysam_available():
+        parser.error("bgzip compression and tabix indexing require pysam")
+    return parsed
+
+def pysam_available():
+    """
+    Returns True if pysam can be imported
+    """
+    try:
+        import pysam
+    except ImportError:
+        return False
+    return True
 
 def make_dir(path):
     """
@@ -34,11 +94,10 @@ def make_dir(path):
             if exception.errno != errno.EEXIST:
                 raise
 
-def ivar_variants_to_vcf(input_file, output_file):
+def vcf_header(sample_names, merged=False):
     """
-    Converting ivar variants tsv to vcf
+    Returns the vcf header for the given sample columns
     """
-    filename = os.path.splitext(input_file)[0]
     header = ('##fileformat=VCFv4.2\n'
               '##source=iVar\n'
               '##INFO=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n'
@@ -52,47 +111,205 @@ def ivar_variants_to_vcf(input_file, output_file):
               '##FORMAT=<ID=alt_RV,Number=1,Type=Integer,Description="Deapth of alternate base on reverse reads">\n'
               '##FORMAT=<ID=alt_QUAL,Number=1,Type=String,Description="Mean quality of alternate base">\n'
               '##FORMAT=<ID=alt_FREQ,Number=1,Type=String,Description="Frequency of alternate base">\n')
-    header += '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + filename + '\n'
+    if merged:
+        header += ('##INFO=<ID=NS,Number=1,Type=Integer,Description="Number of samples carrying the variant">\n'
+                   '##FORMAT=<ID=FT,Number=1,Type=String,Description="Sample filter, PASS or FAIL">\n'
+                   '##FORMAT=<ID=DP,Number=1,Type=Integer,Description="Total Depth">\n')
+    header += '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t' + '\t'.join(sample_names) + '\n'
+    return header
+
+def convert_variants(in_file, variants_count_dict):
+    """
+    Yields (CHROM, POS, REF, ALT, FILTER, TOTAL_DP, SAMPLE) tuples from an opened iVar variants tsv, counting variants by type
+    """
+    for variant in read_ivar_tsv(in_file):
+        ref = variant.ref
+        alt = variant.alt
+        variant_type = variant.variant_type
+        if variant_type == 'INS':
+            alt = ref + alt[1:]
+        elif variant_type == 'DEL':
+            ref += alt[1:]
+            alt = variant.ref
+        variants_count_dict[variant_type] += 1
+        if variant.pass_test == 'TRUE':
+            filter = 'PASS'
+        else:
+            filter = 'FAIL'
+        sample = ':'.join(('1', variant.ref_dp, variant.ref_rv, variant.ref_qual, variant.alt_dp, variant.alt_rv, variant.alt_qual, variant.alt_freq))
+        yield (variant.chrom, variant.pos, ref, alt, filter, variant.total_dp, sample)
 
+def write_vcf(in_file, out_file, sample_name, records=None):
+    """
+    Writes the vcf converted from an opened iVar variants tsv and returns the variant counts
+    Converted records are also appended to records when a list is given
+    """
     variants_count_dict = {'SNP':0, 'INS':0, 'DEL':0}
+    out_file.write(vcf_header([sample_name]))
+    for chrom, pos, ref, alt, filter, total_dp, sample in convert_variants(in_file, variants_count_dict):
+        out_file.write('\t'.join((chrom, pos, '.', ref, alt, '.', filter, 'DP=' + total_dp, VCF_FORMAT, sample)) + '\n')
+        if records is not None:
+            records.append((chrom, int(pos), ref, alt, filter, total_dp, sample))
+    return variants_count_dict
+
+def variants_count_table(counts):
+    """
+    Returns the variant count table lines for a list of (sample, variants_count_dict)
+    """
+    lines = ['\t'.join(['sample'] + VARIANT_TYPES)]
+    for sample, variants_count_dict in counts:
+        lines.append('\t'.join([sample] + [str(variants_count_dict[variant]) for variant in VARIANT_TYPES]))
+    return lines
+
+def ivar_variants_to_vcf(input_file, output_file, profiler=None):
+    """
+    Converting ivar variants tsv to vcf
+    """
+    profiler = profiler or StageProfiler()
+    filename = os.path.splitext(input_file)[0]
 
     make_dir(os.path.dirname(output_file))
 
-    with open(input_file, 'r') as in_file, open(output_file, 'w') as out_file:
-        out_file.write(header)
-        next(in_file)
-        for line in in_file:
-            line = re.split("\t", line)
-            chrom = line[0]
-            pos = line[1]
-            id = '.'
-            ref = line[2]
-            alt = line[3]
-            if alt[0] == '+':
-                alt = ref + alt[1:]
-                variants_count_dict['INS'] += 1
-            elif alt[0] == '-':
-                ref += alt[1:]
-                alt = line[2]
-                variants_count_dict['DEL'] += 1
-            else:
-                variants_count_dict['SNP'] += 1
-            qual = '.'
-            pass_test = line[13]
-            if pass_test == 'TRUE':
-                filter = 'PASS'
-            else:
-                filter = 'FAIL'
-            info = 'DP=' + line[11]
-            format = 'GT:ref_DP:ref_RV:ref_QUAL:alt_DP:alt_RV:alt_QUAL:alt_FREQ'
-            sample = '1:' + line[4] + ':' + line[5] + ':' + line[6] + ':' + line[7] + ':' + line[8] + ':' + line[9] + ':' + line[10]
-            line = chrom + '\t' + pos + '\t' + id + '\t' + ref + '\t' + alt + '\t' + qual + '\t' + filter + '\t' + info + '\t' + format + '\t' + sample + '\n'
-            out_file.write(line)
+    # The tsv is converted line by line, reading and writing make up a single stage
+    with profiler.stage("convert variants"):
+        with open(input_file, 'r') as in_file, open(output_file, 'w') as out_file:
+            variants_count_dict = write_vcf(in_file, out_file, filename)
 
     ## Print variant counts
-    variants_count_list = [(variant, str(count)) for variant, count in sorted(variants_count_dict.items())]
-    print('\t'.join(['sample'] + [x[0] for x in variants_count_list]))
-    print('\t'.join([filename] + [x[1] for x in variants_count_list]))
+    with profiler.stage("write counts"):
+        print('\n'.join(variants_count_table([(filename, variants_count_dict)])))
+
+def stream_variants_to_vcf(sample_name, profiler=None):
+    """
+    Converting ivar variants tsv from stdin to vcf on stdout, the variant counts are written to stderr
+    """
+    profiler = profiler or StageProfiler()
+    with profiler.stage("convert variants"):
+        variants_count_dict = write_vcf(sys.stdin, sys.stdout, sample_name)
+    sys.stderr.write('\n'.join(variants_count_table([(sample_name, variants_count_dict)])) + '\n')
+
+def index_vcf(vcf_file):
+    """
+    Compresses a plain text vcf with bgzip, indexes it with tabix and returns the compressed file path
+    """
+    import pysam
+    return pysam.tabix_index(vcf_file, preset='vcf', force=True, keep_original=False)
+
+def list_batch_inputs(batch):
+    """
+    Returns the iVar tsv files found recursively in a directory or listed in a manifest file (one path per line, '#' lines are skipped)
+    In a directory, the tsv files that are not iVar variants tsv files are skipped with a warning
+    """
+    if os.path.isdir(batch):
+        input_files = []
+        for root, dirs, names in os.walk(batch):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if not name.endswith(".tsv"):
+                    continue
+                if is_ivar_tsv(path):
+                    input_files.append(path)
+                else:
+                    sys.stderr.write("WARNING: %s is not an iVar variants tsv, skipped\n" % path)
+        return input_files
+    with open(batch, 'r') as manifest:
+        return [line.strip() for line in manifest if line.strip() and not line.startswith("#")]
+
+def batch_output_path(input_file, output_dir):
+    """
+    Returns the vcf path of an iVar tsv in batch mode
+    """
+    output_file = os.path.splitext(input_file)[0] + ".vcf"
+    if output_dir:
+        output_file = os.path.join(output_dir, os.path.basename(output_file))
+    return output_file
+
+def convert_one(task):
+    """
+    Batch worker: converts one iVar tsv and returns its sample name, variant counts, vcf path, records to merge and None,
+    or its sample name, None, None, None and the error message when it can't be converted, no partial vcf being left
+    """
+    input_file, output_dir, bgzip, keep_records = task
+    filename = os.path.splitext(input_file)[0]
+    output_file = batch_output_path(input_file, output_dir)
+    try:
+        if not is_ivar_tsv(input_file):
+            raise ValueError("not an iVar variants tsv")
+        make_dir(os.path.dirname(output_file))
+        records = [] if keep_records else None
+        with open(input_file, 'r') as in_file, open(output_file, 'w') as out_file:
+            variants_count_dict = write_vcf(in_file, out_file, filename, records)
+        if bgzip:
+            output_file = index_vcf(output_file)
+        return filename, variants_count_dict, output_file, records, None
+    except Exception as exception:
+        for path in (output_file, output_file + ".gz", output_file + ".gz.tbi"):
+            if os.path.isfile(path):
+                os.remove(path)
+        return filename, None, None, None, "%s: %s" % (type(exception).__name__, exception)
+
+def write_merged_vcf(samples, merged_file):
+    """
+    Writes a multi-sample vcf with one column per sample from the converted records of each sample
+    A site is keyed by CHROM, POS, REF and ALT, samples without the variant get a missing '.' column
+    """
+    sites = {}
+    for index, (_, records) in enumerate(samples):
+        for chrom, pos, ref, alt, filter, total_dp, sample in records:
+            site = sites.setdefault((chrom, pos, ref, alt), {})
+            # iVar reports a variant once per overlapping GFF feature, keep the first occurence
+            if index not in site:
+                site[index] = (sample + ':' + filter + ':' + total_dp, filter)
+
+    compress = merged_file.endswith(".gz")
+    plain_file = merged_file[:-3] if compress else merged_file
+    make_dir(os.path.dirname(plain_file))
+    with open(plain_file, 'w') as out_file:
+        out_file.write(vcf_header([os.path.basename(sample_name) for sample_name, _ in samples], merged=True))
+        for (chrom, pos, ref, alt), site in sorted(sites.items()):
+            columns = [site[index][0] if index in site else '.' for index in range(len(samples))]
+            filter = 'PASS' if any(sample_filter == 'PASS' for _, sample_filter in site.values()) else 'FAIL'
+            out_file.write('\t'.join([chrom, str(pos), '.', ref, alt, '.', filter, 'NS=' + str(len(site)), VCF_FORMAT + ':FT:DP'] + columns) + '\n')
+    if compress:
+        index_vcf(plain_file)
+
+def batch_variants_to_vcf(input_files, output_dir=None, threads=1, bgzip=False, merged_file=None, counts_file=None, profiler=None):
+    """
+    Converting a batch of ivar variants tsv to vcf across a process pool
+    Writes the consolidated variant counts table and optionally a merged run vcf of the converted files, returns the written
+    vcf paths and the (iVar tsv, error message) of the files that could not be converted, without stopping the batch
+    The memory of the worker processes is not traced when profiling with threads > 1
+    """
+    profiler = profiler or StageProfiler()
+    tasks = [(input_file, output_dir, bgzip, merged_file is not None) for input_file in input_files]
+    with profiler.stage("convert samples"):
+        if threads > 1:
+            pool = multiprocessing.Pool(threads)
+            try:
+                results = pool.map(convert_one, tasks, chunksize=max(1, len(tasks) // (threads * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [convert_one(task) for task in tasks]
+    failures = [(input_file, error) for input_file, (_, _, _, _, error) in zip(input_files, results) if error is not None]
+    results = [result for result in results if result[4] is None]
+
+    with profiler.stage("write counts"):
+        count_lines = variants_count_table([(filename, variants_count_dict) for filename, variants_count_dict, _, _, _ in results])
+        if counts_file:
+            make_dir(os.path.dirname(counts_file))
+            with open(counts_file, 'w') as out_file:
+                out_file.write('\n'.join(count_lines) + '\n')
+        else:
+            print('\n'.join(count_lines))
+
+    if merged_file:
+        with profiler.stage("write merged VCF"):
+            write_merged_vcf([(filename, records) for filename, _, _, records, _ in results], merged_file)
+
+    return [output_file for _, _, output_file, _, _ in results], failures
 
 
 def main(args=None):
@@ -100,7 +317,26 @@ def main(args=None):
     main function
     """
     args = parse_args(args)
-    ivar_variants_to_vcf(args.FILE_IN, args.FILE_OUT)
+    if args.batch:
+        profiler = StageProfiler(args.profile, "ivar_variants_to_vcf")
+        with profiler.stage("list inputs"):
+            input_files = list_batch_inputs(args.batch)
+        profiler.extra['samples'] = len(input_files)
+        _, failures = batch_variants_to_vcf(input_files, args.output_dir, args.threads, args.bgzip, args.merged, args.counts, profiler)
+        for input_file, error in failures:
+            sys.stderr.write("WARNING: %s could not be converted (%s)\n" % (input_file, error))
+        if args.failures:
+            make_dir(os.path.dirname(args.failures))
+            with open(args.failures, 'w') as out_file:
+                out_file.write("input\terror\n")
+                out_file.writelines("%s\t%s\n" % failure for failure in failures)
+    elif args.FILE_IN == '-' and args.FILE_OUT == '-':
+        profiler = StageProfiler(args.profile, "ivar_variants_to_vcf", args.sample)
+        stream_variants_to_vcf(args.sample, profiler)
+    else:
+        profiler = StageProfiler(args.profile, "ivar_variants_to_vcf", os.path.basename(args.FILE_IN).split(".")[0])
+        ivar_variants_to_vcf(args.FILE_IN, args.FILE_OUT, profiler)
+    profiler.write()
 
 
 if __name__ == '__main__':
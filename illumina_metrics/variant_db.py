@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+
+"""
+Indexed cross-run variant database, answering "which samples carry X" without rescanning the variant files of every run.
+
+The iVar variants tsv and the vcf files written by ivar_variants_to_vcf.py (single sample or merged run vcf) of a run
+are loaded in one SQLite file:
+ - samples      = one row per run and sample
+ - variants     = one row per variant, identified as REGION:POS_REF/ALT with the iVar REF/ALT notation (as in
+                  run_reporting/generate_report_tables.R, the indels of the vcf files being converted back to it), along
+                  with the bitmap of the samples carrying it (bit i set for the sample of id i)
+ - calls        = one row per variant and sample with the ALT_FREQ, ALT_DP, TOTAL_DP and PASS/FAIL of the call
+ - files        = the files loaded, with the fingerprint (path, size and mtime) they were loaded with
+Ingestion is incremental: files already loaded with the same fingerprint are skipped, files that changed since they
+were loaded have their calls replaced. Variants are indexed by position and ID and calls by sample and ALT_FREQ, so
+lookups by position range, variant ID, sample or frequency threshold don't scan the database.
+
+Example: python variant_db.py ingest -d variants.db -r RUN_1 variant/
+         python variant_db.py query -d variants.db --variant MN908947.3:23403_A/G --min_freq 0.75
+"""
+
+import os
+import re
+import sys
+import sqlite3
+import argparse
+import itertools
+
+import numpy as np
+
+from variant_reader import IVAR_HEADER, open_text, read_ivar_tsv, VcfReader
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "common"))
+from metrics_cache import fingerprint
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS samples (
+    id INTEGER PRIMARY KEY,
+    run TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    UNIQUE (run, sample)
+);
+CREATE INDEX IF NOT EXISTS samples_sample ON samples (sample);
+CREATE TABLE IF NOT EXISTS variants (
+    id INTEGER PRIMARY KEY,
+    variant_id TEXT NOT NULL UNIQUE,
+    chrom TEXT NOT NULL,
+    pos INTEGER NOT NULL,
+    ref TEXT NOT NULL,
+    alt TEXT NOT NULL,
+    carriers INTEGER NOT NULL DEFAULT 0,
+    samples BLOB
+);
+CREATE INDEX IF NOT EXISTS variants_position ON variants (chrom, pos);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    run TEXT NOT NULL,
+    fingerprint TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS calls (
+    variant INTEGER NOT NULL,
+    sample INTEGER NOT NULL,
+    file INTEGER NOT NULL,
+    alt_freq REAL,
+    alt_dp INTEGER,
+    total_dp INTEGER,
+    filter TEXT NOT NULL,
+    PRIMARY KEY (variant, sample)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS calls_sample ON calls (sample);
+CREATE INDEX IF NOT EXISTS calls_alt_freq ON calls (alt_freq);
+CREATE INDEX IF NOT EXISTS calls_file ON calls (file);
+"""
+
+CALL_COLUMNS = ['variant_id', 'run', 'sample', 'chrom', 'pos', 'ref', 'alt', 'alt_freq', 'alt_dp', 'total_dp', 'filter']
+VARIANT_COLUMNS = ['variant_id', 'chrom', 'pos', 'ref', 'alt', 'carriers']
+VARIANT_FILES = (".tsv", ".vcf", ".vcf.gz")
+REGION = re.compile(r"^(?:(.+):)?(\d+)?-(\d+)?$")
+# Maximum number of parameters of one SQLite statement
+SQL_CHUNK_SIZE = 900
+
+def parse_args(args=None):
+    """
+    Argument parser
+    """
+    description = "Loads the iVar variants of runs in an indexed database and queries the samples carrying variants across runs."
+
+    parser = argparse.ArgumentParser(description=description)
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.required = True
+
+    ingest = subparsers.add_parser('ingest',
+                                   help="Loads the variant files of a run, files already loaded and unchanged being skipped.")
+
+    ingest.add_argument('-d',
+                        '--database',
+                        help="SQLite variant database, created if needed.",
+                        required=True)
+
+    ingest.add_argument('-r',
+                        '--run',
+                        help="Run the variant files belong to.",
+                        required=True)
+
+    ingest.add_argument('inputs',
+                        help="iVar variants tsv or vcf files, or directories searched recursively for them.",
+                        nargs='+')
+
+    ingest.add_argument('-f',
+                        '--force',
+                        help="Reload the files even if they didn't change since they were loaded.",
+                        action='store_true')
+
+    query = subparsers.add_parser('query',
+                                  help="Lists the variant calls matching all the given filters as tsv.")
+
+    query.add_argument('-d',
+                       '--database',
+                       help="SQLite variant database.",
+                       required=True)
+
+    query.add_argument('--region',
+                       help="Position range as CHROM:START-END, START-END, START- or -END, 1-based and inclusive.",
+                       required=False)
+
+    query.add_argument('--variant',
+                       help="Variant IDs as REGION:POS_REF/ALT.",
+                       nargs='+',
+                       required=False)
+
+    query.add_argument('--sample',
+                       help="Samples, from any run.",
+                       nargs='+',
+                       required=False)
+
+    query.add_argument('--run',
+                       help="Runs.",
+                       nargs='+',
+                       required=False)
+
+    query.add_argument('--min_freq',
+                       help="Minimum ALT_FREQ of the calls.",
+                       type=float,
+                       required=False)
+
+    query.add_argument('--max_freq',
+                       help="Maximum ALT_FREQ of the calls.",
+                       type=float,
+                       required=False)
+
+    query.add_argument('--pass_only',
+                       help="Only list the calls passing the iVar filter.",
+                       action='store_true')
+
+    query.add_argument('--variants',
+                       help="List the matching variants with their number of carrier samples instead of the calls.",
+                       action='store_true')
+
+    query.add_argument('--min_carriers',
+                       help="With --variants, minimum number of samples carrying the variant (Default: 1).",
+                       default=1,
+                       type=int)
+
+    query.add_argument('-o',
+                       '--output',
+                       help="tsv output file (Default: stdout).",
+                       type=argparse.FileType('w'),
+                       default='-')
+
+    return parser.parse_args(args)
+
+def sample_name(name):
+    """
+    Returns the sample name of an iVar tsv path or a vcf sample column, as ivar_variants_to_vcf.py names them after their file
+    """
+    return os.path.basename(name).split(".")[0]
+
+def variant_id(chrom, pos, ref, alt):
+    return "%s:%s_%s/%s" % (chrom, pos, ref, alt)
+
+def ivar_alleles(ref, alt):
+    """
+    Returns the iVar REF/ALT notation of the REF/ALT of a vcf written by ivar_variants_to_vcf.py
+    """
+    if len(alt) > 1 and len(ref) == 1 and alt.startswith(ref):
+        return ref, "+" + alt[1:]
+    if len(ref) > 1 and len(alt) == 1 and ref.startswith(alt):
+        return alt, "-" + ref[1:]
+    return ref, alt
+
+def to_number(value, number_type=float):
+    """
+    Returns the number of a field, None when it is missing or not a number
+    """
+    try:
+        return number_type(value)
+    except (TypeError, ValueError):
+        return None
+
+def read_tsv_calls(path):
+    """
+    Yields the (sample, chrom, pos, ref, alt, alt_freq, alt_dp, total_dp, filter) calls of an iVar variants tsv
+    Other tsv files found along the variant files are skipped with a warning
+    """
+    sample = sample_name(path)
+    with open_text(path) as in_file:
+        header = in_file.readline()
+        if not header.startswith(IVAR_HEADER):
+            sys.stderr.write("WARNING: %s is not an iVar variants tsv, skipped\n" % path)
+            return
+        for variant in read_ivar_tsv(itertools.chain([header], in_file)):
+            yield (sample, variant.chrom, int(variant.pos), variant.ref, variant.alt, to_number(variant.alt_freq),
+                   to_number(variant.alt_dp, int), to_number(variant.total_dp, int), 'PASS' if variant.pass_test == 'TRUE' else 'FAIL')
+
+def read_vcf_calls(path):
+    """
+    Yields the calls of a single or multi-sample vcf written by ivar_variants_to_vcf.py, samples without the variant being skipped
+    """
+    with VcfReader(path) as reader:
+        samples = [sample_name(sample) for sample in reader.samples]
+        for record in reader:
+            ref, alt = ivar_alleles(record.ref, record.alt)
+            info = dict(field.split("=", 1) for field in record.info.split(";") if "=" in field)
+            for index, sample in enumerate(samples):
+                if record.sample_columns[index] in (".", "./."):
+                    continue
+                total_dp = record.get('DP', index, info.get('DP'))
+                yield (sample, record.chrom, record.pos, ref, alt, to_number(record.get('alt_FREQ', index)),
+                       to_number(record.get('alt_DP', index), int), to_number(total_dp, int), record.get('FT', index, record.filter))
+
+def read_calls(path):
+    """
+    Returns the calls of a variant file, keeping the first of the calls of a sample iVar reports once per overlapping feature
+    """
+    reader = read_tsv_calls if path.endswith(".tsv") else read_vcf_calls
+    calls = {}
+    for call in reader(path):
+        calls.setdefault((call[0], variant_id(*call[1:5])), call)
+    return list(calls.values())
+
+def list_variant_files(inputs):
+    """
+    Returns the variant files given or found recursively in the given directories
+    In directories, the vcf converted from an iVar tsv found next to it is left out, its calls being those of the tsv
+    """
+    files = []
+    for path in inputs:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                tsv_files = set(name[:-len(".tsv")] for name in names if name.endswith(".tsv"))
+                files.extend(os.path.join(root, name) for name in sorted(names) if name.endswith(VARIANT_FILES) and
+                             not (name.endswith((".vcf", ".vcf.gz")) and re.sub(r"\.vcf(\.gz)?$", "", name) in tsv_files))
+        else:
+            files.append(path)
+    return files
+
+def parse_region(region):
+    """
+    Returns the (chrom, start, end) of a CHROM:START-END position range, missing parts being None
+    """
+    match = REGION.match(region)
+    if match is None:
+        raise ValueError("invalid region %s, expected CHROM:START-END, START-END, START- or -END" % region)
+    chrom, start, end = match.groups()
+    return chrom, to_number(start, int), to_number(end, int)
+
+def chunks(values, size=SQL_CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def bitmap_bytes(sample_ids):
+    """
+    Returns the little-endian bitmap of a set of sample ids
+    """
+    bitmap = 0
+    for sample_id in sample_ids:
+        bitmap |= 1 << sample_id
+    return bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little')
+
+def bitmap_samples(bitmap):
+    """
+    Returns the sample ids set in a bitmap
+    """
+    if not bitmap:
+        return []
+    return np.flatnonzero(np.unpackbits(np.frombuffer(bitmap, dtype=np.uint8), bitorder='little')).tolist()
+
+class VariantDatabase(object):
+    """
+    SQLite backed store of the variant calls of all the samples of all the runs
+    """
+    def __init__(self, db_path):
+        directory = os.path.dirname(db_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(db_path)
+        self.connection.executescript(SCHEMA)
+
+    def ingest(self, paths, run, force=False):
+        """
+        Loads variant files of a run, returns the number of files loaded and skipped
+        Each file is committed on its own, so an interrupted ingestion only reloads the files it didn't get to
+        """
+        loaded = skipped = 0
+        for path in paths:
+            path = os.path.abspath(path)
+            file_fingerprint = fingerprint([path])
+            row = self.connection.execute("SELECT id, fingerprint FROM files WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[1] == file_fingerprint and not force:
+                skipped += 1
+                continue
+            calls = read_calls(path)
+            with self.connection:
+                self.load_file(path, run, file_fingerprint, calls, row[0] if row else None)
+            loaded += 1
+        return loaded, skipped
+
+    def load_file(self, path, run, file_fingerprint, calls, file_id=None):
+        """
+        Replaces the calls of a file and updates the sample bitmaps of the variants they touch
+        """
+        cursor = self.connection.cursor()
+        touched = set()
+        if file_id is None:
+            cursor.execute("INSERT INTO files (path, run, fingerprint) VALUES (?, ?, ?)", (path, run, file_fingerprint))
+            file_id = cursor.lastrowid
+        else:
+            touched.update(variant for variant, in cursor.execute("SELECT variant FROM calls WHERE file = ?", (file_id,)))
+            cursor.execute("DELETE FROM calls WHERE file = ?", (file_id,))
+            cursor.execute("UPDATE files SET run = ?, fingerprint = ? WHERE id = ?", (run, file_fingerprint, file_id))
+
+        samples = sorted(set(call[0] for call in calls))
+        cursor.executemany("INSERT OR IGNORE INTO samples (run, sample) VALUES (?, ?)", [(run, sample) for sample in samples])
+        sample_ids = dict(cursor.execute("SELECT sample, id FROM samples WHERE run = ?", (run,)))
+
+        variants = dict((variant_id(*call[1:5]), call[1:5]) for call in calls)
+        cursor.executemany("INSERT OR IGNORE INTO variants (variant_id, chrom, pos, ref, alt) VALUES (?, ?, ?, ?, ?)",
+                           [(identifier,) + fields for identifier, fields in variants.items()])
+        variant_ids = {}
+        for chunk in chunks(variants):
+            variant_ids.update(cursor.execute("SELECT variant_id, id FROM variants WHERE variant_id IN (%s)" % ",".join("?" * len(chunk)), chunk))
+
+        # The first file loaded with a call of a sample keeps it
+        cursor.executemany("INSERT OR IGNORE INTO calls VALUES (?, ?, ?, ?, ?, ?, ?)",
+                           [(variant_ids[variant_id(*call[1:5])], sample_ids[call[0]], file_id) + call[5:] for call in calls])
+        touched.update(variant_ids.values())
+        self.update_bitmaps(touched)
+
+    def update_bitmaps(self, variants):
+        """
+        Rebuilds the sample bitmap and carrier count of variants from their calls
+        """
+        cursor = self.connection.cursor()
+        for chunk in chunks(variants):
+            carriers = dict((variant, []) for variant in chunk)
+            for variant, sample in cursor.execute("SELECT variant, sample FROM calls WHERE variant IN (%s)" % ",".join("?" * len(chunk)), chunk):
+                carriers[variant].append(sample)
+            cursor.executemany("UPDATE variants SET carriers = ?, samples = ? WHERE id = ?",
+                               [(len(samples), bitmap_bytes(samples), variant) for variant, samples in carriers.items()])
+
+    def carriers(self, identifier):
+        """
+        Returns the (run, sample) of the samples carrying a variant, from its bitmap
+        """
+        row = self.connection.execute("SELECT samples FROM variants WHERE variant_id = ?", (identifier,)).fetchone()
+        if row is None:
+            return []
+        sample_ids = bitmap_samples(row[0])
+        samples = []
+        for chunk in chunks(sample_ids):
+            samples.extend(self.connection.execute("SELECT run, sample FROM samples WHERE id IN (%s) ORDER BY id" % ",".join("?" * len(chunk)), chunk))
+        return samples
+
+    def calls(self, region=None, variants=None, samples=None, runs=None, min_freq=None, max_freq=None, pass_only=False):
+        """
+        Returns the calls matching all the given filters as tuples of CALL_COLUMNS, sorted by position and sample
+        region is a (chrom, start, end) position range, any of them being None to leave it open
+        """
+        conditions, params = self.conditions(region, variants)
+        if samples:
+            conditions.append("s.sample IN (%s)" % ",".join("?" * len(samples)))
+            params.extend(samples)
+        if runs:
+            conditions.append("s.run IN (%s)" % ",".join("?" * len(runs)))
+            params.extend(runs)
+        if min_freq is not None:
+            conditions.append("c.alt_freq >= ?")
+            params.append(min_freq)
+        if max_freq is not None:
+            conditions.append("c.alt_freq <= ?")
+            params.append(max_freq)
+        if pass_only:
+            conditions.append("c.filter = 'PASS'")
+        query = ("SELECT v.variant_id, s.run, s.sample, v.chrom, v.pos, v.ref, v.alt, c.alt_freq, c.alt_dp, c.total_dp, c.filter "
+                 "FROM calls c JOIN variants v ON v.id = c.variant JOIN samples s ON s.id = c.sample")
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        return self.connection.execute(query + " ORDER BY v.chrom, v.pos, v.ref, v.alt, s.run, s.sample", params).fetchall()
+
+    def variants(self, region=None, variants=None, min_carriers=1):
+        """
+        Returns the variants matching the filters as tuples of VARIANT_COLUMNS, carriers being the number of samples carrying them
+        """
+        conditions, params = self.conditions(region, variants)
+        conditions.append("v.carriers >= ?")
+        params.append(min_carriers)
+        query = "SELECT v.variant_id, v.chrom, v.pos, v.ref, v.alt, v.carriers FROM variants v WHERE " + " AND ".join(conditions)
+        return self.connection.execute(query + " ORDER BY v.chrom, v.pos, v.ref, v.alt", params).fetchall()
+
+    @staticmethod
+    def conditions(region=None, variants=None):
+        """
+        Returns the SQL conditions and parameters selecting variants by position range and ID
+        """
+        conditions, params = [], []
+        if region is not None:
+            for condition, value in zip(("v.chrom = ?", "v.pos >= ?", "v.pos <= ?"), region):
+                if value is not None:
+                    conditions.append(condition)
+                    params.append(value)
+        if variants:
+            conditions.append("v.variant_id IN (%s)" % ",".join("?" * len(variants)))
+            params.extend(variants)
+        return conditions, params
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+def format_value(value):
+    return "NA" if value is None else str(value)
+
+def main(args=None):
+    """
+    main
+    """
+    args = parse_args(args)
+    if args.command == 'ingest':
+        database = VariantDatabase(args.database)
+        try:
+            loaded, skipped = database.ingest(list_variant_files(args.inputs), args.run, args.force)
+        finally:
+            database.close()
+        sys.stderr.write("%i variant files loaded, %i unchanged files skipped\n" % (loaded, skipped))
+        return
+
+    if not os.path.isfile(args.database):
+        sys.stderr.write("ERROR: variant database %s not found\n" % args.database)
+        sys.exit(1)
+    try:
+        region = parse_region(args.region) if args.region else None
+    except ValueError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        sys.exit(1)
+    database = VariantDatabase(args.database)
+    try:
+        if args.variants:
+            if args.sample or args.run or args.min_freq is not None or args.max_freq is not None or args.pass_only:
+                sys.stderr.write("WARNING: --sample, --run, --min_freq, --max_freq and --pass_only only filter calls, ignored with --variants\n")
+            columns, rows = VARIANT_COLUMNS, database.variants(region, args.variant, args.min_carriers)
+        else:
+            columns, rows = CALL_COLUMNS, database.calls(region, args.variant, args.sample, args.run, args.min_freq, args.max_freq, args.pass_only)
+    finally:
+        database.close()
+    args.output.write("\t".join(columns) + "\n")
+    for row in rows:
+        args.output.write("\t".join(format_value(value) for value in row) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+"""
+Lightweight readers for the iVar variants tsv files and for the vcf files written by ivar_variants_to_vcf.py.
+Records are streamed one line at a time as compact __slots__ objects, all fields are kept as the strings found in
+the file and the per-sample FORMAT fields (alt_FREQ, alt_DP, ...) are only split when they are first accessed.
+"""
+
+import gzip
+
+IVAR_HEADER = "REGION\tPOS\tREF\tALT"
+IVAR_COLUMNS = ('chrom', 'pos', 'ref', 'alt', 'ref_dp', 'ref_rv', 'ref_qual', 'alt_dp', 'alt_rv', 'alt_qual', 'alt_freq', 'total_dp', 'pval', 'pass_test')
+
+def open_text(path, mode='rt'):
+    """
+    Opens a plain or gzip/bgzip compressed text file
+    """
+    if path.endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def is_ivar_tsv(path):
+    """
+    Returns True when a file starts with the header of an iVar variants tsv
+    """
+    with open_text(path) as in_file:
+        return in_file.readline().startswith(IVAR_HEADER)
+
+class IvarRecord(object):
+    """
+    One variant line of an iVar variants tsv
+    """
+    __slots__ = IVAR_COLUMNS
+
+    def __init__(self, fields):
+        (self.chrom, self.pos, self.ref, self.alt, self.ref_dp, self.ref_rv, self.ref_qual, self.alt_dp, self.alt_rv,
+         self.alt_qual, self.alt_freq, self.total_dp, self.pval, self.pass_test) = fields[:14]
+
+    @property
+    def variant_type(self):
+        """
+        Returns INS, DEL or SNP following the iVar ALT notation
+        """
+        if self.alt[0] == '+':
+            return 'INS'
+        elif self.alt[0] == '-':
+            return 'DEL'
+        return 'SNP'
+
+def read_ivar_tsv(in_file):
+    """
+    Yields an IvarRecord for each line of an opened iVar variants tsv, skipping the header
+    """
+    next(in_file, None)
+    for line in in_file:
+        line = line.rstrip("\r\n")
+        if line:
+            yield IvarRecord(line.split("\t", 14))
+
+class VcfRecord(object):
+    """
+    One line of a vcf, the FORMAT and sample columns are only split on demand
+    """
+    __slots__ = ('chrom', 'pos', 'id', 'ref', 'alt', 'qual', 'filter', 'info', 'format', 'sample_columns', '_format_keys', '_samples')
+
+    def __init__(self, fields, format_keys):
+        self.chrom, pos, self.id, self.ref, self.alt, self.qual, self.filter, self.info = fields[:8]
+        self.pos = int(pos)
+        self.format = fields[8] if len(fields) > 8 else ""
+        self.sample_columns = fields[9:]
+        self._format_keys = format_keys
+        self._samples = None
+
+    def _format_index(self):
+        """
+        Returns the FORMAT key to column index mapping, shared by all the records having the same FORMAT
+        """
+        index = self._format_keys.get(self.format)
+        if index is None:
+            index = {key: i for i, key in enumerate(self.format.split(":"))}
+            self._format_keys[self.format] = index
+        return index
+
+    def get(self, key, sample=0, default=None):
+        """
+        Returns the raw string value of a FORMAT field for the sample at the given index
+        """
+        index = self._format_index().get(key)
+        if index is None:
+            return default
+        if self._samples is None:
+            self._samples = [None] * len(self.sample_columns)
+        values = self._samples[sample]
+        if values is None:
+            values = self._samples[sample] = self.sample_columns[sample].split(":")
+        return values[index] if index < len(values) else default
+
+    @property
+    def alts(self):
+        """
+        Returns the list of ALT alleles
+        """
+        return self.alt.split(",")
+
+    @property
+    def passed(self):
+        """
+        Returns True when the FILTER column is PASS
+        """
+        return self.filter == 'PASS'
+
+class VcfReader(object):
+    """
+    Streams the records of a plain or gzip compressed vcf
+    """
+    def __init__(self, vcf_file):
+        self._file = open_text(vcf_file) if isinstance(vcf_file, str) else vcf_file
+        self.meta = []
+        self.samples = []
+        self._format_keys = {}
+        self._first = None
+        for line in self._file:
+            if line.startswith("##"):
+                self.meta.append(line.rstrip("\r\n"))
+            elif line.startswith("#"):
+                self.samples = line.rstrip("\r\n").split("\t")[9:]
+                break
+            else:
+                self._first = line
+                break
+
+    def __iter__(self):
+        if self._first is not None:
+            line, self._first = self._first, None
+            yield VcfRecord(line.rstrip("\r\n").split("\t"), self._format_keys)
+        for line in self._file:
+            line = line.rstrip("\r\n")
+            if line:
+                yield VcfRecord(line.split("\t"), self._format_keys)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -8,6 +8,21 @@ sample_name (str): the name of the sample used as input
 Note: assumes that it is being run from the 'analysis' location of the sample, and that all files
 follow the naming convention of our adapted ARTIC pipeline
 
+The coverage is read from the ARTIC bam pickle (--pickle) or, without pickle, computed directly from the
+sorted bam (--bam) in one streaming pass.
+
+Batch mode: all the samples of a run are processed in one process with a pool of --processes workers, the samples
+being listed in a --manifest tsv (columns: sample, consensus, fq_stats, pickle and optionally bam) or discovered under
+an ARTIC --analysis_dir (any directory holding a <SAMPLE>.consensus.fasta). One combined csv is written and the
+samples that fail are reported on stderr (and in --failures) without stopping the batch.
+
+With --cache, the metrics of each sample are kept in a SQLite file keyed by the size and mtime of its input files (see
+common/metrics_cache.py), so re-collecting a run only recomputes the samples whose inputs changed.
+
+With --profile, the wall time, CPU time and peak memory of each stage (loading the consensus, fastq stats and pickle,
+computing the coverage metrics, writing the output) are appended as a JSON line to the given file (see
+common/stage_profiler.py), the stages of each sample being included in batch mode.
+
 Outputs a table with the follwing columns:
  - sample               = sample name
  - cons.perc.N          = percent N in consensus
@@ -24,17 +39,55 @@ Outputs a table with the follwing columns:
  - bam.perc.500x        = Percent covered at min 500x depth
  - bam.perc.1000x       = Percent covered at min 1000x depth
  - bam.perc.2000x       = Percent covered at min 2000x depth
+
+The bam.perc.<N>x columns follow the depth thresholds given with --thresholds (Default: 50 100 250 500 1000 2000).
+With --extended, the following columns are appended:
+ - bam.cov.evenness     = Coverage evenness score (Oktay et al. 2015) over the whole genome
+ - bam.perc.zero.cov    = Percent of the genome at zero depth
+ - bam.longest.<N>x     = Longest run of consecutive positions not covered above <N>x, for each threshold
+ - cons.N.runs          = Number of runs of consecutive N in consensus
+ - cons.longest.N.run   = Longest run of consecutive N in consensus
+ - cons.ambiguous       = Number of IUPAC ambiguous bases other than N in consensus
+With --primer_bed, the following column is appended and the samples x amplicons depth and dropout matrices are written
+in --amplicon_dir (see common/amplicon_coverage.py):
+ - bam.amplicon.dropouts = Number of amplicons with a mean depth under --dropout_depth
 """
 
 
 import argparse
+import fnmatch
+import multiprocessing
+import numpy as np
+import os
 import pandas as pd
 import pickle
 import sys
 
-from Bio.Seq import Seq
-from Bio import SeqIO
-from Bio.SeqUtils import GC
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), os.pardir, "common"))
+from metrics_cache import MetricsCache
+from stage_profiler import StageProfiler
+import amplicon_coverage
+import consensus_qc
+
+DEFAULT_THRESHOLDS = [50, 100, 250, 500, 1000, 2000]
+
+# Basic values
+CoV2_genome_size = float(29903)
+CoV2_chr_name = "MN908947.3"
+
+# Batch mode file patterns, relative to the directory holding the sample consensus
+CONSENSUS_SUFFIX = ".consensus.fasta"
+DISCOVERY_PATTERNS = {
+    'fq_stats': ["{sample}*fastq.stats", "*fastq.stats"],
+    'pickle': ["{sample}*pickle*", "*pickle*"],
+    'bam': ["{sample}.primertrimmed.rg.sorted.bam", "{sample}*.sorted.bam"]
+    }
+MANIFEST_COLUMNS = ['sample', 'consensus', 'fq_stats', 'pickle', 'bam']
+# Per-amplicon depths are carried (and cached) along with the metrics of a sample, then moved to the amplicon matrices
+AMPLICON_COLUMN = "amplicon.{statistic}.{amplicon}"
+
+# Bumped whenever the metrics computation changes, so metrics cached by a previous version are recomputed
+CACHE_VERSION = 2
 
 def parseoptions():
     """Command line options"""
@@ -43,64 +96,244 @@ def parseoptions():
     parser.add_argument('-c',
                         '--consensus',
                         help="Consensus file Fasta format.",
-                        required=True)
+                        required=False)
     parser.add_argument('-s',
                         '--sample',
                         help="Sample name.",
-                        required=True)
+                        required=False)
     parser.add_argument('-fqs',
                         '--fq_stats',
                         help="\"fastq.stats\" file.",
-                        required=True)
+                        required=False)
     parser.add_argument('-pk',
                         '--pickle',
                         help="File format pickle.",
-                        required=True)
+                        required=False)
+    parser.add_argument('-b',
+                        '--bam',
+                        help="Sorted bam file, used to compute the coverage directly when no pickle is given. With both --pickle and --bam, checks that both give identical metrics.",
+                        required=False)
     parser.add_argument('-o',
                         '--output',
                         help="Output filename.",
                         required=False)
+    parser.add_argument('-t',
+                        '--thresholds',
+                        help="Depth thresholds used for the bam.perc.<N>x columns (Default: 50 100 250 500 1000 2000).",
+                        nargs='+',
+                        type=int,
+                        default=DEFAULT_THRESHOLDS)
+    parser.add_argument('-e',
+                        '--extended',
+                        help="Add coverage evenness, zero depth and longest low coverage run columns.",
+                        action='store_true')
+    parser.add_argument('-m',
+                        '--manifest',
+                        help="Batch mode: tsv with a header and sample, consensus, fq_stats, pickle and optionally bam columns.",
+                        required=False)
+    parser.add_argument('-a',
+                        '--analysis_dir',
+                        help="Batch mode: ARTIC analysis directory where the samples are discovered.",
+                        required=False)
+    parser.add_argument('-p',
+                        '--processes',
+                        help="Batch mode: number of worker processes (Default: 1).",
+                        type=int,
+                        default=1)
+    parser.add_argument('-f',
+                        '--failures',
+                        help="Batch mode: tsv listing the samples that failed along with the error.",
+                        required=False)
+    parser.add_argument('--cache',
+                        help="SQLite file caching the per-sample metrics across runs, only the samples whose input files changed are recomputed.",
+                        required=False)
+    parser.add_argument('--force',
+                        help="With --cache, recompute all the samples and refresh their cached metrics.",
+                        action='store_true')
+    parser.add_argument('--invalidate',
+                        help="With --cache, drop the cached metrics of the given samples, or of all the samples if none is given, before collecting.",
+                        nargs='*',
+                        metavar='SAMPLE',
+                        required=False)
+    parser.add_argument('--hash',
+                        help="With --cache, also key the cache on the content hash of the input files, not only their size and mtime.",
+                        action='store_true')
+    parser.add_argument('--profile',
+                        help="Append the wall time, CPU time and peak memory of each stage of the run as a JSON line to this file.",
+                        required=False)
+    parser.add_argument('--primer_bed',
+                        help="Primer scheme BED (ARTIC format) or amplicon regions BED, adds the bam.amplicon.dropouts column and writes the amplicon depth and dropout matrices.",
+                        required=False)
+    parser.add_argument('--dropout_depth',
+                        help="Mean depth under which an amplicon is a dropout (Default: %i)." % amplicon_coverage.DEFAULT_DROPOUT_DEPTH,
+                        type=float,
+                        default=amplicon_coverage.DEFAULT_DROPOUT_DEPTH)
+    parser.add_argument('--amplicon_dir',
+                        help="Directory where the amplicon matrices are written (Default: directory of --output).",
+                        required=False)
 
-    return parser.parse_args()
-
-# Read arguments
-sample = sys.argv[1]
-
-
-def main():
-    """main function"""
-
-    # ARGS
-    args = parseoptions()
-    sample = args.sample
-    ##########################################################################################
-    # Construct file names
-    consensus_file = args.consensus
-    fastq_stats_file = args.fq_stats
-    pickle_file = args.pickle
-    output_file = args.output if args.output else None
-
-    # Basic values
-    CoV2_genome_size = float(29903)
-    CoV2_chr_name = "MN908947.3"
-
-
+    args = parser.parse_args()
+    if args.manifest and args.analysis_dir:
+        parser.error("--manifest and --analysis_dir can't be used together")
+    if not (args.manifest or args.analysis_dir):
+        if not (args.consensus and args.sample and args.fq_stats):
+            parser.error("--consensus, --sample and --fq_stats are required unless --manifest or --analysis_dir is used")
+        if not (args.pickle or args.bam):
+            parser.error("one of --pickle or --bam is required")
+    if (args.force or args.invalidate is not None or args.hash) and not args.cache:
+        parser.error("--force, --invalidate and --hash require --cache")
+    return args
+
+
+def coverage_arrays(coverage, genome_size):
+    """
+    Converts the per-position coverage dict of the pickle into NumPy arrays, a depth array computed from the bam being used as is
+    Returns the depths of the positions reported in the pileup and the depth over the whole genome, unreported positions being at 0
+    """
+    if isinstance(coverage, np.ndarray):
+        genome_depth = np.zeros(genome_size, dtype=np.int64)
+        genome_depth[:min(genome_size, len(coverage))] = coverage[:genome_size]
+        return genome_depth[genome_depth > 0], genome_depth
+    positions = np.fromiter(coverage.keys(), dtype=np.int64, count=len(coverage))
+    depths = np.fromiter(coverage.values(), dtype=np.int64, count=len(coverage))
+    genome_depth = np.zeros(max(genome_size, int(positions.max()) + 1 if len(positions) else 0), dtype=np.int64)
+    genome_depth[positions] = depths
+    return depths, genome_depth[:genome_size]
+
+def longest_run(mask):
+    """
+    Returns the length of the longest run of True values in a boolean array
+    """
+    if not mask.any():
+        return 0
+    edges = np.diff(np.concatenate(([0], mask.view(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    return int((ends - starts).max())
+
+def coverage_metrics(depths, thresholds):
+    """
+    Returns the mean, median, min, max coverage and the number of positions above each threshold
+    The thresholds are all answered from one sorted copy of the depths
+    """
+    sorted_depths = np.sort(depths)
+    above = len(sorted_depths) - np.searchsorted(sorted_depths, thresholds, side='right')
+    return {
+        'mean': sorted_depths.mean(),
+        'median': np.median(sorted_depths),
+        'min': float(sorted_depths[0]),
+        'max': float(sorted_depths[-1]),
+        'above': dict(zip(thresholds, above.tolist()))
+        }
+
+def extended_coverage_metrics(genome_depth, thresholds):
+    """
+    Returns the coverage evenness score, the percent of the genome at zero depth and the longest run not covered above each threshold
+    """
+    genome_size = float(len(genome_depth))
+    rounded_mean = round(genome_depth.mean())
+    if rounded_mean > 0:
+        below_mean = genome_depth[genome_depth <= rounded_mean]
+        evenness = 1 - (len(below_mean) - below_mean.sum() / float(rounded_mean)) / genome_size
+    else:
+        evenness = 0.0
+    return {
+        'evenness': evenness,
+        'perc_zero': (np.count_nonzero(genome_depth == 0) / genome_size) * 100,
+        'longest': {threshold: longest_run(genome_depth <= threshold) for threshold in thresholds}
+        }
+
+
+def bam_stats(bam_file, chr_name, genome_size, chunk_size=1000000):
+    """
+    Computes the read_stats and pileup_stats of the ARTIC bam pickle directly from a sorted bam, in one streaming pass
+    Depth is the number of reads of the pysam pileup (PileupColumn.nsegments with the default pileup filters): reads that are
+    unmapped, secondary, QC failed or duplicates are left out and a read counts over its whole reference span, deletions included.
+    Unlike the pileup, the depth isn't capped at max_depth.
+    read_stats counts reads as the QC-passed column of samtools flagstat: mapped counts the primary, secondary and supplementary
+    alignments. Memory is bounded by the genome size and the read buffer size.
+    The coverage of chr_name is returned as a NumPy depth array instead of a per-position dict.
+    """
+    import pysam
+
+    read_stats = {'total': 0, 'mapped': 0, 'unmapped': 0, 'secondary': 0, 'supplementary': 0}
+    depth_diff = np.zeros(genome_size + 1, dtype=np.int64)
+    starts = []
+    ends = []
+    with pysam.AlignmentFile(bam_file, 'rb') as bam:
+        tid = bam.get_tid(chr_name)
+        for read in bam.fetch(until_eof=True):
+            if read.is_qcfail:
+                continue
+            read_stats['total'] += 1
+            if read.is_secondary:
+                read_stats['secondary'] += 1
+            elif read.is_supplementary:
+                read_stats['supplementary'] += 1
+            if read.is_unmapped:
+                read_stats['unmapped'] += 1
+                continue
+            read_stats['mapped'] += 1
+            if read.reference_id != tid or read.is_secondary or read.is_duplicate:
+                continue
+            # The reference span of a read covers its aligned blocks and its deletions, as the pileup does
+            starts.append(read.reference_start)
+            ends.append(read.reference_end)
+            if len(starts) >= chunk_size:
+                add_blocks(depth_diff, starts, ends)
+                starts = []
+                ends = []
+    add_blocks(depth_diff, starts, ends)
+    return {
+        'read_stats': read_stats,
+        'pileup_stats': {'coverage': {chr_name: np.cumsum(depth_diff[:genome_size])}}
+        }
+
+def add_blocks(depth_diff, starts, ends):
+    """
+    Adds the reference spans of reads to a depth difference array
+    """
+    if starts:
+        size = len(depth_diff)
+        depth_diff += np.bincount(np.minimum(starts, size - 1), minlength=size)
+        depth_diff -= np.bincount(np.minimum(ends, size - 1), minlength=size)
+
+def load_bam_stats(pickle_file=None, bam_file=None, profiler=None):
+    """
+    Returns the bam stats from the ARTIC pickle or, when no pickle is given, computed from the bam
+    """
+    profiler = profiler or StageProfiler()
+    if pickle_file:
+        with profiler.stage("load pickle"):
+            return pd.read_pickle(pickle_file)
+    with profiler.stage("bam coverage"):
+        return bam_stats(bam_file, CoV2_chr_name, int(CoV2_genome_size))
+
+def collect_metrics(sample, consensus_file, fastq_stats_file, bam_pickle, thresholds=DEFAULT_THRESHOLDS, extended=False, profiler=None,
+                    amplicons=None, dropout_depth=amplicon_coverage.DEFAULT_DROPOUT_DEPTH):
+    """
+    Returns the metrics of a sample as an ordered dict of single value lists, bam_pickle being the loaded pickle or bam_stats() output
+    With amplicons, the mean and median depth of each amplicon are added as AMPLICON_COLUMN entries
+    """
+    profiler = profiler or StageProfiler()
     ##########################################################################################
     # Import Consensus sequence
-    with open(consensus_file, 'r') as infile:
-        consensus = SeqIO.read(infile, 'fasta')
+    with profiler.stage("load consensus"):
+        consensus = consensus_qc.consensus_qc(consensus_file)
 
-    # Calculate consensus metrics
-    cons_len = float(len(consensus.seq)) # Consensus length
-    num_N = float(consensus.seq.count('N')) # Number of N in consensus
-    perc_N = (num_N / cons_len) * 100 # Percent of N in consensus
-    perc_GC = GC(consensus.seq)
+        # Calculate consensus metrics, as Biopython Seq.count('N') and GC() gave them
+        counts = consensus['counts']
+        cons_len = float(consensus['length']) # Consensus length
+        num_N = float(counts[ord('N')]) # Number of N in consensus
+        perc_N = (num_N / cons_len) * 100 # Percent of N in consensus
+        perc_GC = int(sum(counts[ord(base)] for base in "GCgcSs")) * 100.0 / cons_len
 
 
     ##########################################################################################
     # Read in Fastq stats
-    with open(fastq_stats_file, 'r') as infile:
-        fastq_stats = pd.read_table(infile, sep=' ', header=None, index_col=0).transpose()
+    with profiler.stage("load fastq stats"):
+        with open(fastq_stats_file, 'r') as infile:
+            fastq_stats = pd.read_table(infile, sep=' ', header=None, index_col=0).transpose()
 
 
     # Calculate fastq metrics
@@ -110,30 +343,23 @@ def main():
 
 
     ##########################################################################################
-    # Read in pickle file
-    bam_pickle = pd.read_pickle(pickle_file)
-
     # Parse coverage info from pickle
-    coverage_df = pd.DataFrame.from_dict(bam_pickle['pileup_stats']['coverage'][CoV2_chr_name], orient = 'index')
-
-    # Calculate BAM metrics
-    read_mapped = float(bam_pickle['read_stats']['mapped'])
-    perc_mapped = (read_mapped / pass_reads) * 100
-    mean_cov = coverage_df[0].mean()
-    med_cov = coverage_df[0].median()
-    max_cov = float(coverage_df[0].max())
-    min_cov = float(coverage_df[0].min())
-    max_min_ratio = (max_cov - min_cov) / mean_cov
-    perc_50x = (len(coverage_df[coverage_df[0] > 50]) / CoV2_genome_size) * 100
-    perc_100x = (len(coverage_df[coverage_df[0] > 100]) / CoV2_genome_size) * 100
-    perc_250x = (len(coverage_df[coverage_df[0] > 250]) / CoV2_genome_size) * 100
-    perc_500x = (len(coverage_df[coverage_df[0] > 500]) / CoV2_genome_size) * 100
-    perc_1000x = (len(coverage_df[coverage_df[0] > 1000]) / CoV2_genome_size) * 100
-    perc_2000x = (len(coverage_df[coverage_df[0] > 2000]) / CoV2_genome_size) * 100
+    with profiler.stage("coverage metrics"):
+        depths, genome_depth = coverage_arrays(bam_pickle['pileup_stats']['coverage'][CoV2_chr_name], int(CoV2_genome_size))
+
+        # Calculate BAM metrics
+        read_mapped = float(bam_pickle['read_stats']['mapped'])
+        perc_mapped = (read_mapped / pass_reads) * 100
+        cov_metrics = coverage_metrics(depths, thresholds)
+        mean_cov = cov_metrics['mean']
+        med_cov = cov_metrics['median']
+        max_cov = cov_metrics['max']
+        min_cov = cov_metrics['min']
+        max_min_ratio = (max_cov - min_cov) / mean_cov
 
 
     #######################################c
-    # Create output dataframe
+    # Create output dictionary
 
     output_dict = {
         "sample" : [sample],
@@ -144,22 +370,249 @@ def main():
         "bam.perc.align" : [perc_mapped],
         "bam.mean.cov" : [mean_cov],
         "bam.med.cov" : [med_cov],
-        "bam.max.min.ratio" : [max_min_ratio],
-        "bam.perc.50x" : [perc_50x],
-        "bam.perc.100x" : [perc_100x],
-        "bam.perc.250x" : [perc_250x],
-        "bam.perc.500x" : [perc_500x],
-        "bam.perc.1000x" : [perc_1000x],
-        "bam.perc.2000x" : [perc_2000x]
+        "bam.max.min.ratio" : [max_min_ratio]
     }
+    for threshold in thresholds:
+        output_dict["bam.perc.%ix" % threshold] = [(cov_metrics['above'][threshold] / CoV2_genome_size) * 100]
+    if extended:
+        with profiler.stage("extended coverage metrics"):
+            extended_metrics = extended_coverage_metrics(genome_depth, thresholds)
+        output_dict["bam.cov.evenness"] = [extended_metrics['evenness']]
+        output_dict["bam.perc.zero.cov"] = [extended_metrics['perc_zero']]
+        for threshold in thresholds:
+            output_dict["bam.longest.%ix" % threshold] = [extended_metrics['longest'][threshold]]
+        output_dict["cons.N.runs"] = [consensus['n_runs']]
+        output_dict["cons.longest.N.run"] = [consensus['longest_n_run']]
+        output_dict["cons.ambiguous"] = [consensus['ambiguous']]
+    if amplicons:
+        with profiler.stage("amplicon metrics"):
+            means, medians = amplicon_coverage.amplicon_depths(genome_depth, amplicons)
+            output_dict["bam.amplicon.dropouts"] = [int(amplicon_coverage.dropouts(means, dropout_depth).sum())]
+            for (name, _, _), mean, median in zip(amplicons, means.tolist(), medians.tolist()):
+                output_dict[AMPLICON_COLUMN.format(statistic='mean', amplicon=name)] = [mean]
+                output_dict[AMPLICON_COLUMN.format(statistic='median', amplicon=name)] = [median]
+
+    return output_dict
+
+def write_metrics(output_df, output_file, amplicons=None, amplicon_dir=None, dropout_depth=amplicon_coverage.DEFAULT_DROPOUT_DEPTH):
+    """
+    Writes the metrics csv and, with amplicons, moves the per-amplicon depths to the amplicon matrices in amplicon_dir
+    """
+    if amplicons:
+        samples = []
+        for _, row in output_df.iterrows():
+            samples.append((row['sample'],
+                            [row[AMPLICON_COLUMN.format(statistic='mean', amplicon=name)] for name, _, _ in amplicons],
+                            [row[AMPLICON_COLUMN.format(statistic='median', amplicon=name)] for name, _, _ in amplicons]))
+        amplicon_coverage.write_amplicon_matrices(amplicon_dir, amplicons, samples, dropout_depth)
+        output_df = output_df[[column for column in output_df.columns if not column.startswith("amplicon.")]]
+    return output_df.to_csv(output_file, sep = ',', index=False)
+
+def compare_metrics(pickle_metrics, bam_metrics):
+    """
+    Returns the (column, pickle value, bam value) of the metrics that differ between the pickle and the bam modes
+    """
+    return [(column, pickle_metrics[column][0], bam_metrics[column][0]) for column in pickle_metrics if pickle_metrics[column] != bam_metrics[column]]
+
+def read_manifest(manifest_file):
+    """
+    Returns the sample tuples of a batch manifest as a list of dicts, empty or NA pickle and bam cells being None
+    """
+    samples = []
+    with open(manifest_file, 'r') as infile:
+        header = infile.readline().rstrip("\r\n").split("\t")
+        for line in infile:
+            if not line.strip() or line.startswith("#"):
+                continue
+            values = dict(zip(header, line.rstrip("\r\n").split("\t")))
+            samples.append({column: values.get(column) if values.get(column) not in ("", "NA") else None for column in MANIFEST_COLUMNS})
+    return samples
+
+def discover_samples(analysis_dir):
+    """
+    Walks an ARTIC analysis directory once and returns a dict per <SAMPLE>.consensus.fasta found
+    along with the fastq stats, pickle and bam found next to it, missing files being None
+    """
+    samples = []
+    for root, dirs, files in os.walk(analysis_dir):
+        dirs.sort()
+        for consensus in sorted(entry for entry in files if entry.endswith(CONSENSUS_SUFFIX)):
+            sample = consensus[:-len(CONSENSUS_SUFFIX)]
+            found = {'sample': sample, 'consensus': os.path.join(root, consensus)}
+            for key, patterns in DISCOVERY_PATTERNS.items():
+                found[key] = None
+                for pattern in patterns:
+                    matches = sorted(fnmatch.filter(files, pattern.format(sample=sample)))
+                    if matches:
+                        found[key] = os.path.join(root, matches[0])
+                        break
+            samples.append(found)
+    return samples
+
+def sample_inputs(sample_files):
+    """
+    Returns the input files the metrics of a sample are computed from, used to key the metrics cache
+    """
+    return [sample_files['consensus'], sample_files['fq_stats'], sample_files['pickle'] or sample_files['bam']]
+
+def cache_params(thresholds, extended, amplicons=None, dropout_depth=amplicon_coverage.DEFAULT_DROPOUT_DEPTH):
+    """
+    Returns the collector parameters keying the metrics cache, the amplicons only being part of them when given
+    """
+    params = [CACHE_VERSION, thresholds, extended]
+    if amplicons:
+        params += [amplicons, dropout_depth]
+    return params
+
+def collect_sample(task):
+    """
+    Batch worker: returns (sample, metrics dict, None, stages) or (sample, None, error message, stages) for one sample
+    The stages are the profiled stages of the sample, empty unless profiling
+    """
+    sample_files, thresholds, extended, profile, amplicons, dropout_depth = task
+    sample = sample_files['sample']
+    profiler = StageProfiler(sample=sample, enabled=profile)
+    try:
+        if not sample_files['consensus'] or not sample_files['fq_stats']:
+            raise ValueError("missing consensus or fastq stats file")
+        if not (sample_files['pickle'] or sample_files['bam']):
+            raise ValueError("missing pickle or bam file")
+        bam_pickle = load_bam_stats(sample_files['pickle'], sample_files['bam'], profiler)
+        metrics = collect_metrics(sample, sample_files['consensus'], sample_files['fq_stats'], bam_pickle, thresholds, extended, profiler, amplicons, dropout_depth)
+        return sample, metrics, None, profiler.stages
+    except Exception as exception:
+        return sample, None, "%s: %s" % (type(exception).__name__, exception), profiler.stages
+
+def collect_batch(samples, thresholds=DEFAULT_THRESHOLDS, extended=False, processes=1, cache=None, profiler=None, amplicons=None,
+                  dropout_depth=amplicon_coverage.DEFAULT_DROPOUT_DEPTH):
+    """
+    Collects the metrics of all the samples across a pool of processes, the samples found in the cache being skipped
+    Returns the combined metrics dataframe and the list of (sample, error message) for the samples that failed
+    When profiling, the stages of each computed sample are added to the 'samples' of the profile record
+    """
+    profiler = profiler or StageProfiler()
+    results = [None] * len(samples)
+    fingerprints = {}
+    pending = []
+    with profiler.stage("check cache"):
+        for index, sample_files in enumerate(samples):
+            if cache is not None:
+                fingerprints[index] = cache.fingerprint(sample_inputs(sample_files), cache_params(thresholds, extended, amplicons, dropout_depth))
+                cached = cache.get(sample_files['sample'], fingerprints[index])
+                if cached is not None:
+                    results[index] = (sample_files['sample'], cached, None, [])
+                    continue
+            pending.append(index)
+
+    tasks = [(samples[index], thresholds, extended, profiler.enabled, amplicons, dropout_depth) for index in pending]
+    with profiler.stage("collect samples"):
+        pool = multiprocessing.Pool(processes) if processes > 1 and len(tasks) > 1 else None
+        try:
+            # Samples are cached as they are computed, so a killed collection doesn't compute them again
+            computed = pool.imap(collect_sample, tasks, chunksize=1) if pool else map(collect_sample, tasks)
+            for index, result in zip(pending, computed):
+                results[index] = result
+                if cache is not None and result[1] is not None:
+                    cache.put(result[0], fingerprints[index], result[1])
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+    with profiler.stage("build table"):
+        metrics = [pd.DataFrame.from_dict(output_dict, orient='columns') for _, output_dict, _, _ in results if output_dict is not None]
+        failures = [(sample, error) for sample, _, error, _ in results if error is not None]
+        output_df = pd.concat(metrics, ignore_index=True) if metrics else pd.DataFrame()
+    if profiler.enabled:
+        profiler.extra['samples'] = [{'sample': sample, 'stages': stages} for sample, _, _, stages in (results[index] for index in pending)]
+        profiler.extra['cached_samples'] = len(samples) - len(pending)
+    return output_df, failures
 
-    output_df = pd.DataFrame.from_dict(output_dict, orient='columns')
 
+def main():
+    """main function"""
+
+    # ARGS
+    args = parseoptions()
+    profiler = StageProfiler(args.profile, "nanopore_metrics", args.sample)
+    thresholds = sorted(set(args.thresholds))
+    try:
+        amplicons = amplicon_coverage.read_amplicons(args.primer_bed) if args.primer_bed else None
+    except ValueError as error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        sys.exit(1)
+    amplicon_dir = args.amplicon_dir or os.path.dirname(args.output or "") or os.curdir
+    cache = None
+    if args.cache:
+        cache = MetricsCache(args.cache, "nanopore", args.hash, args.force)
+        if args.invalidate is not None:
+            dropped = cache.invalidate(args.invalidate or None)
+            sys.stderr.write("Metrics cache: %i cached samples invalidated\n" % dropped)
 
     ##########################################################################################
-    # Write output dataframe
+    # Batch mode
+    if args.manifest or args.analysis_dir:
+        with profiler.stage("find samples"):
+            samples = read_manifest(args.manifest) if args.manifest else discover_samples(args.analysis_dir)
+        output_df, failures = collect_batch(samples, thresholds, args.extended, args.processes, cache, profiler, amplicons, args.dropout_depth)
+        if cache is not None:
+            cache.close()
+            sys.stderr.write(cache.stats() + "\n")
+        for failed_sample, error in failures:
+            sys.stderr.write("WARNING: metrics could not be collected for sample %s (%s)\n" % (failed_sample, error))
+        if args.failures:
+            with open(args.failures, 'w') as outfile:
+                outfile.write("sample\terror\n")
+                outfile.writelines("%s\t%s\n" % failure for failure in failures)
+        with profiler.stage("write output"):
+            write_metrics(output_df, args.output, amplicons if len(output_df) else None, amplicon_dir, args.dropout_depth)
+        profiler.write()
+        return
 
-    output_df.to_csv(output_file, sep = ',', index=False)
+    sample = args.sample
+    ##########################################################################################
+    # Construct file names
+    consensus_file = args.consensus
+    fastq_stats_file = args.fq_stats
+    pickle_file = args.pickle
+    bam_file = args.bam
+    output_file = args.output if args.output else None
+
+
+    ##########################################################################################
+    # Collect metrics from the pickle file or, without pickle, directly from the bam
+    # The pickle/bam check always recomputes, the cache is only used for a single input
+    output_dict = None
+    if cache is not None and not (pickle_file and bam_file):
+        sample_files = {'consensus': consensus_file, 'fq_stats': fastq_stats_file, 'pickle': pickle_file, 'bam': bam_file}
+        sample_fingerprint = cache.fingerprint(sample_inputs(sample_files), cache_params(thresholds, args.extended, amplicons, args.dropout_depth))
+        output_dict = cache.get(sample, sample_fingerprint)
+    if output_dict is None:
+        output_dict = collect_metrics(sample, consensus_file, fastq_stats_file, load_bam_stats(pickle_file, bam_file, profiler), thresholds, args.extended, profiler,
+                                      amplicons, args.dropout_depth)
+        if cache is not None and not (pickle_file and bam_file):
+            cache.put(sample, sample_fingerprint, output_dict)
+    if cache is not None:
+        cache.close()
+        sys.stderr.write(cache.stats() + "\n")
+
+    # With both inputs, check that the bam mode gives the same metrics as the pickle
+    if pickle_file and bam_file:
+        bam_dict = collect_metrics(sample, consensus_file, fastq_stats_file, load_bam_stats(bam_file=bam_file), thresholds, args.extended, amplicons=amplicons,
+                                   dropout_depth=args.dropout_depth)
+        differences = compare_metrics(output_dict, bam_dict)
+        for column, pickle_value, bam_value in differences:
+            sys.stderr.write("WARNING: %s differs between pickle (%s) and bam (%s) for sample %s\n" % (column, pickle_value, bam_value, sample))
+        if differences:
+            sys.exit(1)
+        sys.stderr.write("Pickle and bam metrics are identical for sample %s\n" % sample)
+
+    ##########################################################################################
+    # Write output dataframe
+    with profiler.stage("write output"):
+        output_df = pd.DataFrame.from_dict(output_dict, orient='columns')
+        write_metrics(output_df, output_file, amplicons, amplicon_dir, args.dropout_depth)
+    profiler.write()
 
 if __name__ == "__main__":
     main()
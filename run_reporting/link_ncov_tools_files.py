@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+"""
+Links the bam, consensus and variants files of all the samples of a GenPipes covseq run for ncov_tools.
+
+Single-pass replacement of find_files.ivar.sh and find_files.freebayes.sh: alignment/, consensus/ and variant/ are
+walked once and indexed by file name, then the files of every sample are looked up in the index. The samples with a
+complete set of files are linked in report/ncov_tools/data and the per-sample path report ("<SAMPLE> , <bam> , <fasta> ,
+<variants>", as the find_files scripts printed it) is written. The samples with a missing or ambiguous file are not
+linked and are listed in a summary on stderr (and in --incomplete).
+Assumes it is being run from the top of the genpipes project directory.
+"""
+
+import os
+import sys
+import fnmatch
+import argparse
+
+# Searched tree, file name pattern and link name of the bam, consensus and variants of each caller
+CALLER_FILES = {
+    'ivar': [
+        ('alignment', "{sample}.sorted.filtered.primerTrim.bam", "{sample}.mapped.primertrimmed.sorted.bam"),
+        ('consensus', "{sample}.consensus.*.fasta", "{sample}.consensus.fasta"),
+        ('variant', "{sample}.*tsv", "{sample}.variants.tsv")
+        ],
+    'freebayes': [
+        ('alignment', "{sample}.sorted.filtered.primerTrim.bam", "{sample}.mapped.primertrimmed.sorted.bam"),
+        ('consensus', "{sample}.freebayes_calling.consensus.fasta", "{sample}.consensus.fasta"),
+        ('variant', "{sample}.freebayes_calling.consensus.vcf", "{sample}.variants.vcf")
+        ]
+    }
+FILE_TYPES = ['bam', 'consensus', 'variants']
+REPORT_HEADER = "sample,bam.path,fasta.path,tsv.path"
+LINK_DIR = os.path.join("report", "ncov_tools", "data")
+
+def parse_args():
+    """
+    Argument parser
+    """
+    description = "Links the bam, consensus and variants files of all the samples of a run for ncov_tools."
+
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument('-r',
+                        '--readset',
+                        help="readset file of the run, the samples being the first column of the lines without 'Sample'.",
+                        required=False)
+
+    parser.add_argument('-s',
+                        '--samples',
+                        help="Samples to link, instead of the samples of the readset file.",
+                        nargs='+',
+                        required=False)
+
+    parser.add_argument('-c',
+                        '--caller',
+                        help="Variant caller whose consensus and variants are linked (Default: ivar).",
+                        choices=sorted(CALLER_FILES),
+                        default='ivar')
+
+    parser.add_argument('-o',
+                        '--output',
+                        help="Per-sample path report (Default: stdout).",
+                        required=False)
+
+    parser.add_argument('--no_header',
+                        help="Don't write the header of the path report.",
+                        action='store_true')
+
+    parser.add_argument('-i',
+                        '--incomplete',
+                        help="tsv listing the samples that were not linked along with the missing files.",
+                        required=False)
+
+    args = parser.parse_args()
+    if bool(args.readset) == bool(args.samples):
+        parser.error("one of --readset or --samples is required")
+    return args
+
+def read_samples(readset_file):
+    """
+    Returns the samples of a readset file as 'cut -f 1 readset.txt | grep -v Sample' does, one per readset
+    """
+    with open(readset_file, 'r') as infile:
+        return [line.rstrip("\r\n").split("\t")[0] for line in infile if "Sample" not in line]
+
+def index_tree(top):
+    """
+    Walks a directory once and returns its files indexed by each prefix of their name ending before a '.'
+    Symbolic links are neither followed nor listed, as with find -type f
+    """
+    index = {}
+    pending = [top]
+    while pending:
+        directory = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                pending.append(entry.path)
+            elif entry.is_file(follow_symlinks=False):
+                dot = entry.name.find(".")
+                while dot > 0:
+                    index.setdefault(entry.name[:dot], []).append((entry.name, entry.path))
+                    dot = entry.name.find(".", dot + 1)
+    return index
+
+def find_files(indexes, sample, caller):
+    """
+    Returns the sorted paths matching each file pattern of a sample
+    """
+    found = []
+    for tree, pattern, _ in CALLER_FILES[caller]:
+        pattern = pattern.format(sample=sample)
+        found.append(sorted(path for name, path in indexes[tree].get(sample, []) if fnmatch.fnmatchcase(name, pattern)))
+    return found
+
+def report_line(sample, found):
+    """
+    Returns the path report line of a sample, as 'echo $SAMPLEID "," $(find ...) "," ...' printed it
+    """
+    words = [sample]
+    for paths in found:
+        words.append(",")
+        words.extend(paths)
+    return " ".join(words)
+
+def link_sample(sample, found, caller, project_dir):
+    """
+    Links the files of a complete sample in report/ncov_tools/data
+    """
+    for paths, (_, _, link_name) in zip(found, CALLER_FILES[caller]):
+        link = os.path.join(LINK_DIR, link_name.format(sample=sample))
+        if os.path.lexists(link):
+            os.remove(link)
+        os.symlink(os.path.join(project_dir, paths[0]), link)
+
+def link_files(samples, caller, report, incomplete_file=None):
+    """
+    Indexes the alignment, consensus and variant trees once, links the complete samples and writes their path report
+    Returns the list of (sample, problems) of the samples that were not linked
+    """
+    indexes = dict((tree, index_tree(tree + "/")) for tree in set(tree for tree, _, _ in CALLER_FILES[caller]))
+    project_dir = os.getcwd()
+    os.makedirs(LINK_DIR, exist_ok=True)
+    incomplete = []
+    linked = set()
+    for sample in samples:
+        found = find_files(indexes, sample, caller)
+        report.write(report_line(sample, found) + "\n")
+        if sample in linked or sample in dict(incomplete):
+            continue
+        problems = ["%s missing" % file_type for file_type, paths in zip(FILE_TYPES, found) if not paths]
+        problems += ["%i %s files" % (len(paths), file_type) for file_type, paths in zip(FILE_TYPES, found) if len(paths) > 1]
+        if problems:
+            incomplete.append((sample, ", ".join(problems)))
+        else:
+            link_sample(sample, found, caller, project_dir)
+            linked.add(sample)
+
+    for sample, problems in incomplete:
+        sys.stderr.write("WARNING: sample %s not linked for ncov_tools (%s)\n" % (sample, problems))
+    sys.stderr.write("%i samples linked for ncov_tools, %i incomplete\n" % (len(linked), len(incomplete)))
+    if incomplete_file:
+        with open(incomplete_file, 'w') as outfile:
+            outfile.write("sample\tproblems\n")
+            outfile.writelines("%s\t%s\n" % entry for entry in incomplete)
+    return incomplete
+
+def main():
+    """
+    main
+    """
+    args = parse_args()
+    samples = args.samples if args.samples else read_samples(args.readset)
+    report = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        if not args.no_header:
+            report.write(REPORT_HEADER + "\n")
+        link_files(samples, args.caller, report, args.incomplete)
+    finally:
+        if args.output:
+            report.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -22,10 +22,8 @@ cd ${RUN_PATH}
 
 # Create ncov_tools links
 echo "Linking files for ncov_tools..."
-echo "sample,bam.path,fasta.path,tsv.path" > output_file_paths.csv
-for item in $(cut -f 1 readset.txt | grep -v Sample); do
-    bash ${REPORT_TMPLTS}/find_files.sh ${item} >> output_file_paths.csv
-done
+python ${REPORT_TMPLTS}/link_ncov_tools_files.py --readset readset.txt --caller ivar \
+    --output output_file_paths.csv --incomplete ncov_tools_incomplete_samples.tsv
 
 # Run Collect Metrics Script
 echo "Collecting metrics..."